@@ -1,11 +1,33 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-import os, sys, re, subprocess, tempfile
+import os, sys, re, subprocess, tempfile, socket, struct, time, threading
+import fcntl, termios
 from subprocess import Popen, PIPE
 
 CLEANUP = False
 
+# Options passed to WA_CMD before the module (see usage)
+WA_ARGS = []
+
+# With --batch the commands of each module are queued here and run
+# through a single WA_CMD --batch process (see run_batch) so they share
+# the instance's memory and globals
+BATCH = None
+
+# With --serve the queued commands are sent to a WA_CMD --serve server
+# instead (see run_served)
+SERVE = False
+
+# With --stream each module is piped to WA_CMD as "-", STREAM_CHUNK
+# bytes at a time (see stream_module), so section headers and function
+# bodies span several reads
+STREAM = False
+STREAM_CHUNK = 7
+
+# Output of the spectest.print and core.DEBUG imports in batch output
+GUEST_OUTPUT = re.compile("^(DEBUG: .*|[^ ]+:i32 '.*')$")
+
 # regex patterns of tests to skip
 C_SKIP_TESTS = (
         # names.wast
@@ -135,21 +157,84 @@ def hexpad32(i):
 def hexpad64(i):
     return "0x%016x" % i
 
+# The module dump (Types: through Block maps:) in the WA_CMD log
+def module_dump(err):
+    start = err.find("Types:")
+    end = err.find("\n\n", err.find("Block maps:"))
+    if start < 0 or end < 0:
+        return ""
+    return err[start:end]
+
+# Bytes written to the pipe fd that have not been read yet
+def pipe_unread(fd):
+    return struct.unpack("i", fcntl.ioctl(fd, termios.FIONREAD, "\0"*4))[0]
+
+# Run cmd, which reads its module from "-", with the module bytes data
+# written to its stdin STREAM_CHUNK bytes at a time. Each piece is
+# written once the last one has been read, so each is a separate
+# read. Returns (returncode, out, err).
+def stream_module(cmd, data):
+    (rfd, wfd) = os.pipe()
+    sp = Popen(cmd, stdin=rfd, stdout=PIPE, stderr=PIPE, close_fds=True)
+    os.close(rfd)
+    done = threading.Event()  # cmd has exited
+    def feed():
+        try:
+            for i in range(0, len(data), STREAM_CHUNK):
+                os.write(wfd, data[i:i+STREAM_CHUNK])
+                while pipe_unread(wfd) > 0 and not done.is_set():
+                    time.sleep(0.001)
+        except OSError:
+            pass  # WA_CMD stopped reading (custom sections after Data)
+        finally:
+            os.close(wfd)
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    (out, err) = sp.communicate()
+    done.set()
+    feeder.join()
+    return sp.returncode, out, err
+
 def invoke(wasm, func, args, returncode=0):
-    cmd = [WA_CMD, wasm, func, "--"] + args
-    #print("Running: %s" % " ".join(cmd))
+    if STREAM:
+        cmd = [WA_CMD] + WA_ARGS + ["-", func, "--"] + args
+        (rc, out, err) = stream_module(cmd, file(wasm, 'rb').read())
+    else:
+        cmd = [WA_CMD] + WA_ARGS + [wasm, func, "--"] + args
+        #print("Running: %s" % " ".join(cmd))
 
-    sp = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    (out, err) = sp.communicate()
-    if sp.returncode != returncode:
+        sp = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        (out, err) = sp.communicate()
+        rc = sp.returncode
+    if rc != returncode:
         raise Exception("Failed (retcode expected: %d, got: %d)\n%s" % (
-            returncode, sp.returncode, err))
+            returncode, rc, err))
+    if "--cache-dir" in WA_ARGS:
+        # Run again from the cached module and expect the same output
+        # and module dump
+        sp = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        (out2, err2) = sp.communicate()
+        if sp.returncode != returncode or out2 != out:
+            raise Exception("Failed (cached run differs):\n"
+                            "  first: '%s'\n  cached: '%s'\n%s" % (
+                                out, out2, err2))
+        if module_dump(err2) != module_dump(err):
+            raise Exception("Failed (cached module dump differs):\n"
+                            "first:\n%s\ncached:\n%s" % (
+                                module_dump(err), module_dump(err2)))
     return out, err
 
 def test_assert(mode, wasm, func, args, expected, returncode=0):
+    if BATCH is not None:
+        BATCH.append((mode, func, args, expected, returncode))
+        return
     print("Testing(%s) %s(%s) = %s" % (
         mode, func, ", ".join(args), expected))
 
+    out, err = invoke(wasm, func, args, returncode)
+    check_result(expected, out, err, returncode)
+
+def check_result(expected, out, err, returncode):
 
     expects = set([expected])
     m0 = re.search("^(-?[0-9\.e-]+):f32$", expected)
@@ -167,8 +252,6 @@ def test_assert(mode, wasm, func, args, expected, returncode=0):
     if expected == "nan:f64":
         expects.add("-nan:f64")
 
-    out, err = invoke(wasm, func, args, returncode)
-
     # munge the output some
     out = out.rstrip("\n")
     out = re.sub("L:i32$", ':i32', out)
@@ -293,17 +376,253 @@ def do_invoke(wasm, form):
     else:
         args = [re.split(' +', v)[1] for v in re.split("\)\s*\(", m.group(2)[1:-1])]
 
+    if BATCH is not None:
+        BATCH.append(("invoke", func, args, None, 0))
+        return
     print("Invoking %s(%s)" % (
         func, ", ".join([str(a) for a in args])))
 
     invoke(wasm, func, args)
 
+def batch_output(wasm, lines, wa_args):
+    cmd = [WA_CMD] + wa_args + [wasm]
+    sp = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    (out, err) = sp.communicate("".join(lines))
+    return sp.returncode, out, err
+
+# Run the queued commands of a module as one batch and check the
+# result line of each in turn. The batch exits with 1 if any command
+# trapped.
+def run_batch(wasm, commands):
+    lines = ["%s\n" % " ".join([func] + args)
+             for (_, func, args, _, _) in commands]
+    print("Running %d commands in one batch" % len(lines))
+    returncode, out, err = batch_output(wasm, lines, WA_ARGS)
+    if "--cache-dir" in WA_ARGS:
+        # Run again from the cached module and expect the same output
+        returncode2, out2, err2 = batch_output(wasm, lines, WA_ARGS)
+        if returncode2 != returncode or out2 != out:
+            raise Exception("Failed (cached batch differs):\n"
+                            "  first: '%s'\n  cached: '%s'\n%s" % (
+                                out, out2, err2))
+    if "--jobs" in WA_ARGS:
+        # Results and guest output come back in input order, as from
+        # a single process
+        idx = WA_ARGS.index("--jobs")
+        wa_args = WA_ARGS[:idx] + WA_ARGS[idx+2:] + ["--batch"]
+        returncode2, out2, err2 = batch_output(wasm, lines, wa_args)
+        if returncode2 != returncode or out2 != out:
+            raise Exception("Failed (--jobs output differs from --batch):\n"
+                            "  jobs: '%s'\n  batch: '%s'\n%s" % (
+                                out, out2, err))
+    results = [l for l in out.split("\n")[:-1] if not GUEST_OUTPUT.match(l)]
+    if len(results) != len(commands):
+        raise Exception("Failed (%d results for %d commands)\n%s%s" % (
+            len(results), len(commands), out, err))
+    expected_returncode = check_results(commands, results)
+    if returncode != expected_returncode:
+        raise Exception("Failed (batch retcode expected: %d, got: %d)\n%s" % (
+            expected_returncode, returncode, err))
+
+# Check the result line of each queued command. Returns 1 if any of
+# them trapped, else 0.
+def check_results(commands, results):
+    expected_returncode = 0
+    for (mode, func, args, expected, rc), line in zip(commands, results):
+        if mode == "invoke":
+            print("Invoked %s(%s) = %s" % (func, ", ".join(args), line))
+            if line.startswith("Exception:") or line.startswith("Error:"):
+                raise Exception("Failed:\n  invoke: '%s'" % line)
+            continue
+        print("Testing(%s) %s(%s) = %s" % (
+            mode, func, ", ".join(args), expected))
+        if rc == 1:
+            expected_returncode = 1
+            if not line.startswith("Exception:"):
+                raise Exception("Failed:\n  expected: '%s'\n  got: '%s'" % (
+                    expected, line))
+            check_result(expected, "", line, 1)
+        else:
+            check_result(expected, line + "\n", "", 0)
+    return expected_returncode
+
+def frame(payload):
+    return struct.pack(">I", len(payload)) + payload
+
+def read_exact(sock, n):
+    data = ""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise Exception("Failed (server closed the connection)")
+        data += chunk
+    return data
+
+def read_frame(sock):
+    n = struct.unpack(">I", read_exact(sock, 4))[0]
+    return read_exact(sock, n)
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+# Run the queued commands of a module against a WA_CMD --serve server.
+# A first client sends a request and disconnects without reading the
+# response, then the commands are pipelined on one connection followed
+# by an empty and an unknown export request, which must get Error
+# responses without closing the connection.
+def run_served(wasm, commands):
+    path = tempfile.mktemp(suffix=".sock")
+    log = tempfile.TemporaryFile()
+    cmd = [WA_CMD] + WA_ARGS + ["--serve", path, wasm]
+    print("Serving %d commands from '%s'" % (len(commands), path))
+    server = Popen(cmd, stdout=log, stderr=log)
+    try:
+        for i in range(200):
+            if server.poll() is not None or os.path.exists(path): break
+            time.sleep(0.05)
+
+        if commands:
+            (_, func, args, _, _) = commands[0]
+            sock = connect(path)
+            sock.sendall(frame(" ".join([func] + args)))
+            time.sleep(0.2)  # the response is never read
+            sock.close()
+
+        sock = connect(path)
+        requests = [frame(" ".join([func] + args))
+                    for (_, func, args, _, _) in commands]
+        requests.append(frame(""))
+        requests.append(frame("no-such-export"))
+        sock.sendall("".join(requests))
+        results = [read_frame(sock) for r in requests]
+        sock.close()
+        for extra in results[-2:]:
+            print("Testing(error) %s" % extra)
+            if not extra.startswith("Error:"):
+                raise Exception("Failed:\n  expected: 'Error: ...'\n"
+                                "  got: '%s'" % extra)
+        check_results(commands, results[:-2])
+
+        # The server keeps serving new connections
+        sock = connect(path)
+        sock.sendall(frame(""))
+        read_frame(sock)
+        sock.close()
+        if server.poll() is not None:
+            raise Exception("Failed (server exited with %d)" % (
+                server.returncode))
+    except:
+        if server.poll() is None:
+            server.kill()
+        server.wait()
+        log.seek(0)
+        print(log.read()[-2000:])
+        raise
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        if os.path.exists(path):
+            os.remove(path)
+
+# The module of an assert_invalid (or assert_unlinkable) has to be
+# rejected when it is loaded (or instantiated, which binds its
+# imports) with an error, not a crash such as an IndexError. Function
+# bodies are validated when the module is loaded (on first call with
+# --lazy, so that is left out).
+def test_assert_invalid(wast2wasm, form, kind="invalid"):
+    m = re.search('^\(assert_%s\s+(\(module\\b.*\))\s*"([^"]*)"\s*\)\s*$'
+                  % kind, form, re.S)
+    if not m:
+        raise Exception("unparsed assert_%s: '%s'" % (kind, form))
+    expected = m.group(2)
+    print("Testing(%s) module = %s" % (kind, expected))
+
+    (t1fd, wast_tempfile) = tempfile.mkstemp(suffix=".wast")
+    (t2fd, wasm_tempfile) = tempfile.mkstemp(suffix=".wasm")
+    try:
+        file(wast_tempfile, 'w').write(m.group(1))
+        subprocess.check_call([wast2wasm, "--no-check", wast_tempfile,
+                               "-o", wasm_tempfile])
+        wa_args = [a for a in WA_ARGS if a not in ("--lazy", "--batch")]
+        if STREAM:
+            cmd = [WA_CMD] + wa_args + ["--batch-file", "/dev/null", "-"]
+            (rc, out, err) = stream_module(cmd,
+                                           file(wasm_tempfile, 'rb').read())
+        else:
+            cmd = [WA_CMD] + wa_args + ["--batch", wasm_tempfile]
+            sp = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            (out, err) = sp.communicate("")
+            rc = sp.returncode
+        got = err.rstrip("\n").split("\n")[-1]
+        if rc == 0:
+            raise Exception("Failed (invalid module loaded):\n  expected: '%s'" % (
+                expected))
+        if not re.match("^(WA)?Exception: ", got):
+            raise Exception("Failed:\n  expected: '%s'\n  got: '%s'" % (
+                expected, got))
+        print("  got: %s" % got)
+    finally:
+        os.close(t1fd)
+        os.close(t2fd)
+        os.remove(wast_tempfile)
+        os.remove(wasm_tempfile)
+
+def read_uleb(data, pos):
+    result = shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return result, pos
+
+# With --stream, a module cut short (in its magic, after the id of its
+# first section, in the middle of its Code section and before the last
+# byte of its last section other than a custom one) fails to load with
+# an error rather than a crash. Custom sections after Data are never
+# read from a stream.
+def test_truncated(wasm):
+    data = file(wasm, 'rb').read()
+    expected = "Exception: unexpected end of module"
+    cuts = set([7, 9])
+    last_end = 0
+    pos = 8
+    while pos < len(data):
+        id = ord(data[pos])
+        length, start = read_uleb(data, pos+1)
+        pos = start + length
+        if id == 10:  # Code
+            cuts.add(start + length//2)
+        if id != 0:
+            last_end = pos
+    if last_end > 9:
+        cuts.add(last_end - 1)
+    for cut in sorted(cuts):
+        if cut >= len(data): continue
+        print("Testing(truncated) module[:%d] = %s" % (cut, expected))
+        cmd = [WA_CMD] + WA_ARGS + ["--batch-file", "/dev/null", "-"]
+        (rc, out, err) = stream_module(cmd, data[:cut])
+        got = err.rstrip("\n").split("\n")[-1]
+        if rc == 0 or got != expected:
+            raise Exception("Failed:\n  expected: '%s'\n  got: '%s'" % (
+                expected, got))
+
 def skip_test(form):
     for s in SKIP_TESTS:
         if re.search(s, form):
             return True
     return False
 
+def run_commands(wasm, commands):
+    if SERVE:
+        run_served(wasm, commands)
+    else:
+        run_batch(wasm, commands)
+
 def run_test_file(wast2wasm, wa_cmd, test_file):
     (t1fd, wast_tempfile) = tempfile.mkstemp(suffix=".wast")
     (t2fd, wasm_tempfile) = tempfile.mkstemp(suffix=".wasm")
@@ -316,6 +635,9 @@ def run_test_file(wast2wasm, wa_cmd, test_file):
         runner = None
 
         for form in forms:
+            if BATCH and re.match("^\(module\\b.*", form):
+                run_commands(wasm_tempfile, BATCH)
+                del BATCH[:]
             if  ";;" == form[0:2]:
                 print(form)
             elif re.match("^\(module\\b.*", form):
@@ -330,9 +652,11 @@ def run_test_file(wast2wasm, wa_cmd, test_file):
                         wasm_tempfile ]
                 #print("Running: %s" % " ".join(cmd))
                 subprocess.check_call(cmd)
+                if STREAM:
+                    test_truncated(wasm_tempfile)
 
                 print("Loading module WASM from '%s'" % wasm_tempfile)
-                cmd = [wa_cmd, "--repl", wasm_tempfile]
+                cmd = [wa_cmd] + WA_ARGS + ["--repl", wasm_tempfile]
                 #print("Running: %s" % " ".join(cmd))
 
                 runner = Popen(cmd, stdout=PIPE, stderr=PIPE)
@@ -352,19 +676,19 @@ def run_test_file(wast2wasm, wa_cmd, test_file):
             elif re.match("^\(invoke\\b.*", form):
                 do_invoke(wasm_tempfile, form)
             elif re.match("^\(assert_invalid\\b.*", form):
-                #print("ignoring assert_invalid")
-                pass
+                test_assert_invalid(wast2wasm, form)
             elif re.match("^\(assert_exhaustion\\b.*", form):
                 print("ignoring assert_exhaustion")
                 pass
             elif re.match("^\(assert_unlinkable\\b.*", form):
-                print("ignoring assert_unlinkable")
-                pass
+                test_assert_invalid(wast2wasm, form, "unlinkable")
             elif re.match("^\(assert_return_nan\\b.*", form):
                 print("ignoring assert_return_nan")
                 pass
             else:
                 raise Exception("unrecognized form '%s...'" % form[0:40])
+        if BATCH:
+            run_commands(wasm_tempfile, BATCH)
     finally:
         if CLEANUP:
             print("Removing tempfiles")
@@ -374,10 +698,43 @@ def run_test_file(wast2wasm, wa_cmd, test_file):
             print("Leaving tempfiles: %s" % (
                 [wast_tempfile, wasm_tempfile]))
 
+def usage():
+    print("usage: runtest.py [--engine NAME] [WA_CMD OPTION...] TEST.wast")
+    print("  options before the test file are passed on to WA_CMD, e.g.")
+    print("  --engine tiered --tier-threshold 0 or --cache-dir DIR (which")
+    print("  also checks that a second, cached run gives the same output)")
+    print("  With --batch the commands after each module are run through")
+    print("  one WA_CMD --batch process, so they share memory and globals")
+    print("  With --serve they are sent over one connection to a WA_CMD")
+    print("  --serve server. With --jobs N they are run as a batch split")
+    print("  across N workers (so have to be independent of each other)")
+    print("  With --stream each module is piped to WA_CMD in small pieces")
+    print("  (as '-') and cut short copies of it must fail to load")
+    sys.exit(2)
+
 if __name__ == "__main__":
     WAST2WASM = os.environ.get("WAST2WASM", "wast2wasm")
     WA_CMD = os.environ.get("WA_CMD", "./warpy.py")
 
+    if len(sys.argv) < 2 or sys.argv[-1].startswith("-"):
+        usage()
+    WA_ARGS = sys.argv[1:-1]
+    if "--engine" in WA_ARGS and WA_ARGS.index("--engine") == len(WA_ARGS)-1:
+        usage()
+
+    if "--batch" in WA_ARGS or "--jobs" in WA_ARGS:
+        BATCH = []
+    if "--serve" in WA_ARGS:
+        WA_ARGS.remove("--serve")
+        SERVE = True
+        BATCH = []
+    if "--stream" in WA_ARGS:
+        WA_ARGS.remove("--stream")
+        STREAM = True
+        # stdin carries the module, and the cache needs a whole file
+        if BATCH is not None or "--cache-dir" in WA_ARGS:
+            usage()
+
     if WA_CMD.endswith(".py"):
         SKIP_TESTS = PY_SKIP_TESTS
     else:
@@ -386,4 +743,5 @@ if __name__ == "__main__":
 
     print("WA_CMD: '%s'" % WA_CMD)
     print("WAST2WASM: '%s'" % WAST2WASM)
-    run_test_file(WAST2WASM, WA_CMD, sys.argv[1])
+    print("WA_ARGS: %s" % WA_ARGS)
+    run_test_file(WAST2WASM, WA_CMD, sys.argv[-1])
@@ -0,0 +1,47 @@
+;; Memory and globals persist across the lines of a batch (and across
+;; a trap). Each invoke starts a new instance otherwise, so run with:
+;;   ./runtest.py --batch test/batch.wast
+(module
+  (memory 1)
+  (global $count (mut i32) (i32.const 0))
+  (func $start
+    (i32.store (i32.const 0) (i32.const 7)))
+  (start $start)
+  (func (export "store") (param i32 i32)
+    (i32.store (get_local 0) (get_local 1)))
+  (func (export "load") (param i32) (result i32)
+    (i32.load (get_local 0)))
+  (func (export "inc") (result i32)
+    (set_global $count (i32.add (get_global $count) (i32.const 1)))
+    (get_global $count))
+  (func (export "grow") (param i32) (result i32)
+    (grow_memory (get_local 0)))
+  (func (export "size") (result i32)
+    (current_memory))
+)
+(assert_return (invoke "load" (i32.const 0)) (i32.const 7))
+(invoke "store" (i32.const 8) (i32.const 42))
+(assert_return (invoke "load" (i32.const 8)) (i32.const 42))
+(assert_return (invoke "inc") (i32.const 1))
+(assert_return (invoke "inc") (i32.const 2))
+(assert_trap (invoke "load" (i32.const 65536)) "out of bounds memory access")
+(assert_return (invoke "grow" (i32.const 1)) (i32.const 1))
+(assert_return (invoke "size") (i32.const 2))
+(invoke "store" (i32.const 65536) (i32.const 3))
+(assert_return (invoke "load" (i32.const 65536)) (i32.const 3))
+(assert_return (invoke "inc") (i32.const 3))
+
+;; A second module gets a fresh instance. The output of its start
+;; function comes before the first result line.
+(module
+  (import "spectest" "print" (func $print (param i32)))
+  (global $count (mut i32) (i32.const 10))
+  (func $start
+    (call $print (i32.const 0x6b6f)))
+  (start $start)
+  (func (export "inc") (result i32)
+    (set_global $count (i32.add (get_global $count) (i32.const 1)))
+    (get_global $count))
+)
+(assert_return (invoke "inc") (i32.const 11))
+(assert_return (invoke "inc") (i32.const 12))
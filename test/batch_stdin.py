@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# core.readline in a --batch run reads the lines of stdin that follow
+# its command (batch commands and the guest share one reader). Run from
+# the top directory with WAST2WASM set as for runtest.py:
+#   python test/batch_stdin.py
+
+from __future__ import print_function
+import os, sys, subprocess, tempfile
+
+WA_CMD = os.environ.get("WA_CMD", "./warpy.py")
+
+MODULE = """
+(module
+  (import "core" "readline" (func $readline (param i32 i32) (result i32)))
+  (import "core" "writeline" (func $writeline (param i32)))
+  (memory 1)
+  (func (export "rd") (result i32) (local i32)
+    (set_local 0 (call $readline (i32.const 0) (i32.const 100)))
+    (if (i32.ge_s (get_local 0) (i32.const 0))
+      (then (call $writeline (i32.const 0))))
+    (get_local 0))
+  (func (export "one") (result i32) (i32.const 1))
+)
+"""
+
+# (batch arguments, stdin, expected stdout)
+TESTS = [
+    (["--batch"], "rd\nhello\none\n",
+     "user> hello\n0x5:i32\n0x1:i32\n"),
+    (["--batch"], "rd\nhello\nrd\n\none\nrd\n",
+     "user> hello\n0x5:i32\nuser> \n0x0:i32\n0x1:i32\nuser> -0x1:i32\n"),
+]
+
+def compile_module(wasm_tempfile):
+    wast2wasm = os.environ.get("WAST2WASM", "wast2wasm")
+    (t1fd, wast_tempfile) = tempfile.mkstemp(suffix=".wast")
+    try:
+        os.write(t1fd, MODULE)
+        subprocess.check_call([wast2wasm, "--no-check", wast_tempfile,
+                               "-o", wasm_tempfile])
+    finally:
+        os.close(t1fd)
+        os.remove(wast_tempfile)
+
+def run_tests(wasm):
+    for (args, stdin, expected) in TESTS:
+        print("Testing %s with stdin %r" % (" ".join(args), stdin))
+        sp = subprocess.Popen([WA_CMD] + args + [wasm],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE)
+        (out, err) = sp.communicate(stdin)
+        if sp.returncode != 0 or out != expected:
+            raise Exception("Failed:\n  expected: %r\n  got: %r\n"
+                            "  stderr: %r" % (expected, out, err))
+
+if __name__ == "__main__":
+    (t2fd, wasm_tempfile) = tempfile.mkstemp(suffix=".wasm")
+    try:
+        compile_module(wasm_tempfile)
+        run_tests(wasm_tempfile)
+    finally:
+        os.close(t2fd)
+        os.remove(wasm_tempfile)
+    print("All batch stdin tests passed")
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# Host access to linear memory (Memory.read_bytes, write_bytes, copy
+# and view) from host functions registered with register_python. Run
+# from the top directory with WAST2WASM set as for runtest.py:
+#   python test/host_memory.py
+
+from __future__ import print_function
+import os, sys, subprocess, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import warpy
+from warpy import I32, WAException
+
+MODULE = """
+(module
+  (import "host" "write" (func $write (param i32 i32)))
+  (import "host" "read" (func $read (param i32 i32) (result i32)))
+  (import "host" "copy" (func $copy (param i32 i32 i32)))
+  (import "host" "keep" (func $keep (param i32 i32)))
+  (import "host" "poke" (func $poke (param i32 i32)))
+  (memory 1 4)
+  (func (export "write") (param i32 i32) (call $write (get_local 0) (get_local 1)))
+  (func (export "read") (param i32 i32) (result i32)
+    (call $read (get_local 0) (get_local 1)))
+  (func (export "copy") (param i32 i32 i32)
+    (call $copy (get_local 0) (get_local 1) (get_local 2)))
+  (func (export "keep") (param i32 i32) (call $keep (get_local 0) (get_local 1)))
+  (func (export "poke") (param i32 i32) (call $poke (get_local 0) (get_local 1)))
+  (func (export "load8") (param i32) (result i32)
+    (i32.load8_u (get_local 0)))
+  (func (export "store8") (param i32 i32)
+    (i32.store8 (get_local 0) (get_local 1)))
+  (func (export "grow") (param i32) (result i32)
+    (grow_memory (get_local 0)))
+)
+"""
+
+# What the host functions read (see host_read) and the view kept by
+# host_keep
+read_log = []
+kept = []
+
+def host_write(mem, pos, length):
+    mem.write_bytes(pos, "abcdefgh"[:length])
+
+def host_read(mem, pos, length):
+    s = mem.read_bytes(pos, length)
+    read_log.append(s)
+    return len(s)
+
+def host_copy(mem, dest, src, length):
+    mem.copy(dest, src, length)
+
+def host_keep(mem, pos, length):
+    del kept[:]
+    kept.append(mem.view(pos, length))
+
+def host_poke(mem, idx, val):
+    kept[0][idx] = chr(val)
+
+def compile_module():
+    wast2wasm = os.environ.get("WAST2WASM", "wast2wasm")
+    (t1fd, wast_tempfile) = tempfile.mkstemp(suffix=".wast")
+    (t2fd, wasm_tempfile) = tempfile.mkstemp(suffix=".wasm")
+    try:
+        os.write(t1fd, MODULE)
+        subprocess.check_call([wast2wasm, "--no-check", wast_tempfile,
+                               "-o", wasm_tempfile])
+        return warpy.read_wasm_file(wasm_tempfile)
+    finally:
+        os.close(t1fd)
+        os.close(t2fd)
+        os.remove(wast_tempfile)
+        os.remove(wasm_tempfile)
+
+def call(inst, name, *args):
+    results = inst.call(name, [str(a) for a in args])
+    if len(results) > 0:
+        return results[0][1]
+    return None
+
+def read(inst, pos, length):
+    call(inst, "read", pos, length)
+    return read_log.pop()
+
+def check(name, got, expected):
+    print("Testing %s = %r" % (name, expected))
+    if got != expected:
+        raise Exception("Failed:\n  expected: %r\n  got: %r" % (
+            expected, got))
+
+def check_trap(name, inst, func, *args):
+    print("Testing(trap) %s = out of bounds memory access" % name)
+    try:
+        call(inst, func, *args)
+    except WAException as e:
+        if e.message != "out of bounds memory access":
+            raise Exception("Failed:\n  expected: 'out of bounds memory"
+                            " access'\n  got: '%s'" % e.message)
+        return
+    raise Exception("Failed:\n  expected: 'out of bounds memory access'"
+                    "\n  got: no trap")
+
+def run_tests(data):
+    reg = warpy.ImportRegistry()
+    reg.register_python("host", "write", [I32, I32], [], host_write)
+    reg.register_python("host", "read", [I32, I32], [I32], host_read)
+    reg.register_python("host", "copy", [I32, I32, I32], [], host_copy)
+    reg.register_python("host", "keep", [I32, I32], [], host_keep)
+    reg.register_python("host", "poke", [I32, I32], [], host_poke)
+    inst = warpy.Instance(warpy.CompiledModule(data), reg, {})
+
+    # write_bytes and read_bytes against guest loads and stores
+    call(inst, "write", 16, 4)
+    check("load8(17) after write_bytes", call(inst, "load8", 17), ord("b"))
+    call(inst, "store8", 18, ord("z"))
+    check("read_bytes(16, 4)", read(inst, 16, 4), "abzd")
+    call(inst, "write", 65532, 4)
+    check("read_bytes at the end of memory", read(inst, 65532, 4), "abcd")
+    check("read_bytes(0, 0)", read(inst, 0, 0), "")
+
+    # copy with overlapping ranges in both directions
+    call(inst, "write", 32, 8)
+    call(inst, "copy", 34, 32, 4)
+    check("copy forward", read(inst, 32, 8), "ababcdgh")
+    call(inst, "write", 32, 8)
+    call(inst, "copy", 32, 34, 4)
+    check("copy backward", read(inst, 32, 8), "cdefefgh")
+
+    # Out of range accesses trap like guest loads and stores
+    check_trap("read_bytes(65533, 4)", inst, "read", 65533, 4)
+    check_trap("write_bytes(65533, 4)", inst, "write", 65533, 4)
+    check_trap("copy to past the end", inst, "copy", 65534, 0, 4)
+    check_trap("copy from past the end", inst, "copy", 0, 65534, 4)
+    check_trap("view(65535, 2)", inst, "keep", 65535, 2)
+    check_trap("read_bytes(-1, 1)", inst, "read", -1, 1)
+
+    # A view writes straight to linear memory and stays valid when the
+    # memory grows in place (within its maximum)
+    call(inst, "keep", 48, 4)
+    call(inst, "poke", 1, ord("v"))
+    check("load8(49) after a write to the view",
+          call(inst, "load8", 49), ord("v"))
+    check("grow(1)", call(inst, "grow", 1), 1)
+    call(inst, "poke", 2, ord("w"))
+    check("load8(50) after grow", call(inst, "load8", 50), ord("w"))
+    call(inst, "store8", 51, ord("x"))
+    check("view after grow", kept[0].tobytes(), "\0vwx")
+
+    # The grown page is in range now
+    call(inst, "write", 65536, 4)
+    check("read_bytes in the grown page", read(inst, 65536, 4), "abcd")
+    check_trap("read_bytes past the grown page", inst, "read", 131070, 4)
+
+if __name__ == "__main__":
+    warpy.INFO = warpy.DEBUG = False
+    run_tests(compile_module())
+    print("All host memory tests passed")
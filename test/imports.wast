@@ -0,0 +1,25 @@
+;; Imports of the core host functions are checked against their
+;; registered signatures when the module is instantiated
+;; (./runtest.py test/imports.wast)
+(module
+  (import "core" "flush" (func $flush))
+  (import "core" "readline" (func $readline (param i32 i32) (result i32)))
+  (import "core" "writeline" (func $writeline (param i32)))
+  (func (export "flush") (call $flush))
+)
+(invoke "flush")
+(assert_unlinkable
+  (module (import "core" "writeline" (func (param i32 i32))))
+  "incompatible import type")
+(assert_unlinkable
+  (module (import "core" "writeline" (func (param i32) (result i32))))
+  "incompatible import type")
+(assert_unlinkable
+  (module (import "core" "writeline" (func (param i64))))
+  "incompatible import type")
+(assert_unlinkable
+  (module (import "core" "readline" (func (param i32) (result i32))))
+  "incompatible import type")
+(assert_unlinkable
+  (module (import "core" "flush" (func (result i32))))
+  "incompatible import type")
@@ -0,0 +1,43 @@
+;; Modules with invalid function bodies are rejected when they are
+;; loaded (./runtest.py test/invalid.wast)
+(assert_invalid
+  (module (func (result i32) (i64.const 1)))
+  "type mismatch")
+(assert_invalid
+  (module (func (result i32) (i32.add (i32.const 1))))
+  "type mismatch")
+(assert_invalid
+  (module (func (i32.const 1)))
+  "type mismatch")
+(assert_invalid
+  (module (func (result i32) (if i32 (i32.const 1) (then (i32.const 1)))))
+  "type mismatch")
+(assert_invalid
+  (module (func (drop (get_local 0))))
+  "unknown local")
+(assert_invalid
+  (module (func (br 1)))
+  "unknown label")
+(assert_invalid
+  (module (func (call 1)))
+  "unknown function")
+(assert_invalid
+  (module (global i32 (i32.const 0)) (func (set_global 0 (i32.const 1))))
+  "global is immutable")
+(assert_invalid
+  (module (func (drop (i32.load (i32.const 0)))))
+  "unknown memory")
+;; Function 0 ([] -> [i32]) is i32.const 1, end, i32.const 2, end:
+;; operators after the end of the function body
+(assert_invalid
+  (module binary
+    "\00asm" "\01\00\00\00"
+    "\01\05\01\60\00\01\7f"
+    "\03\02\01\00"
+    "\0a\09\01\07\00\41\01\0b\41\02\0b")
+  "END opcode expected")
+
+;; A valid module after the invalid ones still loads and runs
+(module
+  (func (export "one") (result i32) (i32.const 1)))
+(assert_return (invoke "one") (i32.const 1))
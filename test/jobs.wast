@@ -0,0 +1,24 @@
+;; Independent calls split across --jobs workers. Results and the output
+;; of each call come back in input order and a trap in any worker sets
+;; the exit status. Run with more lines than jobs, e.g.:
+;;   ./runtest.py --jobs 3 test/jobs.wast
+;; which also checks the output is the same as from a single --batch.
+(module
+  (import "spectest" "print" (func $print (param i32)))
+  (func (export "echo") (param i32) (result i32)
+    (call $print (get_local 0))
+    (get_local 0))
+  (func (export "div_s") (param i32 i32) (result i32)
+    (call $print (get_local 0))
+    (i32.div_s (get_local 0) (get_local 1)))
+)
+(assert_return (invoke "echo" (i32.const 0x61)) (i32.const 0x61))
+(assert_return (invoke "echo" (i32.const 0x62)) (i32.const 0x62))
+(assert_return (invoke "div_s" (i32.const 0x63) (i32.const 1)) (i32.const 0x63))
+(assert_return (invoke "echo" (i32.const 0x64)) (i32.const 0x64))
+(assert_trap (invoke "div_s" (i32.const 0x65) (i32.const 0)) "integer divide by zero")
+(assert_return (invoke "echo" (i32.const 0x66)) (i32.const 0x66))
+(assert_return (invoke "echo" (i32.const 0x67)) (i32.const 0x67))
+(assert_return (invoke "div_s" (i32.const 0x68) (i32.const 2)) (i32.const 0x34))
+(assert_return (invoke "echo" (i32.const 0x69)) (i32.const 0x69))
+(assert_return (invoke "echo" (i32.const 0x6a)) (i32.const 0x6a))
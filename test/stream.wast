@@ -0,0 +1,53 @@
+;; Modules piped to warpy as "-" in small pieces, so section headers
+;; and function bodies span reads (./runtest.py --stream
+;; test/stream.wast, which also checks that cut short copies of each
+;; module fail to load). They load the same from a file.
+(module
+  (type $v_i (func (result i32)))
+  (memory 1)
+  (table 2 anyfunc)
+  (elem (i32.const 0) $seven $sum)
+  (global $g (mut i32) (i32.const 5))
+  (func $seven (type $v_i) (i32.const 7))
+  (func $sum (type $v_i) (local i32 i32)
+    (set_local 0 (i32.const 0))
+    (set_local 1 (i32.const 0))
+    (block
+      (loop
+        (br_if 1 (i32.ge_u (get_local 0) (i32.const 16)))
+        (set_local 1 (i32.add (get_local 1)
+                              (i32.load8_u (get_local 0))))
+        (set_local 0 (i32.add (get_local 0) (i32.const 1)))
+        (br 0)))
+    (get_local 1))
+  (func (export "call") (param i32) (result i32)
+    (call_indirect (type $v_i) (get_local 0)))
+  (func (export "global") (result i32)
+    (set_global $g (i32.add (get_global $g) (i32.const 1)))
+    (get_global $g))
+  (func (export "load") (param i32) (result i32)
+    (i32.load (get_local 0)))
+  (data (i32.const 0) "\01\02\03\04\05\06\07\08\09\0a\0b\0c\0d\0e\0f\10")
+)
+(assert_return (invoke "call" (i32.const 0)) (i32.const 7))
+(assert_return (invoke "call" (i32.const 1)) (i32.const 136))
+(assert_return (invoke "global") (i32.const 6))
+(assert_return (invoke "load" (i32.const 4)) (i32.const 0x08070605))
+(assert_trap (invoke "call" (i32.const 2)) "undefined element")
+
+;; Custom sections before Type and after Data. When streaming, the
+;; module is complete after Data and the rest is left unread.
+;; Exports "a" (the i32 at 0, set by Data) and "b" (42).
+(module binary
+  "\00asm" "\01\00\00\00"
+  "\00\03\01ax"
+  "\01\05\01\60\00\01\7f"
+  "\03\03\02\00\00"
+  "\05\03\01\00\01"
+  "\07\09\02\01a\00\00\01b\00\01"
+  "\0a\0e\02\07\00\41\00\28\02\00\0b\04\00\41\2a\0b"
+  "\0b\0a\01\00\41\00\0b\04\07\00\00\00"
+  "\00\1c\07trailer" "abcdefghijklmnopqrst"
+  "\00\03\01zz")
+(assert_return (invoke "a") (i32.const 7))
+(assert_return (invoke "b") (i32.const 42))
@@ -0,0 +1,82 @@
+;; Sequences the peephole pass folds or fuses into the superinstructions
+;; 0xc0-0xc5 (see SUPER_INFO). Run with --engine NAME and compare with
+;; --no-peephole.
+(module
+  (memory 1)
+  (data (i32.const 16) "\01\00\00\00\02\00\00\00\03\00\00\00\04\00\00\00")
+  ;; 0xc0 get_local a; get_local b
+  (func (export "two_locals") (param i32 i32) (result i32)
+    (i32.sub (get_local 1) (get_local 0)))
+  ;; 0xc1 get_local a; get_local b; i32.add
+  (func (export "add_locals") (param i32 i32) (result i32)
+    (i32.add (get_local 0) (get_local 1)))
+  (func (export "add_locals64") (param i64 i64) (result i64)
+    (i64.add (get_local 0) (get_local 1)))
+  ;; 0xc2 get_local a; i32.const c; i32.add
+  (func (export "add_local_const") (param i32) (result i32)
+    (i32.add (get_local 0) (i32.const -3)))
+  ;; get_local a; get_local b; i32.const c; i32.add
+  (func (export "sub_add_const") (param i32 i32) (result i32)
+    (i32.sub (get_local 0) (i32.add (get_local 1) (i32.const 10))))
+  ;; 0xc3 get_local a; i32.const c; i32.add; i32.load offset
+  (func (export "load_local_const") (param i32) (result i32)
+    (i32.load offset=4 (i32.add (get_local 0) (i32.const 8))))
+  (func (export "load_local_const_oob") (param i32) (result i32)
+    (i32.load offset=4 (i32.add (get_local 0) (i32.const 65528))))
+  ;; 0xc4 i32.const c; i32.add
+  (func (export "add_const") (param i32 i32) (result i32)
+    (i32.add (i32.mul (get_local 0) (get_local 1)) (i32.const 0x7fffffff)))
+  ;; 0xc5 i32.eqz; br_if
+  (func (export "br_unless") (param i32) (result i32)
+    (block i32
+      (br_if 0 (i32.const 7) (i32.eqz (get_local 0)))
+      (drop)
+      (i32.const 9)))
+  ;; constant folding: i32.const; i32.eqz and i32.const c1; i32.const c2; op
+  (func (export "fold") (result i32)
+    (i32.add (i32.eqz (i32.const 0))
+             (i32.sub (i32.const 5) (i32.mul (i32.const 0x10001) (i32.const 0x10002)))))
+  ;; all of the above in a loop where the fused sequences start at a
+  ;; branch target: sum of the i32s at 16, 20, ... for n elements
+  (func (export "sum") (param $n i32) (result i32)
+    (local $i i32) (local $s i32)
+    (block
+      (loop
+        (br_if 1 (i32.eqz (i32.sub (get_local $n) (get_local $i))))
+        (set_local $s (i32.add (get_local $s)
+          (i32.load offset=16 (i32.add (get_local $i) (i32.const 0)))))
+        (set_local $s (i32.add (get_local $s) (get_local $i)))
+        (set_local $i (i32.add (get_local $i) (i32.const 4)))
+        (set_local $n (i32.add (get_local $n) (i32.const 0)))
+        (br 0)))
+    (get_local $s))
+  ;; a loop whose back-edge is an i32.eqz; br_if
+  (func (export "countdown") (param $n i32) (result i32)
+    (local $c i32)
+    (loop
+      (set_local $c (i32.add (get_local $c) (i32.const 1)))
+      (set_local $n (i32.sub (get_local $n) (i32.const 1)))
+      (br_if 0 (i32.eqz (i32.eqz (get_local $n)))))
+    (get_local $c))
+)
+(assert_return (invoke "two_locals" (i32.const 3) (i32.const 10)) (i32.const 7))
+(assert_return (invoke "add_locals" (i32.const 3) (i32.const 10)) (i32.const 13))
+(assert_return (invoke "add_locals" (i32.const 0x7fffffff) (i32.const 1)) (i32.const 0x80000000))
+(assert_return (invoke "add_locals" (i32.const -1) (i32.const -1)) (i32.const -2))
+(assert_return (invoke "add_locals64" (i64.const 3) (i64.const 10)) (i64.const 13))
+(assert_return (invoke "add_local_const" (i32.const 10)) (i32.const 7))
+(assert_return (invoke "add_local_const" (i32.const 1)) (i32.const -2))
+(assert_return (invoke "add_local_const" (i32.const 0x80000001)) (i32.const 0x7ffffffe))
+(assert_return (invoke "sub_add_const" (i32.const 30) (i32.const 5)) (i32.const 15))
+(assert_return (invoke "load_local_const" (i32.const 4)) (i32.const 1))
+(assert_return (invoke "load_local_const" (i32.const 8)) (i32.const 2))
+(assert_return (invoke "load_local_const_oob" (i32.const 0)) (i32.const 0))
+(assert_trap (invoke "load_local_const_oob" (i32.const 1)) "out of bounds memory access")
+(assert_return (invoke "add_const" (i32.const 3) (i32.const 5)) (i32.const 0x8000000e))
+(assert_return (invoke "br_unless" (i32.const 0)) (i32.const 7))
+(assert_return (invoke "br_unless" (i32.const 1)) (i32.const 9))
+(assert_return (invoke "fold") (i32.const 0xfffd0004))
+(assert_return (invoke "sum" (i32.const 0)) (i32.const 0))
+(assert_return (invoke "sum" (i32.const 16)) (i32.const 34))
+(assert_return (invoke "countdown" (i32.const 1)) (i32.const 1))
+(assert_return (invoke "countdown" (i32.const 25)) (i32.const 25))
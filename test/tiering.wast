@@ -0,0 +1,113 @@
+;; Calls and loops that cross the tier-up threshold of the tiered engine
+;; part way through, so the hot code is promoted (at calls) or entered
+;; on-stack at a loop back-edge (OSR) with live locals, operand stack
+;; values and call frames. Run with, e.g.:
+;;   ./runtest.py --engine tiered --tier-threshold 3 test/tiering.wast
+;;   ./runtest.py --engine tiered --tier-threshold 3 --tier-up closure test/tiering.wast
+(module
+  (type $ii (func (param i32) (result i32)))
+  (table 2 anyfunc)
+  (elem (i32.const 0) $fib $sum_to)
+  (memory 1)
+  ;; promoted at a call, part way down the recursion
+  (func $fib (type $ii)
+    (if i32 (i32.lt_s (get_local 0) (i32.const 2))
+      (then (get_local 0))
+      (else (i32.add (call $fib (i32.sub (get_local 0) (i32.const 1)))
+                     (call $fib (i32.sub (get_local 0) (i32.const 2)))))))
+  (func (export "fib") (param i32) (result i32)
+    (call $fib (get_local 0)))
+  ;; OSR into a single loop with live locals
+  (func $sum_to (type $ii)
+    (local $s i32)
+    (block
+      (loop
+        (br_if 1 (i32.eqz (get_local 0)))
+        (set_local $s (i32.add (get_local $s) (get_local 0)))
+        (set_local 0 (i32.sub (get_local 0) (i32.const 1)))
+        (br 0)))
+    (get_local $s))
+  (func (export "sum_to") (param i32) (result i32)
+    (call $sum_to (get_local 0)))
+  ;; OSR with values of the enclosing expression below the loop
+  (func (export "operands") (param $n i32) (result i32)
+    (local $i i32)
+    (i32.add (i32.const 1000)
+      (i32.mul (i32.const 2)
+        (block i32
+          (loop
+            (set_local $i (i32.add (get_local $i) (i32.const 1)))
+            (br_if 0 (i32.lt_s (get_local $i) (get_local $n))))
+          (get_local $i)))))
+  ;; OSR in an inner loop, then the outer loop continues in the new tier
+  (func (export "nested") (param $n i32) (result i64)
+    (local $i i32) (local $j i32) (local $s i64)
+    (block
+      (loop
+        (br_if 1 (i32.ge_s (get_local $i) (get_local $n)))
+        (set_local $j (i32.const 0))
+        (block
+          (loop
+            (br_if 1 (i32.ge_s (get_local $j) (get_local $i)))
+            (set_local $s (i64.add (get_local $s)
+              (i64.extend_s/i32 (i32.mul (get_local $i) (get_local $j)))))
+            (set_local $j (i32.add (get_local $j) (i32.const 1)))
+            (br 0)))
+        (set_local $i (i32.add (get_local $i) (i32.const 1)))
+        (br 0)))
+    (get_local $s))
+  ;; OSR in a callee while its callers are still interpreted, with a
+  ;; br_table out of the loop and call_indirect from the loop body
+  (func $walk (param $n i32) (param $k i32) (result i32)
+    (local $acc i32)
+    (block $done
+      (block $odd
+        (block $even
+          (loop $top
+            (set_local $acc (i32.add (get_local $acc)
+              (call_indirect (type $ii) (get_local $n)
+                (i32.and (get_local $k) (i32.const 1)))))
+            (set_local $n (i32.sub (get_local $n) (i32.const 1)))
+            (br_table $top $even $odd $done
+              (select (i32.const 0)
+                      (i32.add (i32.const 1) (i32.rem_u (get_local $k) (i32.const 3)))
+                      (get_local $n)))))
+        (return (i32.add (get_local $acc) (i32.const 100))))
+      (return (i32.add (get_local $acc) (i32.const 200))))
+    (i32.add (get_local $acc) (i32.const 300)))
+  (func (export "walk") (param i32 i32) (result i32)
+    (i32.add (i32.const 5) (call $walk (get_local 0) (get_local 1))))
+  ;; OSR with memory stores in the loop, checked after the loop ends
+  (func (export "fill") (param $n i32) (result i32)
+    (local $i i32) (local $s i32)
+    (loop
+      (i32.store8 (get_local $i) (get_local $i))
+      (set_local $i (i32.add (get_local $i) (i32.const 1)))
+      (br_if 0 (i32.lt_u (get_local $i) (get_local $n))))
+    (set_local $i (i32.const 0))
+    (loop
+      (set_local $s (i32.add (get_local $s) (i32.load8_u (get_local $i))))
+      (set_local $i (i32.add (get_local $i) (i32.const 1)))
+      (br_if 0 (i32.lt_u (get_local $i) (get_local $n))))
+    (get_local $s))
+  ;; a trap after the function has been promoted
+  (func (export "trap_hot") (param $n i32) (result i32)
+    (loop
+      (set_local $n (i32.sub (get_local $n) (i32.const 1)))
+      (br_if 0 (get_local $n)))
+    (i32.div_u (i32.const 1) (get_local $n)))
+)
+(assert_return (invoke "fib" (i32.const 0)) (i32.const 0))
+(assert_return (invoke "fib" (i32.const 2)) (i32.const 1))
+(assert_return (invoke "fib" (i32.const 15)) (i32.const 610))
+(assert_return (invoke "sum_to" (i32.const 2)) (i32.const 3))
+(assert_return (invoke "sum_to" (i32.const 100)) (i32.const 5050))
+(assert_return (invoke "operands" (i32.const 1)) (i32.const 1002))
+(assert_return (invoke "operands" (i32.const 50)) (i32.const 1100))
+(assert_return (invoke "nested" (i32.const 3)) (i64.const 2))
+(assert_return (invoke "nested" (i32.const 40)) (i64.const 293930))
+(assert_return (invoke "walk" (i32.const 10) (i32.const 1)) (i32.const 425))
+(assert_return (invoke "walk" (i32.const 10) (i32.const 2)) (i32.const 448))
+(assert_return (invoke "walk" (i32.const 12) (i32.const 3)) (i32.const 469))
+(assert_return (invoke "fill" (i32.const 100)) (i32.const 4950))
+(assert_trap (invoke "trap_hot" (i32.const 20)) "integer divide by zero")
@@ -0,0 +1,77 @@
+;; Traps raised by each engine (run with ./runtest.py --engine NAME)
+(module
+  (type $ii (func (param i32) (result i32)))
+  (type $v (func))
+  (table 2 anyfunc)
+  (elem (i32.const 0) $double $void)
+  (memory 1)
+  (func $double (type $ii) (i32.mul (get_local 0) (i32.const 2)))
+  (func $void (type $v))
+  (func (export "unreachable") (unreachable))
+  (func (export "unreachable_in_loop") (param i32) (result i32)
+    (block
+      (loop
+        (br_if 1 (i32.eqz (get_local 0)))
+        (set_local 0 (i32.sub (get_local 0) (i32.const 1)))
+        (br 0)))
+    (unreachable))
+  (func (export "div_s") (param i32 i32) (result i32)
+    (i32.div_s (get_local 0) (get_local 1)))
+  (func (export "rem_u") (param i32 i32) (result i32)
+    (i32.rem_u (get_local 0) (get_local 1)))
+  (func (export "div_s64") (param i64 i64) (result i64)
+    (i64.div_s (get_local 0) (get_local 1)))
+  (func (export "load") (param i32) (result i32)
+    (i32.load (get_local 0)))
+  (func (export "load_offset") (param i32) (result i32)
+    (i32.load offset=4 (i32.add (get_local 0) (i32.const 8))))
+  (func (export "store") (param i32)
+    (i64.store (get_local 0) (i64.const 1)))
+  (func (export "indirect") (param i32 i32) (result i32)
+    (call_indirect (type $ii) (get_local 1) (get_local 0)))
+  (func $deep (param i32) (result i32)
+    (i32.add (i32.const 1) (call $deep (get_local 0))))
+  (func (export "deep") (param i32) (result i32)
+    (call $deep (get_local 0)))
+  ;; recursion that stays below the call stack limit (the stacks are
+  ;; grown on the way down)
+  (func $count (param i32) (result i32)
+    (if i32 (i32.eqz (get_local 0))
+      (then (i32.const 0))
+      (else (i32.add (i32.const 1)
+                     (call $count (i32.sub (get_local 0) (i32.const 1)))))))
+  (func (export "count") (param i32) (result i32)
+    (call $count (get_local 0)))
+  ;; the same, alternating between a function the python engine
+  ;; transpiles and one it can not (i32.clz has no translation)
+  (func $mix_f (param i32) (result i32)
+    (if i32 (i32.eqz (get_local 0))
+      (then (i32.const 0))
+      (else (i32.add (i32.const 1)
+                     (call $mix_g (i32.sub (get_local 0) (i32.const 1)))))))
+  (func $mix_g (param i32) (result i32)
+    (drop (i32.clz (get_local 0)))
+    (call $mix_f (get_local 0)))
+  (func (export "mix") (param i32) (result i32)
+    (call $mix_f (get_local 0)))
+)
+(assert_trap (invoke "unreachable") "unreachable")
+(assert_trap (invoke "unreachable_in_loop" (i32.const 10)) "unreachable")
+(assert_return (invoke "div_s" (i32.const 7) (i32.const 2)) (i32.const 3))
+(assert_trap (invoke "div_s" (i32.const 7) (i32.const 0)) "integer divide by zero")
+(assert_trap (invoke "div_s" (i32.const 0x80000000) (i32.const -1)) "integer overflow")
+(assert_trap (invoke "rem_u" (i32.const 7) (i32.const 0)) "integer divide by zero")
+(assert_trap (invoke "div_s64" (i64.const 7) (i64.const 0)) "integer divide by zero")
+(assert_return (invoke "load" (i32.const 65532)) (i32.const 0))
+(assert_trap (invoke "load" (i32.const 65533)) "out of bounds memory access")
+(assert_trap (invoke "load_offset" (i32.const 65524)) "out of bounds memory access")
+(assert_trap (invoke "store" (i32.const 65530)) "out of bounds memory access")
+(assert_return (invoke "indirect" (i32.const 0) (i32.const 21)) (i32.const 42))
+(assert_trap (invoke "indirect" (i32.const 1) (i32.const 21)) "indirect call signature mismatch")
+(assert_trap (invoke "indirect" (i32.const 2) (i32.const 21)) "undefined element")
+(assert_trap (invoke "indirect" (i32.const 9) (i32.const 21)) "undefined element")
+(assert_trap (invoke "deep" (i32.const 0)) "call stack exhausted")
+(assert_return (invoke "count" (i32.const 8000)) (i32.const 8000))
+(assert_trap (invoke "count" (i32.const 9000)) "call stack exhausted")
+(assert_return (invoke "mix" (i32.const 4000)) (i32.const 4000))
+(assert_trap (invoke "mix" (i32.const 4500)) "call stack exhausted")
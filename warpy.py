@@ -8,7 +8,7 @@ TRACE = False   # trace instructions/stacks
 DEBUG = True    # verbose logging
 VALIDATE= True
 
-import sys, os, math
+import sys, os, math, stat
 IS_RPYTHON = sys.argv[0].endswith('rpython')
 
 if IS_RPYTHON:
@@ -17,6 +17,7 @@ if IS_RPYTHON:
     def jitpolicy(driver):
         return JitPolicy()
     from rpython.rlib.jit import JitDriver, elidable, unroll_safe, promote
+    from rpython.rlib.jit import dont_look_inside
 
     from rpython.rtyper.lltypesystem import lltype
     from rpython.rtyper.lltypesystem.lloperation import llop
@@ -25,6 +26,9 @@ if IS_RPYTHON:
     from rpython.rlib.rfloat import round_double
     from rpython.rlib.rarithmetic import (
             intmask, string_to_int)
+    from rpython.rlib.rmarshal import get_marshaller, get_loader
+    from rpython.rlib.rsha import RSHA
+    from rpython.rlib import rsocket, rpoll
 
     class IntSort(TimSort):
         def lt(self, a, b):
@@ -57,9 +61,14 @@ else:
     sys.path.append(os.path.abspath('./pypy2-v5.6.0-src'))
     import traceback
     import struct
+    import marshal, hashlib
+    import socket, select
+    import mmap
+    import ctypes
 
     def elidable(f): return f
     def unroll_safe(f): return f
+    def dont_look_inside(f): return f
     def promote(x): pass
 
     def do_sort(a):
@@ -91,30 +100,40 @@ class WAException(Exception):
         self.message = message
 
 class Type():
+    _immutable_fields_ = ['index', 'form', 'params[*]', 'results[*]']
+
     def __init__(self, index, form, params, results):
         self.index = index
         self.form = form
-        self.params = params
-        self.results = results
+        # Copies so these never share a (resizable) list type with
+        # the lists the parser appends to
+        self.params = params[:]
+        self.results = results[:]
 
 class Code():
     pass
 
 class Block(Code):
     def __init__(self, kind, type, start):
-        self.kind = kind # block opcode (0x00 for init_expr)
+        self.kind = kind # block opcode (0x00 for function)
         self.type = type # value_type
         self.locals = []
         self.start = start
         self.end = 0
         self.else_addr = 0
         self.br_addr = 0
+        self.height = 0 # operand stack height on entry
 
     def update(self, end, br_addr):
         self.end = end
         self.br_addr = br_addr
 
 class Function(Code):
+    # code/consts/reg_code are set once after parsing (or on first
+    # call); quasi-immutable so traces fold the reads through func
+    _immutable_fields_ = ['type', 'index', 'locals?', 'decoded?',
+                          'code?', 'consts?', 'reg_code?']
+
     def __init__(self, type, index):
         self.type = type # value_type
         self.index = index
@@ -123,6 +142,14 @@ class Function(Code):
         self.end = 0
         self.else_addr = 0
         self.br_addr = 0
+        # Pre-decoded form (see decode_function)
+        self.code = []      # opcodes and decoded immediates
+        self.consts = []    # f32/f64 constants indexed from code
+        self.block_map = {} # {block addr: Block, ...} (see find_blocks)
+        self.reg_code = []  # register form (see translate_registers)
+        self.hotness = 0    # calls plus loop back-edges (tiered engine)
+        self.decoded = False  # code is set (see ensure_compiled)
+        self.owner = None   # CompiledModule that decodes it
 
     def update(self, locals, start, end):
         self.locals = locals
@@ -131,11 +158,25 @@ class Function(Code):
         self.br_addr = end
 
 class FunctionImport(Code):
-    def __init__(self, type, module, field):
+    def __init__(self, type, index, module, field):
         self.type = type  # value_type
+        self.index = index  # function index (see ImportRegistry.bind)
         self.module = module
         self.field = field
 
+# Call stack entry. Frames are allocated the first time the call
+# depth reaches them (see grow_callstack) and reused across calls so
+# calls and returns do not allocate.
+class Frame(object):
+    __slots__ = ['func', 'sp', 'fp', 'ra', 'caller']
+
+    def __init__(self):
+        self.func = None    # Function being executed
+        self.sp = -1        # value stack size prior to the call
+        self.fp = -1        # caller frame pointer
+        self.ra = 0         # return address in the caller code
+        self.caller = None  # calling Function (None for top-level)
+
 
 ######################################
 # WebAssembly spec data
@@ -144,8 +185,10 @@ class FunctionImport(Code):
 MAGIC = 0x6d736100
 VERSION = 0x01  # MVP
 
-STACK_SIZE     = 65536
+STACK_SIZE     = 1024  # initial value stack slots (see grow_stacks)
 CALLSTACK_SIZE = 8192
+CALLSTACK_INIT = 64    # initial call stack frames (see grow_callstack)
+MAX_PAGES      = 65536  # 4GiB of 64KiB pages
 
 I32     = 0x7f  # -0x01
 I64     = 0x7e  # -0x02
@@ -424,6 +467,35 @@ OPERATOR_INFO = {
         0xbf : ['f64.reinterpret/i64', ''],
         }
 
+# Operand types ([params], [results]) of the memory, constant and
+# numeric operators, derived from their names (see validate_function)
+def operator_types(name):
+    types = { 'i32' : I32, 'i64' : I64, 'f32' : F32, 'f64' : F64 }
+    t = types[name[0:3]]
+    op = name[4:]
+    if '/' in op:  # conversions and reinterpretations
+        return [types[op.split('/')[1]]], [t]
+    elif op.startswith('load'):
+        return [I32], [t]
+    elif op.startswith('store'):
+        return [I32, t], []
+    elif op == 'const':
+        return [], [t]
+    elif op == 'eqz':
+        return [t], [I32]
+    elif op.split('_')[0] in ('eq', 'ne', 'lt', 'gt', 'le', 'ge'):
+        return [t, t], [I32]
+    elif op in ('clz', 'ctz', 'popcnt', 'abs', 'neg', 'ceil', 'floor',
+                'trunc', 'nearest', 'sqrt'):
+        return [t], [t]
+    else:
+        return [t, t], [t]
+
+OPERATOR_TYPES = {}
+for opcode, (name, _) in OPERATOR_INFO.items():
+    if name[0:4] in ('i32.', 'i64.', 'f32.', 'f64.'):
+        OPERATOR_TYPES[opcode] = operator_types(name)
+
 LOAD_SIZE = { 0x28 : 4,
               0x29 : 8,
               0x2a : 4,
@@ -442,11 +514,11 @@ LOAD_SIZE = { 0x28 : 4,
               0x37 : 8,
               0x38 : 4,
               0x39 : 8,
-              0x40 : 1,
-              0x41 : 2,
-              0x42 : 1,
-              0x43 : 2,
-              0x44 : 4 }
+              0x3a : 1,
+              0x3b : 2,
+              0x3c : 1,
+              0x3d : 2,
+              0x3e : 4 }
 
 
 ######################################
@@ -538,53 +610,6 @@ def rotr64(a,cnt):
     return ((a >> (cnt % 0x40))
             | ((a << (0x40 - (cnt % 0x40))) & 0xffffffffffffffff))
 
-@elidable
-def bytes2uint8(b):
-    return b[0]
-
-@elidable
-def bytes2int8(b):
-    val = b[0]
-    if val & 0x80:
-        return val - 0x100
-    else:
-        return val
-
-#
-
-@elidable
-def bytes2uint16(b):
-    return (b[1]<<8) + b[0]
-
-@elidable
-def bytes2int16(b):
-    val = (b[1]<<8) + b[0]
-    if val & 0x8000:
-        return val - 0x10000
-    else:
-        return val
-
-#
-
-@elidable
-def bytes2uint32(b):
-    return (b[3]<<24) + (b[2]<<16) + (b[1]<<8) + b[0]
-
-@elidable
-def uint322bytes(v):
-    return [0xff & (v),
-            0xff & (v>>8),
-            0xff & (v>>16),
-            0xff & (v>>24)]
-
-@elidable
-def bytes2int32(b):
-    val = (b[3]<<24) + (b[2]<<16) + (b[1]<<8) + b[0]
-    if val & 0x80000000:
-        return val - 0x100000000
-    else:
-        return val
-
 @elidable
 def int2uint32(i):
     return i & 0xffffffff
@@ -599,37 +624,6 @@ def int2int32(i):
 
 #
 
-@elidable
-def bytes2uint64(b):
-    return ((b[7]<<56) + (b[6]<<48) + (b[5]<<40) + (b[4]<<32) +
-            (b[3]<<24) + (b[2]<<16) + (b[1]<<8) + b[0])
-
-@elidable
-def uint642bytes(v):
-    return [0xff & (v),
-            0xff & (v>>8),
-            0xff & (v>>16),
-            0xff & (v>>24),
-            0xff & (v>>32),
-            0xff & (v>>40),
-            0xff & (v>>48),
-            0xff & (v>>56)]
-
-if IS_RPYTHON:
-    @elidable
-    def bytes2int64(b):
-        return bytes2uint64(b)
-else:
-    def bytes2int64(b):
-        val = ((b[7]<<56) + (b[6]<<48) + (b[5]<<40) + (b[4]<<32) +
-                (b[3]<<24) + (b[2]<<16) + (b[1]<<8) + b[0])
-        if val & 0x8000000000000000:
-            return val - 0x10000000000000000
-        else:
-            return val
-
-#
-
 if IS_RPYTHON:
     @elidable
     def int2uint64(i):
@@ -675,41 +669,116 @@ def read_LEB(bytes, pos, maxbits=32, signed=False):
         result |= - (1 << shift)
     return (pos, result)
 
-@elidable
-def read_I32(bytes, pos):
-    assert pos >= 0
-    return bytes2uint32(bytes[pos:pos+4])
+# Little-endian loads and stores directly on a bytearray (module
+# bytes or linear memory) without building temporary lists. These
+# are not elidable since memory is mutable.
+if IS_RPYTHON:
+    def read_I8_u(bytes, pos):
+        return bytes[pos]
 
-@elidable
-def read_I64(bytes, pos):
-    assert pos >= 0
-    return bytes2uint64(bytes[pos:pos+8])
+    def read_I8_s(bytes, pos):
+        val = bytes[pos]
+        if val & 0x80:
+            return val - 0x100
+        return val
 
-@elidable
-def read_F32(bytes, pos):
-    assert pos >= 0
-    bits = bytes2int32(bytes[pos:pos+4])
-    return fround(unpack_f32(bits), 5)
+    def read_I16_u(bytes, pos):
+        return bytes[pos] | (bytes[pos+1]<<8)
 
-@elidable
-def read_F64(bytes, pos):
-    assert pos >= 0
-    bits = bytes2int64(bytes[pos:pos+8])
-    return unpack_f64(bits)
+    def read_I16_s(bytes, pos):
+        val = bytes[pos] | (bytes[pos+1]<<8)
+        if val & 0x8000:
+            return val - 0x10000
+        return val
+
+    def read_I32(bytes, pos):
+        assert pos >= 0
+        return (bytes[pos] | (bytes[pos+1]<<8) |
+                (bytes[pos+2]<<16) | (bytes[pos+3]<<24))
+
+    def read_I32_s(bytes, pos):
+        val = read_I32(bytes, pos)
+        if val & 0x80000000:
+            return val - 0x100000000
+        return val
+
+    def read_I64(bytes, pos):
+        assert pos >= 0
+        return read_I32(bytes, pos) | (read_I32(bytes, pos+4)<<32)
+
+    def read_F32(bytes, pos):
+        return fround(unpack_f32(read_I32_s(bytes, pos)), 5)
+
+    def read_F64(bytes, pos):
+        return unpack_f64(read_I64(bytes, pos))
+
+    def write_I8(bytes, pos, ival):
+        bytes[pos] = ival & 0xff
+
+    def write_I16(bytes, pos, ival):
+        bytes[pos]   = ival & 0xff
+        bytes[pos+1] = (ival>>8) & 0xff
 
-def write_I32(bytes, pos, ival):
-    bytes[pos:pos+4] = uint322bytes(ival)
+    def write_I32(bytes, pos, ival):
+        bytes[pos]   = ival & 0xff
+        bytes[pos+1] = (ival>>8) & 0xff
+        bytes[pos+2] = (ival>>16) & 0xff
+        bytes[pos+3] = (ival>>24) & 0xff
 
-def write_I64(bytes, pos, ival):
-    bytes[pos:pos+8] = uint642bytes(ival)
+    def write_I64(bytes, pos, ival):
+        write_I32(bytes, pos, ival)
+        write_I32(bytes, pos+4, ival>>32)
 
-def write_F32(bytes, pos, fval):
-    ival = intmask(pack_f32(fval))
-    bytes[pos:pos+4] = uint322bytes(ival)
+    def write_F32(bytes, pos, fval):
+        write_I32(bytes, pos, intmask(pack_f32(fval)))
 
-def write_F64(bytes, pos, fval):
-    ival = intmask(pack_f64(fval))
-    bytes[pos:pos+8] = uint642bytes(ival)
+    def write_F64(bytes, pos, fval):
+        write_I64(bytes, pos, intmask(pack_f64(fval)))
+else:
+    def read_I8_u(bytes, pos):
+        return struct.unpack_from('<B', bytes, pos)[0]
+
+    def read_I8_s(bytes, pos):
+        return struct.unpack_from('<b', bytes, pos)[0]
+
+    def read_I16_u(bytes, pos):
+        return struct.unpack_from('<H', bytes, pos)[0]
+
+    def read_I16_s(bytes, pos):
+        return struct.unpack_from('<h', bytes, pos)[0]
+
+    def read_I32(bytes, pos):
+        return struct.unpack_from('<I', bytes, pos)[0]
+
+    def read_I32_s(bytes, pos):
+        return struct.unpack_from('<i', bytes, pos)[0]
+
+    def read_I64(bytes, pos):
+        return struct.unpack_from('<Q', bytes, pos)[0]
+
+    def read_F32(bytes, pos):
+        return fround(struct.unpack_from('<f', bytes, pos)[0], 5)
+
+    def read_F64(bytes, pos):
+        return struct.unpack_from('<d', bytes, pos)[0]
+
+    def write_I8(bytes, pos, ival):
+        struct.pack_into('<B', bytes, pos, ival & 0xff)
+
+    def write_I16(bytes, pos, ival):
+        struct.pack_into('<H', bytes, pos, ival & 0xffff)
+
+    def write_I32(bytes, pos, ival):
+        struct.pack_into('<I', bytes, pos, ival & 0xffffffff)
+
+    def write_I64(bytes, pos, ival):
+        struct.pack_into('<Q', bytes, pos, ival & 0xffffffffffffffff)
+
+    def write_F32(bytes, pos, fval):
+        struct.pack_into('<f', bytes, pos, fval)
+
+    def write_F64(bytes, pos, fval):
+        struct.pack_into('<d', bytes, pos, fval)
 
 
 def value_repr(val):
@@ -754,22 +823,27 @@ def block_repr(block):
                 block.index, len(block.type.params),
                 len(block.locals), len(block.type.results))
 
-def stack_repr(sp, fp, stack):
+# Value stack slots are untyped (see interpret_mvp) so show both the
+# integer and float view of a slot
+def slot_repr(istack, fstack, i):
+    return "0x%x|%s" % (istack[i], fstack[i])
+
+def stack_repr(sp, fp, istack, fstack):
     res = []
     for i in range(sp+1):
         if i == fp:
             res.append("*")
-        res.append(value_repr(stack[i]))
+        res.append(slot_repr(istack, fstack, i))
     return "[" + " ".join(res) + "]"
 
-def callstack_repr(csp, bs):
+def callstack_repr(csp, fs):
     return "[" + " ".join(["%s(sp:%d/fp:%d/ra:0x%x)" % (
-        block_repr(bs[i][0]),bs[i][1],bs[i][2],bs[i][3])
+        block_repr(fs[i].func),fs[i].sp,fs[i].fp,fs[i].ra)
                            for i in range(csp+1)]) + "]"
 
-def dump_stacks(sp, stack, fp, csp, callstack):
+def dump_stacks(sp, istack, fstack, fp, csp, callstack):
     debug("      * stack:     %s" % (
-        stack_repr(sp, fp, stack)))
+        stack_repr(sp, fp, istack, fstack)))
     debug("      * callstack: %s" % (
         callstack_repr(csp, callstack)))
 
@@ -791,7 +865,7 @@ def skip_immediates(code, pos):
         pos, v = read_LEB(code, pos, 1)
         vals.append(v)
     elif 'varint32' == imtype:
-        pos, v = read_LEB(code, pos, 32)
+        pos, v = read_LEB(code, pos, 32, signed=True)
         vals.append(v)
     elif 'varuint32' == imtype:
         pos, v = read_LEB(code, pos, 32)
@@ -802,7 +876,7 @@ def skip_immediates(code, pos):
         pos, v = read_LEB(code, pos, 1)
         vals.append(v)
     elif 'varint64' == imtype:
-        pos, v = read_LEB(code, pos, 64)
+        pos, v = read_LEB(code, pos, 64, signed=True)
         vals.append(v)
     elif 'varuint64' == imtype:
         pos, v = read_LEB(code, pos, 64)
@@ -835,164 +909,461 @@ def skip_immediates(code, pos):
         raise Exception("unknown immediate type %s" % imtype)
     return pos, vals
 
-def find_blocks(code, start, end, block_map):
-    pos = start
-
-    # stack of blocks with current at top: (opcode, pos) tuples
-    opstack = []
-
-    #
-    # Build the map of blocks
-    #
+# Operand stack effect (pops, pushes) of operators whose effect does
+# not depend on their immediates or on the enclosing blocks
+@elidable
+def stack_effect(opcode):
+    if   opcode in (0x00, 0x01, 0x02, 0x03, 0x05, 0x0b, 0x0c, 0x0f,
+                    0x22):
+        return 0, 0
+    elif opcode in (0x04, 0x0d, 0x0e, 0x1a, 0x21, 0x24):
+        return 1, 0
+    elif opcode in (0x20, 0x23, 0x3f) or 0x41 <= opcode <= 0x44:
+        return 0, 1
+    elif 0x36 <= opcode <= 0x3e:  # stores
+        return 2, 0
+    elif 0x1b == opcode:  # select
+        return 3, 1
+    elif 0xc0 == opcode:  # get_local.get_local
+        return 0, 2
+    elif opcode in (0xc1, 0xc2, 0xc3):  # fused local reads
+        return 0, 1
+    elif (0x46 <= opcode <= 0x4f or 0x51 <= opcode <= 0x66 or
+          0x6a <= opcode <= 0x78 or 0x7c <= opcode <= 0x8a or
+          0x92 <= opcode <= 0x98 or 0xa0 <= opcode <= 0xa6):
+        return 2, 1
+    else:  # loads, grow_memory, eqz, unary numeric, conversions
+        return 1, 1
+
+# Build the control flow side table of a function:
+#   - block_map: {block/loop/if addr: Block, ...} where each Block
+#     records its label (br_addr), else position and the operand
+#     stack height (above the locals) on entry
+#   - branch_map: {br/br_if/br_table/else addr: [Block, ...], ...}
+#     with the target Block(s) of each branch. Branches out of the
+#     function target a Block of kind 0x00 labeled at the final end.
+# Heights are tracked statically; in unreachable code (after br,
+# br_table, return and unreachable) they never drop below the
+# enclosing block's entry height.
+def find_blocks(code, func, function, types):
+    block_map = {}
+    branch_map = {}
+
+    fblock = Block(0x00, func.type, func.start)
+    fblock.update(func.end, func.end)
+
+    # stack of blocks with current at top
+    opstack = [fblock]
+    height = 0
+
+    pos = func.start
     opcode = 0
-    while pos <= end:
+    while pos <= func.end:
         opcode = code[pos]
-        #debug("0x%x: %s, opstack: %s" % (
-        #    pos, OPERATOR_INFO[opcode][0],
-        #    ["%d,%s,0x%x" % (o,s.index,p) for o,s,p in opstack]))
+        cur_pos = pos
+        pos, vals = skip_immediates(code, pos)
+        block = opstack[-1]
+        pops, pushes = stack_effect(opcode)
         if   0x02 <= opcode <= 0x04:  # block, loop, if
-            block = Block(opcode, BLOCK_TYPE[code[pos+1]], pos)
+            height = max(block.height, height - pops)
+            block = Block(opcode, BLOCK_TYPE[vals[0]], cur_pos)
+            block.height = height
             opstack.append(block)
-            block_map[pos] = block
+            block_map[cur_pos] = block
+            continue
         elif 0x05 == opcode:  # mark else positions
-            assert opstack[-1].kind == 0x04, "else not matched with if"
-            opstack[-1].else_addr = pos+1
+            assert block.kind == 0x04, "else not matched with if"
+            block.else_addr = cur_pos+1
+            branch_map[cur_pos] = [block]
+            height = block.height
+            continue
         elif 0x0b == opcode:  # end
-            if pos == end: break
-            block = opstack.pop()
+            if cur_pos == func.end: break
+            opstack.pop()
             if block.kind == 0x03:  # loop: label after start
-                block.update(pos, block.start+2)
+                block.update(cur_pos, block.start+2)
             else:  # block/if: label at end
-                block.update(pos, pos)
-        pos, _ = skip_immediates(code, pos)
+                block.update(cur_pos, cur_pos)
+            height = block.height + len(block.type.results)
+            continue
+        elif opcode in (0x0c, 0x0d):  # br, br_if
+            branch_map[cur_pos] = [opstack[-1-vals[0]]]
+        elif 0x0e == opcode:  # br_table
+            branch_map[cur_pos] = [opstack[-1-depth]
+                                   for depth in vals[1:]]
+        elif 0x10 == opcode:  # call
+            t = function[vals[0]].type
+            pops, pushes = len(t.params), len(t.results)
+        elif 0x11 == opcode:  # call_indirect
+            t = types[vals[0]]
+            pops, pushes = 1 + len(t.params), len(t.results)
+
+        if opcode in (0x00, 0x0c, 0x0e, 0x0f):
+            # unreachable, br, br_table, return
+            height = block.height
+        else:
+            height = max(block.height, height - pops) + pushes
 
     assert opcode == 0xb, "function block did not end with 0xb"
-    assert len(opstack) == 0, "function ended in middle of block"
+    assert len(opstack) == 1, "function ended in middle of block"
 
-    #debug("block_map: %s" % block_map)
-    return block_map
+    return block_map, branch_map
 
-@unroll_safe
-def pop_block(stack, callstack, sp, fp, csp):
-    block, orig_sp, orig_fp, ra = callstack[csp]
-    csp -= 1
-    t = block.type
-
-    # Validate return value if there is one
-    if VALIDATE:
-        if len(t.results) > 1:
-            raise Exception("multiple return values unimplemented")
-        if len(t.results) > sp+1:
-            raise Exception("stack underflow")
-
-    if len(t.results) == 1:
-        # Restore main value stack, saving top return value
-        save = stack[sp]
-        sp -= 1
-        if save[0] != t.results[0]:
-            raise WAException("call signature mismatch: %s != %s" % (
-                VALUE_TYPE[t.results[0]], VALUE_TYPE[save[0]]))
-
-        # Restore value stack to original size prior to call/block
-        if orig_sp < sp:
-            sp = orig_sp
-
-        # Put back return value if we have one
-        sp += 1
-        stack[sp] = save
+# Branch arity: loop labels take no values, others take the results
+@elidable
+def br_arity(block):
+    if block.kind == 0x03:
+        return 0
+    return len(block.type.results)
+
+# Translate the body of func into a flat list of ints where each
+# opcode is followed by its already decoded immediates. Structured
+# control flow is resolved with the find_blocks side table into plain
+# jumps:
+#   - block, loop and the end of blocks emit nothing
+#   - if is: false target (else body or after end)
+#   - else is: target after end
+#   - br/br_if are: target, arity, value stack base (relative to fp)
+#   - br_table is: count, then target, arity, base for each of the
+#     count targets followed by the default
+#   - the final end and return both return from the function
+# Other immediates are decoded as:
+#   - reserved and memory flags immediates are dropped
+#   - f32/f64 constants are an index into func.consts
+def decode_function(bytes, func, function, types):
+    block_map, branch_map = find_blocks(bytes, func, function, types)
+    local_cnt = len(func.type.params) + len(func.locals)
+
+    code = []
+    consts = []
+    addr_map = {}  # {byte addr: decoded addr, ...}
+    fixups = []    # [(decoded addr, byte addr of target), ...]
+    pos = func.start
+    while pos <= func.end:
+        opcode = bytes[pos]
+        addr_map[pos] = len(code)
+        cur_pos = pos
+        pos, vals = skip_immediates(bytes, pos)
+        imtype = OPERATOR_INFO[opcode][1]
+        if opcode in (0x02, 0x03):  # block, loop
+            continue
+        elif 0x0b == opcode:  # end
+            if cur_pos == func.end:
+                code.append(opcode)
+            continue
+        code.append(opcode)
+        if   0x04 == opcode:  # if
+            block = block_map[cur_pos]
+            if block.else_addr:
+                fixups.append((len(code), block.else_addr))
+            else:
+                fixups.append((len(code), block.end))
+            code.append(0)
+        elif 0x05 == opcode:  # else
+            fixups.append((len(code), branch_map[cur_pos][0].end))
+            code.append(0)
+        elif opcode in (0x0c, 0x0d, 0x0e):  # br, br_if, br_table
+            targets = branch_map[cur_pos]
+            if 0x0e == opcode:
+                code.append(len(targets)-1)
+            for block in targets:
+                fixups.append((len(code), block.br_addr))
+                code.append(0)
+                code.append(br_arity(block))
+                code.append(local_cnt + block.height)
+        elif imtype in ('', 'varuint1'):
+            pass
+        elif imtype in ('uint32', 'uint64'):
+            code.append(len(consts))
+            consts.append(vals[0])
+        elif 'memory_immediate' == imtype:
+            code.append(vals[1])  # offset
+        elif 'varuint32+varuint1' == imtype:
+            code.append(vals[0])  # type index
+        else:
+            code.extend(vals)
+
+    for idx, addr in fixups:
+        code[idx] = addr_map[addr]
+
+    func.code = code
+    func.consts = consts
+    func.block_map = block_map
+    return func
+
+# Superinstructions emitted by optimize_function for frequent
+# sequences in the decoded stream (opcodes unused by the MVP) and the
+# number of decoded immediates they take:
+#   - 0xc0 get_local a; get_local b
+#   - 0xc1 get_local a; get_local b; i32.add
+#   - 0xc2 get_local a; i32.const c; i32.add
+#   - 0xc3 get_local a; i32.const c; i32.add; i32.load offset
+#   - 0xc4 i32.const c; i32.add
+#   - 0xc5 i32.eqz; br_if target, arity, base
+SUPER_INFO = {
+        0xc0 : ['get_local.get_local',                   2],
+        0xc1 : ['get_local.get_local.i32.add',           2],
+        0xc2 : ['get_local.i32.const.i32.add',           2],
+        0xc3 : ['get_local.i32.const.i32.add.i32.load',  3],
+        0xc4 : ['i32.const.i32.add',                     1],
+        0xc5 : ['i32.eqz.br_if',                         3],
+        }
+
+def opcode_name(opcode):
+    if opcode in SUPER_INFO:
+        return SUPER_INFO[opcode][0]
+    return OPERATOR_INFO[opcode][0]
+
+# Decoded counterpart of skip_immediates
+def decoded_immediates(code, pc):
+    opcode = code[pc]
+    pc += 1
+    if   0x0e == opcode:  # br_table
+        cnt = 1 + 3 * (code[pc] + 1)
+    elif opcode in (0x0c, 0x0d, 0xc5):  # br, br_if, i32.eqz.br_if
+        cnt = 3
+    elif opcode in (0x04, 0x05):  # if, else
+        cnt = 1
+    elif opcode in SUPER_INFO:
+        cnt = SUPER_INFO[opcode][1]
+    elif OPERATOR_INFO[opcode][1] in ('', 'varuint1'):
+        cnt = 0
     else:
-        # Restore value stack to original size prior to call/block
-        if orig_sp < sp:
-            sp = orig_sp
+        cnt = 1
+    return pc+cnt, code[pc:pc+cnt]
+
+# Positions of the immediates of a decoded instruction (relative to
+# its opcode) that hold code addresses
+def decoded_targets(code, pc):
+    opcode = code[pc]
+    if opcode in (0x04, 0x05, 0x0c, 0x0d, 0xc5):
+        return [1]
+    elif 0x0e == opcode:  # br_table
+        return [2 + 3*i for i in range(code[pc+1] + 1)]
+    return []
+
+# Value of i32 constant folded binary operators (they can not trap)
+def fold_i32(opcode, a, b):
+    if   0x6a == opcode:  # i32.add
+        return int2int32(a + b)
+    elif 0x6b == opcode:  # i32.sub
+        return int2int32(a - b)
+    elif 0x6c == opcode:  # i32.mul
+        return int2int32(a * b)
+    elif 0x71 == opcode:  # i32.and
+        return a & b
+    elif 0x72 == opcode:  # i32.or
+        return a | b
+    else:  # i32.xor
+        return a ^ b
+
+def replace_tail(insns, cnt, insn):
+    for i in range(cnt):
+        insns.pop()
+    insns.append(insn)
+
+# Replace the tail of insns (the instructions emitted so far) if it
+# ends with a sequence that can be folded or fused. Returns the name
+# of the rewrite for the report or "" if there was none. Only the
+# first instruction of a sequence may be a jump target.
+def peephole(insns, targets):
+    n = len(insns)
+    pc, opcode, imms = insns[-1]
+    if n >= 2 and pc not in targets:
+        ppc, prev, pimms = insns[-2]
+        if 0x41 == prev and 0x45 == opcode:  # i32.const; i32.eqz
+            replace_tail(insns, 2, (ppc, 0x41, [int(pimms[0] == 0)]))
+            return "fold i32.eqz"
+        if (n >= 3 and 0x41 == prev and ppc not in targets and
+                opcode in (0x6a, 0x6b, 0x6c, 0x71, 0x72, 0x73) and
+                insns[-3][1] == 0x41):
+            qpc, _, qimms = insns[-3]
+            replace_tail(insns, 3, (qpc, 0x41,
+                    [fold_i32(opcode, qimms[0], pimms[0])]))
+            return "fold %s" % OPERATOR_INFO[opcode][0]
+        if 0x20 == prev and 0x20 == opcode:
+            replace_tail(insns, 2, (ppc, 0xc0, pimms + imms))
+        elif 0xc0 == prev and 0x6a == opcode:
+            replace_tail(insns, 2, (ppc, 0xc1, pimms))
+        elif (n >= 3 and 0x41 == prev and 0x6a == opcode and
+                ppc not in targets and insns[-3][1] == 0x20):
+            qpc, _, qimms = insns[-3]
+            replace_tail(insns, 3, (qpc, 0xc2, qimms + pimms))
+        elif (n >= 3 and 0x41 == prev and 0x6a == opcode and
+                ppc not in targets and insns[-3][1] == 0xc0):
+            # get_local a; get_local b; i32.const c; i32.add
+            qpc, _, qimms = insns[-3]
+            replace_tail(insns, 3, (qpc, 0x20, [qimms[0]]))
+            insns.append((ppc, 0xc2, [qimms[1], pimms[0]]))
+        elif 0xc2 == prev and 0x28 == opcode:
+            replace_tail(insns, 2, (ppc, 0xc3, pimms + imms))
+        elif 0x41 == prev and 0x6a == opcode:
+            replace_tail(insns, 2, (ppc, 0xc4, pimms))
+        elif 0x45 == prev and 0x0d == opcode:
+            replace_tail(insns, 2, (ppc, 0xc5, imms))
+        else:
+            return ""
+        return SUPER_INFO[insns[-1][1]][0]
+    return ""
+
+# Peephole pass over the decoded code of func (see decode_function).
+# It drops nops and code made dead by br, br_table, else, return and
+# unreachable, folds i32 constant expressions and fuses the sequences
+# in SUPER_INFO. Branch targets are remapped to the rewritten code.
+# Counts of the rewrites are added to stats ({name: count}).
+def optimize_function(func, stats):
+    code = func.code
+    targets = {}
+    pc = 0
+    while pc < len(code):
+        for i in decoded_targets(code, pc):
+            targets[code[pc+i]] = True
+        pc, _ = decoded_immediates(code, pc)
 
-    return block, ra, sp, orig_fp, csp
+    insns = []  # [(original pc, opcode, immediates), ...]
+    live = True
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        next_pc, imms = decoded_immediates(code, pc)
+        if pc in targets:
+            live = True
+        if not live and next_pc < len(code):
+            # keep the final end
+            stats["dead code"] = stats.get("dead code", 0) + 1
+        elif 0x01 == opcode and pc not in targets:
+            stats["nop"] = stats.get("nop", 0) + 1
+        else:
+            insns.append((pc, opcode, imms))
+            while True:
+                name = peephole(insns, targets)
+                if not name:
+                    break
+                stats[name] = stats.get(name, 0) + 1
+        if opcode in (0x00, 0x05, 0x0c, 0x0e, 0x0f):
+            live = False
+        pc = next_pc
+
+    addr_map = {}  # {original pc: new pc, ...}
+    new_code = []
+    for pc, opcode, imms in insns:
+        addr_map[pc] = len(new_code)
+        new_code.append(opcode)
+        new_code.extend(imms)
+    for npc in addr_map.values():
+        for i in decoded_targets(new_code, npc):
+            new_code[npc+i] = addr_map[new_code[npc+i]]
 
+    if DEBUG:
+        debug("  optimized function 0x%x from %d to %d code entries" % (
+            func.index, len(code), len(new_code)))
+    func.code = new_code
+    return func
+
+# Pop the value stack back to the size before the frame's call,
+# keeping the return value (if any). Returns the new sp; the caller
+# restores fp, pc and csp from the frame.
+def do_return(istack, fstack, frame, sp):
+    orig_sp = frame.sp
+
+    if len(frame.func.type.results) == 1:
+        # Move the return value down to where the arguments started
+        orig_sp += 1
+        istack[orig_sp] = istack[sp]
+        fstack[orig_sp] = fstack[sp]
+
+    # Restore value stack to original size prior to call (plus the
+    # return value)
+    return orig_sp
+
+# Functions of modules loaded with lazy=True are only validated and
+# decoded on their first call
+def ensure_compiled(func):
+    if not func.decoded:
+        compile_function(func)
+
+@dont_look_inside
+def compile_function(func):
+    func.owner.compile_function(func)
+
+# Fill in the next frame (callstack[csp+1]) with the stack size,
+# frame pointer, return address and calling function and push zeroed
+# locals. Returns the new sp; the caller bumps csp, sets pc to 0 and
+# fp to the new frame's sp+1 (the first parameter).
 @unroll_safe
-def do_call(stack, callstack, sp, fp, csp, func, pc):
-
-    # Push block, stack size and return address onto callstack
+def do_call(istack, fstack, callstack, sp, fp, csp, func, pc, caller):
     t = func.type
-    if VALIDATE: assert csp < CALLSTACK_SIZE, "call stack exhausted"
-    csp += 1
-    callstack[csp] = (func, sp-len(t.params), fp, pc)
-
-    # Update the pos/instruction counter to the function
-    pc = func.start
+    if csp+1 >= CALLSTACK_SIZE:
+        raise WAException("call stack exhausted")
+    if csp+1 >= len(callstack):
+        grow_callstack(callstack, csp+2)
+    ensure_compiled(func)
+    # Room for the locals and the operand stack, which never holds
+    # more values than the function has code entries
+    if sp + len(func.locals) + len(func.code) >= len(istack):
+        grow_stacks(istack, fstack,
+                sp + len(func.locals) + len(func.code) + 1)
+    if not IS_RPYTHON:
+        # Only the tiered engine reads it; keep it out of JIT traces
+        func.hotness += 1
+    frame = callstack[csp+1]
+    frame.func = func
+    frame.sp = sp - len(t.params)
+    frame.fp = fp
+    frame.ra = pc
+    frame.caller = caller
 
     if TRACE:
         info("  Calling function 0x%x, start: 0x%x, end: 0x%x, %d locals, %d params, %d results" % (
             func.index, func.start, func.end,
             len(func.locals), len(t.params), len(t.results)))
 
-    # set frame pointer to include parameters
-    fp = sp - len(t.params) + 1
-    # validate parameters
-    if VALIDATE:
-        for tidx in range(len(t.params)):
-            val = stack[fp+tidx]
-            ptype = t.params[tidx]
-            if ptype != val[0]:
-                raise WAException("call signature mismatch: %s != %s" % (
-                    VALUE_TYPE[ptype], VALUE_TYPE[val[0]]))
-
-    # push locals (dropping extras)
+    # push zeroed locals
     for lidx in range(len(func.locals)):
-        ltype = func.locals[lidx]
         sp += 1
-        stack[sp] = (ltype, 0, 0.0)
+        istack[sp] = 0
+        fstack[sp] = 0.0
+
+    return sp
 
-    return pc, sp, fp, csp
 
+# The value stacks and call stack of an Instance start small and are
+# grown in place (at least doubling) when a call needs more, so
+# creating an Instance does not allocate them at their full depth.
+@dont_look_inside
+def grow_stacks(istack, fstack, size):
+    size = max(size, 2 * len(istack))
+    istack.extend([0] * (size - len(istack)))
+    fstack.extend([0.0] * (size - len(fstack)))
 
-@unroll_safe
-def do_call_import(stack, sp, memory, host_import_func, func):
-    t = func.type
+@dont_look_inside
+def grow_callstack(callstack, size):
+    size = min(max(size, 2 * len(callstack)), CALLSTACK_SIZE)
+    for i in range(size - len(callstack)):
+        callstack.append(Frame())
 
-    # make sure args match type signature
-    args = []
-    for idx in range(len(t.params)-1, -1, -1):
-        arg = stack[sp]
-        sp -= 1
-        args.append(arg)
-        if VALIDATE:
-            ptype = t.params[idx]
-            if ptype != arg[0]:
-                raise WAException("call signature mismatch: %s != %s" % (
-                    VALUE_TYPE[ptype], VALUE_TYPE[arg[0]]))
-
-    # Workaround rpython failure to identify type
-    results = [(0, 0, 0.0)]
-    results.pop()
-    results.extend(host_import_func(memory,
-            func.module, func.field, args))
-
-    # make sure returns match type signature
-    for idx, rtype in enumerate(t.results):
-        if idx < len(results):
-            res = results[idx]
-            if rtype != res[0]:
-                raise Exception("return signature mismatch")
-            sp += 1
-            stack[sp] = res
-        else:
-            raise Exception("return signature mismatch")
-    return sp
+# Call the host function bound to the import func (see
+# ImportRegistry.bind). Returns the new sp.
+def do_call_import(istack, fstack, sp, memory, imports, func):
+    host = get_host(imports, func.index)
+    return host.fn(memory, istack, fstack, sp, func)
 
 
 # Main loop/JIT
 
-def get_location_str(opcode, pc, code, function, table, block_map):
-    return "0x%x %s(0x%x)" % (
-            pc, OPERATOR_INFO[opcode][0], opcode)
-
-@elidable
-def get_block(block_map, pc):
-    return block_map[pc]
+def get_location_str(pc, code, consts, func):
+    opcode = code[pc]
+    return "fn%d 0x%x %s(0x%x)" % (
+            func.index, pc, opcode_name(opcode), opcode)
 
 @elidable
 def get_function(function, fidx):
     return function[fidx]
 
+@elidable
+def get_host(imports, fidx):
+    return imports[fidx]
+
 @elidable
 def bound_violation(opcode, addr, pages):
     return addr+LOAD_SIZE[opcode] > pages*(2**16)
@@ -1004,45 +1375,63 @@ def get_from_table(table, tidx, table_index):
         raise WAException("undefined element")
     return tbl[table_index]
 
+@elidable
+def same_signature(t1, t2):
+    if len(t1.params) != len(t2.params): return False
+    if len(t1.results) != len(t2.results): return False
+    for i in range(len(t1.params)):
+        if t1.params[i] != t2.params[i]: return False
+    for i in range(len(t1.results)):
+        if t1.results[i] != t2.results[i]: return False
+    return True
+
 if IS_RPYTHON:
     # greens/reds must be sorted: ints, refs, floats
     jitdriver = JitDriver(
-            greens=['opcode', 'pc',
-                    'code', 'function', 'table', 'block_map'],
+            greens=['pc', 'code', 'consts', 'func'],
             reds=['sp', 'fp', 'csp',
-                  'module', 'memory', 'stack', 'callstack'],
+                  'module', 'memory', 'istack', 'fstack',
+                  'callstack'],
             get_printable_location=get_location_str)
 
+# The value stack is unboxed: slot i holds its value in istack[i] for
+# i32/i64 and in fstack[i] for f32/f64. Operators know their operand
+# types statically so they read and write only the array they need.
+# Type-generic moves (locals, select, branch and return values) copy
+# both arrays.
 def interpret_mvp(module,
         # Greens
-        pc, code, function, table, block_map,
+        pc, func,
         # Reds
-        memory, sp, stack, fp, csp, callstack):
+        memory, sp, istack, fstack, fp, csp, callstack):
+
+    # Pre-decoded code of the current function
+    code = func.code
+    consts = func.consts
 
     while pc < len(code):
         opcode = code[pc]
         if IS_RPYTHON:
             jitdriver.jit_merge_point(
                     # Greens
-                    opcode=opcode,
                     pc=pc,
                     code=code,
-                    function=function,
-                    table=table,
-                    block_map=block_map,
+                    consts=consts,
+                    func=func,
                     # Reds
                     sp=sp, fp=fp, csp=csp,
                     module=module, memory=memory,
-                    stack=stack, callstack=callstack)
+                    istack=istack, fstack=fstack,
+                    callstack=callstack)
 
         cur_pc = pc
         pc += 1
 
         if TRACE:
-            dump_stacks(sp, stack, fp, csp, callstack)
-            _, immediates = skip_immediates(code, cur_pc)
+            dump_stacks(sp, istack, fstack, fp, csp, callstack)
+            _, immediates = decoded_immediates(code, cur_pc)
             info("    0x%x <0x%x/%s%s%s>" % (
-                cur_pc, opcode, OPERATOR_INFO[opcode][0],
+                cur_pc, opcode, opcode_name(opcode),
                 " " if immediates else "",
                 ",".join(["0x%x" % i for i in immediates])))
 
@@ -1053,336 +1442,434 @@ def interpret_mvp(module,
             raise WAException("unreachable")
         elif 0x01 == opcode:  # nop
             pass
-        elif 0x02 == opcode:  # block
-            pc, ignore = read_LEB(code, pc, 32) # ignore block_type
-            block = get_block(block_map, cur_pc)
-            csp += 1
-            callstack[csp] = (block, sp, fp, 0)
-            if TRACE: debug("      - block: %s" % block_repr(block))
-        elif 0x03 == opcode:  # loop
-            pc, ignore = read_LEB(code, pc, 32) # ignore block_type
-            block = get_block(block_map, cur_pc)
-            csp += 1
-            callstack[csp] = (block, sp, fp, 0)
-            if TRACE: debug("      - block: %s" % block_repr(block))
         elif 0x04 == opcode:  # if
-            pc, ignore = read_LEB(code, pc, 32) # ignore block_type
-            block = get_block(block_map, cur_pc)
-            csp += 1
-            callstack[csp] = (block, sp, fp, 0)
-            cond = stack[sp]
+            cond = istack[sp]  # I32
             sp -= 1
-            if not cond[1]:  # if false (I32)
+            if cond:
+                pc += 1
+            else:
                 # branch to else block or after end of if
-                if block.else_addr == 0:
-                    # no else block so pop if block and skip end
-                    csp -= 1
-                    pc = block.br_addr+1
-                else:
-                    pc = block.else_addr
+                pc = code[pc]
             if TRACE:
-                debug("      - cond: %s jump to 0x%x, block: %s" % (
-                    value_repr(cond), pc, block_repr(block)))
+                debug("      - cond: 0x%x jump to 0x%x" % (cond, pc))
         elif 0x05 == opcode:  # else
-            block = callstack[csp][0]
-            pc = block.br_addr
-            if TRACE:
-                debug("      - of %s jump to 0x%x" % (
-                    block_repr(block), pc))
-        elif 0x0b == opcode:  # end
-            block, ra, sp, fp, csp = pop_block(stack, callstack, sp,
-                    fp, csp)
-            if TRACE: debug("      - of %s" % block_repr(block))
-            if isinstance(block, Function):
-                # Return to return address
-                pc = ra
-                if csp == -1:
-                    # Return to top-level, ignoring return_addr
-                    return pc, sp, fp, csp
-                else:
-                    if TRACE:
-                        info("  Returning from function 0x%x to 0x%x" % (
-                            block.index, pc))
-            elif isinstance(block, Block) and block.kind == 0x00:
-                # this is an init_expr
-                return pc, sp, fp, csp
+            # end of if block, jump after end
+            pc = code[pc]
+            if TRACE: debug("      - to 0x%x" % pc)
+        elif 0x0b == opcode or 0x0f == opcode:  # end (of function), return
+            frame = callstack[csp]
+            sp = do_return(istack, fstack, frame, sp)
+            fp = frame.fp
+            csp -= 1
+            if TRACE: debug("      - of %s" % block_repr(frame.func))
+            # Return to return address
+            pc = frame.ra
+            caller = frame.caller
+            if csp == -1 or caller is None:
+                # Return to top-level, ignoring return_addr
+                return sp
             else:
-                pass # end of block/loop/if, keep going
+                if TRACE:
+                    info("  Returning from function 0x%x to 0x%x" % (
+                        frame.func.index, pc))
+                func = caller
+                code = func.code
+                consts = func.consts
         elif 0x0c == opcode:  # br
-            pc, br_depth = read_LEB(code, pc, 32)
-            csp -= br_depth
-            block, _, _, _ = callstack[csp]
-            pc = block.br_addr # set to end for pop_block
+            # Keep the branch results and drop the rest of the values
+            # pushed since the target block was entered
+            base = fp + code[pc+2]
+            if code[pc+1]:
+                istack[base] = istack[sp]
+                fstack[base] = fstack[sp]
+                sp = base
+            else:
+                sp = base - 1
+            target = code[pc]
+            if not IS_RPYTHON and module.tiering and target < pc:
+                # Loop back-edge, maybe continue in the closure tier
+                tsp = tier_loop(module, func, target, sp, fp, csp)
+                if tsp != NOT_TIERED:
+                    # The loop ran to the end of the function
+                    sp = tsp
+                    target = len(code) - 1
+            pc = target
+            if IS_RPYTHON and target < cur_pc:
+                jitdriver.can_enter_jit(pc=pc, code=code,
+                        consts=consts, func=func,
+                        sp=sp, fp=fp, csp=csp,
+                        module=module, memory=memory,
+                        istack=istack, fstack=fstack,
+                        callstack=callstack)
             if TRACE: debug("      - to: 0x%x" % pc)
         elif 0x0d == opcode:  # br_if
-            pc, br_depth = read_LEB(code, pc, 32)
-            cond = stack[sp]
+            cond = istack[sp]  # I32
             sp -= 1
-            if cond[1]:  # I32
-                csp -= br_depth
-                block, _, _, _ = callstack[csp]
-                pc = block.br_addr # set to end for pop_block
+            if cond:
+                base = fp + code[pc+2]
+                if code[pc+1]:
+                    istack[base] = istack[sp]
+                    fstack[base] = fstack[sp]
+                    sp = base
+                else:
+                    sp = base - 1
+                target = code[pc]
+                if not IS_RPYTHON and module.tiering and target < pc:
+                    # Loop back-edge, maybe continue in the closure tier
+                    tsp = tier_loop(module, func, target, sp, fp, csp)
+                    if tsp != NOT_TIERED:
+                        # The loop ran to the end of the function
+                        sp = tsp
+                        target = len(code) - 1
+                pc = target
+                if IS_RPYTHON and target < cur_pc:
+                    jitdriver.can_enter_jit(pc=pc, code=code,
+                            consts=consts, func=func,
+                            sp=sp, fp=fp, csp=csp,
+                            module=module, memory=memory,
+                            istack=istack, fstack=fstack,
+                            callstack=callstack)
+            else:
+                pc += 3
             if TRACE:
-                debug("      - cond: %s, to: 0x%x" % (cond[1], pc))
+                debug("      - cond: %s, to: 0x%x" % (cond, pc))
         elif 0x0e == opcode:  # br_table
-            pc, target_count = read_LEB(code, pc, 32)
-            depths = []
-            for c in range(target_count):
-                pc, depth = read_LEB(code, pc, 32)
-                depths.append(depth)
-            pc, br_depth = read_LEB(code, pc, 32) # default
-            expr = stack[sp]
+            target_count = code[pc]
+            didx = istack[sp]  # I32
             sp -= 1
-            if VALIDATE: assert expr[0] == I32
-            didx = expr[1]  # I32
-            if didx >= 0 and didx < len(depths):
-                br_depth = depths[didx]
-            csp -= br_depth
-            block, _, _, _ = callstack[csp]
-            pc = block.br_addr # set to end for pop_block
+            if didx < 0 or didx >= target_count:
+                didx = target_count  # default
+            tpc = pc + 1 + 3*didx
+            base = fp + code[tpc+2]
+            if code[tpc+1]:
+                istack[base] = istack[sp]
+                fstack[base] = fstack[sp]
+                sp = base
+            else:
+                sp = base - 1
+            target = code[tpc]
+            if not IS_RPYTHON and module.tiering and target < pc:
+                # Loop back-edge, maybe continue in the closure tier
+                tsp = tier_loop(module, func, target, sp, fp, csp)
+                if tsp != NOT_TIERED:
+                    # The loop ran to the end of the function
+                    sp = tsp
+                    target = len(code) - 1
+            pc = target
+            if IS_RPYTHON and target < cur_pc:
+                jitdriver.can_enter_jit(pc=pc, code=code,
+                        consts=consts, func=func,
+                        sp=sp, fp=fp, csp=csp,
+                        module=module, memory=memory,
+                        istack=istack, fstack=fstack,
+                        callstack=callstack)
             if TRACE:
-                debug("      - depths: %s, didx: %d, to: 0x%x" % (
-                    depths, didx, pc))
-        elif 0x0f == opcode:  # return
-            # Pop blocks until reach Function signature
-            while csp >= 0:
-                if isinstance(callstack[csp][0], Function): break
-                # We don't use pop_block because the end opcode
-                # handler will do this for us and catch the return
-                # value properly.
-                block = callstack[csp]
-                csp -= 1
-            if VALIDATE: assert csp >= 0
-            block = callstack[csp][0]
-            if VALIDATE: assert isinstance(block, Function)
-            # Set instruction pointer to end of function
-            # The actual pop_block and return is handled by handling
-            # the end opcode
-            pc = block.end
-            if TRACE: debug("      - to 0x%x" % pc)
+                debug("      - didx: %d, to: 0x%x" % (didx, pc))
 
         #
         # Call operators
         #
         elif 0x10 == opcode:  # call
-            pc, fidx = read_LEB(code, pc, 32)
-            func = get_function(function, fidx)
+            fidx = code[pc]
+            pc += 1
+            callee = get_function(module.function, fidx)
 
-            if isinstance(func, FunctionImport):
-                t = func.type
+            if isinstance(callee, FunctionImport):
+                t = callee.type
                 if TRACE:
                     debug("      - calling import %s.%s(%s)" % (
-                        func.module, func.field,
+                        callee.module, callee.field,
                         ",".join([VALUE_TYPE[a] for a in t.params])))
-                sp = do_call_import(stack, sp, memory,
-                        module.host_import_func, func)
-            elif isinstance(func, Function):
-                pc, sp, fp, csp = do_call(stack, callstack, sp, fp,
-                        csp, func, pc)
+                sp = do_call_import(istack, fstack, sp, memory,
+                        module.imports, callee)
+            elif isinstance(callee, Function):
+                if not IS_RPYTHON and module.py_funcs is not None:
+                    # Transpiled (python engine) or promoted (tiered)
+                    tsp = tier_call(module, callee, sp, fp, csp)
+                    if tsp != NOT_TIERED:
+                        sp = tsp
+                        continue
+                sp = do_call(istack, fstack, callstack,
+                        sp, fp, csp, callee, pc, func)
+                csp += 1
+                fp = callstack[csp].sp + 1
+                pc = 0
+                func = callee
+                code = func.code
+                consts = func.consts
                 if TRACE: debug("      - calling function fidx: %d"
                                 " at: 0x%x" % (fidx, pc))
         elif 0x11 == opcode:  # call_indirect
-            # TODO: what do we do with tidx?
-            pc, tidx = read_LEB(code, pc, 32)
-            pc, reserved = read_LEB(code, pc, 1)
-            type_index_val = stack[sp]
+            tidx = code[pc]
+            pc += 1
+            table_index = istack[sp]  # I32
             sp -= 1
-            if VALIDATE: assert type_index_val[0] == I32
-            table_index = int(type_index_val[1])  # I32
             promote(table_index)
-            fidx = get_from_table(table, ANYFUNC, table_index)
+            fidx = get_from_table(module.table, ANYFUNC, table_index)
             promote(fidx)
-            pc, sp, fp, csp = do_call(stack, callstack, sp, fp, csp,
-                    get_function(function, fidx), pc)
+            callee = get_function(module.function, fidx)
+            if not same_signature(callee.type, module.type[tidx]):
+                raise WAException("indirect call signature mismatch")
             if TRACE:
                 debug("      - table idx: 0x%x, tidx: 0x%x,"
-                      " calling function fidx: 0x%x at 0x%x" % (
-                          table_index, tidx, fidx, pc))
+                      " calling function fidx: 0x%x" % (
+                          table_index, tidx, fidx))
+            if isinstance(callee, FunctionImport):
+                sp = do_call_import(istack, fstack, sp, memory,
+                        module.imports, callee)
+            elif isinstance(callee, Function):
+                if not IS_RPYTHON and module.py_funcs is not None:
+                    # Transpiled (python engine) or promoted (tiered)
+                    tsp = tier_call(module, callee, sp, fp, csp)
+                    if tsp != NOT_TIERED:
+                        sp = tsp
+                        continue
+                sp = do_call(istack, fstack, callstack,
+                        sp, fp, csp, callee, pc, func)
+                csp += 1
+                fp = callstack[csp].sp + 1
+                pc = 0
+                func = callee
+                code = func.code
+                consts = func.consts
 
         #
         # Parametric operators
         #
         elif 0x1a == opcode:  # drop
-            if TRACE: debug("      - dropping: %s" % value_repr(stack[sp]))
+            if TRACE:
+                debug("      - dropping: %s" % slot_repr(istack, fstack, sp))
             sp -= 1
         elif 0x1b == opcode:  # select
-            cond, a, b = stack[sp], stack[sp-1], stack[sp-2]
+            cond = istack[sp]  # I32
             sp -= 2
-            if cond[1]:  # I32
-                stack[sp] = b
-            else:
-                stack[sp] = a
+            if not cond:
+                istack[sp] = istack[sp+1]
+                fstack[sp] = fstack[sp+1]
             if TRACE:
                 debug("      - cond: 0x%x, selected: %s" % (
-                    cond[1], value_repr(stack[sp])))
+                    cond, slot_repr(istack, fstack, sp)))
 
         #
         # Variable access
         #
         elif 0x20 == opcode:  # get_local
-            pc, arg = read_LEB(code, pc, 32)
+            arg = code[pc]
+            pc += 1
             sp += 1
-            stack[sp] = stack[fp+arg]
-            if TRACE: debug("      - got %s" % value_repr(stack[sp]))
+            istack[sp] = istack[fp+arg]
+            fstack[sp] = fstack[fp+arg]
+            if TRACE:
+                debug("      - got %s" % slot_repr(istack, fstack, sp))
         elif 0x21 == opcode:  # set_local
-            pc, arg = read_LEB(code, pc, 32)
-            val = stack[sp]
+            arg = code[pc]
+            pc += 1
+            istack[fp+arg] = istack[sp]
+            fstack[fp+arg] = fstack[sp]
+            if TRACE:
+                debug("      - to %s" % slot_repr(istack, fstack, sp))
             sp -= 1
-            stack[fp+arg] = val
-            if TRACE: debug("      - to %s" % value_repr(val))
         elif 0x22 == opcode:  # tee_local
-            pc, arg = read_LEB(code, pc, 32)
-            val = stack[sp] # like set_local but do not pop
-            stack[fp+arg] = val
-            if TRACE: debug("      - to %s" % value_repr(val))
+            arg = code[pc]
+            pc += 1
+            # like set_local but do not pop
+            istack[fp+arg] = istack[sp]
+            fstack[fp+arg] = fstack[sp]
+            if TRACE:
+                debug("      - to %s" % slot_repr(istack, fstack, sp))
         elif 0x23 == opcode:  # get_global
-            pc, gidx = read_LEB(code, pc, 32)
+            gidx = code[pc]
+            pc += 1
+            val = module.global_list[gidx]
             sp += 1
-            stack[sp] = module.global_list[gidx]
-            if TRACE: debug("      - got %s" % value_repr(stack[sp]))
+            istack[sp] = val[1]
+            fstack[sp] = val[2]
+            if TRACE: debug("      - got %s" % value_repr(val))
         elif 0x24 == opcode:  # set_global
-            pc, gidx = read_LEB(code, pc, 32)
-            val = stack[sp]
+            gidx = code[pc]
+            pc += 1
+            gtype = module.global_list[gidx][0]
+            val = (gtype, istack[sp], fstack[sp])
             sp -= 1
             module.global_list[gidx] = val
             if TRACE: debug("      - to %s" % value_repr(val))
 
+        #
+        # Superinstructions (see optimize_function)
+        #
+        elif 0xc0 == opcode:  # get_local.get_local
+            arg, arg2 = code[pc], code[pc+1]
+            pc += 2
+            istack[sp+1] = istack[fp+arg]
+            fstack[sp+1] = fstack[fp+arg]
+            istack[sp+2] = istack[fp+arg2]
+            fstack[sp+2] = fstack[fp+arg2]
+            sp += 2
+        elif 0xc1 == opcode:  # get_local.get_local.i32.add
+            arg, arg2 = code[pc], code[pc+1]
+            pc += 2
+            sp += 1
+            istack[sp] = int2int32(istack[fp+arg] + istack[fp+arg2])
+        elif 0xc2 == opcode:  # get_local.i32.const.i32.add
+            arg = code[pc]
+            sp += 1
+            istack[sp] = int2int32(istack[fp+arg] + code[pc+1])
+            pc += 2
+        elif 0xc3 == opcode:  # get_local.i32.const.i32.add.i32.load
+            arg = code[pc]
+            addr = int2int32(istack[fp+arg] + code[pc+1]) + code[pc+2]
+            pc += 3
+            assert addr >= 0
+            if bound_violation(0x28, addr, memory.pages):
+                raise WAException("out of bounds memory access")
+            sp += 1
+            istack[sp] = read_I32(memory.bytes, addr)
+        elif 0xc4 == opcode:  # i32.const.i32.add
+            istack[sp] = int2int32(istack[sp] + code[pc])
+            pc += 1
+        elif 0xc5 == opcode:  # i32.eqz.br_if
+            cond = istack[sp]  # I32
+            sp -= 1
+            if not cond:
+                base = fp + code[pc+2]
+                if code[pc+1]:
+                    istack[base] = istack[sp]
+                    fstack[base] = fstack[sp]
+                    sp = base
+                else:
+                    sp = base - 1
+                target = code[pc]
+                if not IS_RPYTHON and module.tiering and target < pc:
+                    # Loop back-edge, maybe continue in the closure tier
+                    tsp = tier_loop(module, func, target, sp, fp, csp)
+                    if tsp != NOT_TIERED:
+                        # The loop ran to the end of the function
+                        sp = tsp
+                        target = len(code) - 1
+                pc = target
+                if IS_RPYTHON and target < cur_pc:
+                    jitdriver.can_enter_jit(pc=pc, code=code,
+                            consts=consts, func=func,
+                            sp=sp, fp=fp, csp=csp,
+                            module=module, memory=memory,
+                            istack=istack, fstack=fstack,
+                            callstack=callstack)
+            else:
+                pc += 3
+            if TRACE:
+                debug("      - cond: %s, to: 0x%x" % (cond, pc))
+
         #
         # Memory-related operators
         #
 
         # Memory load operators
         elif 0x28 <= opcode <= 0x35:
-            pc, flags = read_LEB(code, pc, 32)
-            pc, offset = read_LEB(code, pc, 32)
-            addr_val = stack[sp]
-            sp -= 1
-            if flags != 2:
-                if TRACE:
-                    info("      - unaligned load - flags: 0x%x,"
-                         " offset: 0x%x, addr: 0x%x" % (
-                             flags, offset, addr_val[1]))
-            addr = addr_val[1] + offset
+            offset = code[pc]
+            pc += 1
+            addr = istack[sp] + offset  # I32
             assert addr >= 0
             if bound_violation(opcode, addr, memory.pages):
                 raise WAException("out of bounds memory access")
+            bytes = memory.bytes
             if   0x28 == opcode:  # i32.load
-                res = (I32, bytes2uint32(memory.bytes[addr:addr+4]), 0.0)
+                istack[sp] = read_I32(bytes, addr)
             elif 0x29 == opcode:  # i64.load
-                res = (I64, bytes2uint64(memory.bytes[addr:addr+8]), 0.0)
+                istack[sp] = read_I64(bytes, addr)
             elif 0x2a == opcode:  # f32.load
-                res = (F32, 0, read_F32(memory.bytes, addr))
+                fstack[sp] = read_F32(bytes, addr)
             elif 0x2b == opcode:  # f64.load
-                res = (F64, 0, read_F64(memory.bytes, addr))
+                fstack[sp] = read_F64(bytes, addr)
             elif 0x2c == opcode:  # i32.load8_s
-                res = (I32, bytes2int8(memory.bytes[addr:addr+1]), 0.0)
+                istack[sp] = read_I8_s(bytes, addr)
             elif 0x2d == opcode:  # i32.load8_u
-                res = (I32, memory.bytes[addr], 0.0)
+                istack[sp] = read_I8_u(bytes, addr)
             elif 0x2e == opcode:  # i32.load16_s
-                res = (I32, bytes2int16(memory.bytes[addr:addr+2]), 0.0)
+                istack[sp] = read_I16_s(bytes, addr)
             elif 0x2f == opcode:  # i32.load16_u
-                res = (I32, bytes2uint16(memory.bytes[addr:addr+2]), 0.0)
+                istack[sp] = read_I16_u(bytes, addr)
             elif 0x30 == opcode:  # i64.load8_s
-                res = (I64, bytes2int8(memory.bytes[addr:addr+1]), 0.0)
+                istack[sp] = read_I8_s(bytes, addr)
             elif 0x31 == opcode:  # i64.load8_u
-                res = (I64, memory.bytes[addr], 0.0)
+                istack[sp] = read_I8_u(bytes, addr)
             elif 0x32 == opcode:  # i64.load16_s
-                res = (I64, bytes2int16(memory.bytes[addr:addr+2]), 0.0)
+                istack[sp] = read_I16_s(bytes, addr)
             elif 0x33 == opcode:  # i64.load16_u
-                res = (I64, bytes2uint16(memory.bytes[addr:addr+2]), 0.0)
+                istack[sp] = read_I16_u(bytes, addr)
             elif 0x34 == opcode:  # i64.load32_s
-                res = (I64, bytes2int32(memory.bytes[addr:addr+4]), 0.0)
+                istack[sp] = read_I32_s(bytes, addr)
             elif 0x35 == opcode:  # i64.load32_u
-                res = (I64, bytes2uint32(memory.bytes[addr:addr+4]), 0.0)
+                istack[sp] = read_I32(bytes, addr)
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
-            sp += 1
-            stack[sp] = res
 
         # Memory store operators
         elif 0x36 <= opcode <= 0x3e:
-            pc, flags = read_LEB(code, pc, 32)
-            pc, offset = read_LEB(code, pc, 32)
-            val = stack[sp]
-            sp -= 1
-            addr_val = stack[sp]
-            sp -= 1
-            if flags != 2:
-                if TRACE:
-                    info("      - unaligned store - flags: 0x%x,"
-                         " offset: 0x%x, addr: 0x%x, val: 0x%x" % (
-                             flags, offset, addr_val[1], val[1]))
-            addr = addr_val[1] + offset
+            offset = code[pc]
+            pc += 1
+            addr = istack[sp-1] + offset  # I32
             assert addr >= 0
             if bound_violation(opcode, addr, memory.pages):
                 raise WAException("out of bounds memory access")
+            bytes = memory.bytes
             if   0x36 == opcode:  # i32.store
-                write_I32(memory.bytes, addr, val[1])
+                write_I32(bytes, addr, istack[sp])
             elif 0x37 == opcode:  # i64.store
-                write_I64(memory.bytes, addr, val[1])
+                write_I64(bytes, addr, istack[sp])
             elif 0x38 == opcode:  # f32.store
-                write_F32(memory.bytes, addr, val[2])
+                write_F32(bytes, addr, fstack[sp])
             elif 0x39 == opcode:  # f64.store
-                write_F64(memory.bytes, addr, val[2])
+                write_F64(bytes, addr, fstack[sp])
             elif 0x3a == opcode:  # i32.store8
-                memory.bytes[addr] = val[1] & 0xff
+                write_I8(bytes, addr, istack[sp])
             elif 0x3b == opcode:  # i32.store16
-                memory.bytes[addr]   =  val[1] & 0x00ff
-                memory.bytes[addr+1] = (val[1] & 0xff00)>>8
+                write_I16(bytes, addr, istack[sp])
             elif 0x3c == opcode:  # i64.store8
-                memory.bytes[addr]   =  val[1] & 0xff
+                write_I8(bytes, addr, istack[sp])
             elif 0x3d == opcode:  # i64.store16
-                memory.bytes[addr]   =  val[1] & 0x00ff
-                memory.bytes[addr+1] = (val[1] & 0xff00)>>8
+                write_I16(bytes, addr, istack[sp])
             elif 0x3e == opcode:  # i64.store32
-                memory.bytes[addr]   =  val[1] & 0x000000ff
-                memory.bytes[addr+1] = (val[1] & 0x0000ff00)>>8
-                memory.bytes[addr+2] = (val[1] & 0x00ff0000)>>16
-                memory.bytes[addr+3] = (val[1] & 0xff000000)>>24
+                write_I32(bytes, addr, istack[sp])
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
+            sp -= 2
 
         # Memory size operators
         elif 0x3f == opcode:  # current_memory
-            pc, reserved = read_LEB(code, pc, 1)
             sp += 1
-            stack[sp] = (I32, module.memory.pages, 0.0)
+            istack[sp] = module.memory.pages
             if TRACE:
                 debug("      - current 0x%x" % module.memory.pages)
         elif 0x40 == opcode:  # grow_memory
-            pc, reserved = read_LEB(code, pc, 1)
-            prev_size = module.memory.pages
-            delta = stack[sp][1]  # I32
-            module.memory.grow(delta)
-            stack[sp] = (I32, prev_size, 0.0)
-            debug("      - delta 0x%x, prev: 0x%x" % (
-                delta, prev_size))
+            prev_size = module.memory.grow(istack[sp])  # I32
+            istack[sp] = prev_size
+            debug("      - prev: 0x%x" % prev_size)
 
         #
         # Constants
         #
         elif 0x41 == opcode:  # i32.const
-            pc, val = read_LEB(code, pc, 32, signed=True)
             sp += 1
-            stack[sp] = (I32, val, 0.0)
-            if TRACE: debug("      - %s" % value_repr(stack[sp]))
+            istack[sp] = code[pc]
+            pc += 1
+            if TRACE: debug("      - 0x%x" % istack[sp])
         elif 0x42 == opcode:  # i64.const
-            pc, val = read_LEB(code, pc, 64, signed=True)
             sp += 1
-            stack[sp] = (I64, val, 0.0)
-            if TRACE: debug("      - %s" % value_repr(stack[sp]))
+            istack[sp] = code[pc]
+            pc += 1
+            if TRACE: debug("      - 0x%x" % istack[sp])
         elif 0x43 == opcode:  # f32.const
             sp += 1
-            stack[sp] = (F32, 0, read_F32(code, pc))
-            pc += 4
-            if TRACE: debug("      - %s" % value_repr(stack[sp]))
+            fstack[sp] = consts[code[pc]]
+            pc += 1
+            if TRACE: debug("      - %s" % fstack[sp])
         elif 0x44 == opcode:  # f64.const
             sp += 1
-            stack[sp] = (F64, 0, read_F64(code, pc))
-            pc += 8
-            if TRACE: debug("      - %s" % value_repr(stack[sp]))
+            fstack[sp] = consts[code[pc]]
+            pc += 1
+            if TRACE: debug("      - %s" % fstack[sp])
 
         #
         # Comparison operators
@@ -1390,632 +1877,3537 @@ def interpret_mvp(module,
 
         # unary
         elif opcode in [0x45, 0x50]:
-            a = stack[sp]
-            sp -= 1
+            ai = istack[sp]
             if   0x45 == opcode: # i32.eqz
-                if VALIDATE: assert a[0] == I32
-                res = (I32, a[1] == 0, 0.0)
+                istack[sp] = ai == 0
             elif 0x50 == opcode: # i64.eqz
-                if VALIDATE: assert a[0] == I64
-                res = (I32, a[1] == 0, 0.0)
+                istack[sp] = ai == 0
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s) = %s" % (
-                    value_repr(a), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
-        # binary
-        elif 0x46 <= opcode <= 0x66:
-            a, b = stack[sp-1], stack[sp]
-            sp -= 2
+        # binary (integer operands)
+        elif 0x46 <= opcode <= 0x5a:
+            sp -= 1
+            ai, bi = istack[sp], istack[sp+1]
             if   0x46 == opcode: # i32.eq
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, a[1] == b[1], 0.0)
+                istack[sp] = ai == bi
             elif 0x47 == opcode: # i32.ne
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, a[1] != b[1], 0.0)
+                istack[sp] = ai != bi
             elif 0x48 == opcode: # i32.lt_s
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2int32(a[1]) < int2int32(b[1]), 0.0)
+                istack[sp] = int2int32(ai) < int2int32(bi)
             elif 0x49 == opcode: # i32.lt_u
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2uint32(a[1]) < int2uint32(b[1]), 0.0)
+                istack[sp] = int2uint32(ai) < int2uint32(bi)
             elif 0x4a == opcode: # i32.gt_s
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2int32(a[1]) > int2int32(b[1]), 0.0)
+                istack[sp] = int2int32(ai) > int2int32(bi)
             elif 0x4b == opcode: # i32.gt_u
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2uint32(a[1]) > int2uint32(b[1]), 0.0)
+                istack[sp] = int2uint32(ai) > int2uint32(bi)
             elif 0x4c == opcode: # i32.le_s
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2int32(a[1]) <= int2int32(b[1]), 0.0)
+                istack[sp] = int2int32(ai) <= int2int32(bi)
             elif 0x4d == opcode: # i32.le_u
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2uint32(a[1]) <= int2uint32(b[1]), 0.0)
+                istack[sp] = int2uint32(ai) <= int2uint32(bi)
             elif 0x4e == opcode: # i32.ge_s
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2int32(a[1]) >= int2int32(b[1]), 0.0)
+                istack[sp] = int2int32(ai) >= int2int32(bi)
             elif 0x4f == opcode: # i32.ge_u
-                if VALIDATE: assert a[0] == I32 and b[0] == I32
-                res = (I32, int2uint32(a[1]) >= int2uint32(b[1]), 0.0)
+                istack[sp] = int2uint32(ai) >= int2uint32(bi)
             elif 0x51 == opcode: # i64.eq
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, a[1] == b[1], 0.0)
+                istack[sp] = ai == bi
             elif 0x52 == opcode: # i64.ne
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, a[1] != b[1], 0.0)
+                istack[sp] = ai != bi
             elif 0x53 == opcode: # i64.lt_s
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2int64(a[1]) < int2int64(b[1]), 0.0)
+                istack[sp] = int2int64(ai) < int2int64(bi)
             elif 0x54 == opcode: # i64.lt_u
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2uint64(a[1]) < int2uint64(b[1]), 0.0)
+                istack[sp] = int2uint64(ai) < int2uint64(bi)
             elif 0x55 == opcode: # i64.gt_s
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2int64(a[1]) > int2int64(b[1]), 0.0)
+                istack[sp] = int2int64(ai) > int2int64(bi)
             elif 0x56 == opcode: # i64.gt_u
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2uint64(a[1]) > int2uint64(b[1]), 0.0)
+                istack[sp] = int2uint64(ai) > int2uint64(bi)
             elif 0x57 == opcode: # i64.le_s
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2int64(a[1]) <= int2int64(b[1]), 0.0)
+                istack[sp] = int2int64(ai) <= int2int64(bi)
             elif 0x58 == opcode: # i64.le_u
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2uint64(a[1]) <= int2uint64(b[1]), 0.0)
+                istack[sp] = int2uint64(ai) <= int2uint64(bi)
             elif 0x59 == opcode: # i64.ge_s
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2int64(a[1]) >= int2int64(b[1]), 0.0)
+                istack[sp] = int2int64(ai) >= int2int64(bi)
             elif 0x5a == opcode: # i64.ge_u
-                if VALIDATE: assert a[0] == I64 and b[0] == I64
-                res = (I32, int2uint64(a[1]) >= int2uint64(b[1]), 0.0)
-            elif 0x5b == opcode: # f32.eq
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] == b[2], 0.0)
+                istack[sp] = int2uint64(ai) >= int2uint64(bi)
+            else:
+                raise WAException("%s(0x%x) unimplemented" % (
+                    OPERATOR_INFO[opcode][0], opcode))
+            if TRACE:
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
+
+        # binary (float operands)
+        elif 0x5b <= opcode <= 0x66:
+            sp -= 1
+            af, bf = fstack[sp], fstack[sp+1]
+            if   0x5b == opcode: # f32.eq
+                istack[sp] = af == bf
             elif 0x5c == opcode: # f32.ne
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] != b[2], 0.0)
+                istack[sp] = af != bf
             elif 0x5d == opcode: # f32.lt
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] < b[2], 0.0)
+                istack[sp] = af < bf
             elif 0x5e == opcode: # f32.gt
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] > b[2], 0.0)
+                istack[sp] = af > bf
             elif 0x5f == opcode: # f32.le
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] <= b[2], 0.0)
+                istack[sp] = af <= bf
             elif 0x60 == opcode: # f32.ge
-                if VALIDATE: assert a[0] == F32 and b[0] == F32
-                res = (I32, a[2] >= b[2], 0.0)
+                istack[sp] = af >= bf
             elif 0x61 == opcode: # f64.eq
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] == b[2], 0.0)
+                istack[sp] = af == bf
             elif 0x62 == opcode: # f64.ne
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] != b[2], 0.0)
+                istack[sp] = af != bf
             elif 0x63 == opcode: # f64.lt
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] < b[2], 0.0)
+                istack[sp] = af < bf
             elif 0x64 == opcode: # f64.gt
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] > b[2], 0.0)
+                istack[sp] = af > bf
             elif 0x65 == opcode: # f64.le
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] <= b[2], 0.0)
+                istack[sp] = af <= bf
             elif 0x66 == opcode: # f64.ge
-                if VALIDATE: assert a[0] == F64 and b[0] == F64
-                res = (I32, a[2] >= b[2], 0.0)
+                istack[sp] = af >= bf
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s, %s) = %s" % (
-                    value_repr(a), value_repr(b), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         #
         # Numeric operators
         #
 
         # unary
-        elif opcode in [0x67, 0x68, 0x69, 0x79, 0x7a, 0x7b, 0x8b,
-                        0x8c, 0x99, 0x9a]:
-            a = stack[sp]
-            sp -= 1
+        elif opcode in [0x67, 0x68, 0x69, 0x79, 0x7a, 0x7b]:
+            ai = istack[sp]
             if   0x67 == opcode: # i32.clz
-                if VALIDATE: assert a[0] == I32
                 count = 0
-                val = a[1]
+                val = ai
                 while count < 32 and (val & 0x80000000) == 0:
                     count += 1
                     val = val * 2
-                res = (I32, count, 0.0)
+                istack[sp] = count
             elif 0x68 == opcode: # i32.ctz
-                if VALIDATE: assert a[0] == I32
                 count = 0
-                val = a[1]
+                val = ai
                 while count < 32 and (val % 2) == 0:
                     count += 1
                     val = val / 2
-                res = (I32, count, 0.0)
+                istack[sp] = count
             elif 0x69 == opcode: # i32.popcnt
-                if VALIDATE: assert a[0] == I32
                 count = 0
-                val = a[1]
+                val = ai
                 for i in range(32):
                     if 0x1 & val:
                         count += 1
                     val = val / 2
-                res = (I32, count, 0.0)
+                istack[sp] = count
             elif 0x79 == opcode: # i64.clz
-                if VALIDATE: assert a[0] == I64
-                val = a[1]
+                val = ai
                 if val < 0:
-                    res = (I64, 0, 0.0)
+                    istack[sp] = 0
                 else:
                     count = 1
                     while count < 63 and (val & 0x4000000000000000) == 0:
                         count += 1
                         val = val * 2
-                    res = (I64, count, 0.0)
+                    istack[sp] = count
             elif 0x7a == opcode: # i64.ctz
-                if VALIDATE: assert a[0] == I64
                 count = 0
-                val = a[1]
+                val = ai
                 while count < 64 and (val % 2) == 0:
                     count += 1
                     val = val / 2
-                res = (I64, count, 0.0)
+                istack[sp] = count
             elif 0x7b == opcode: # i64.popcnt
-                if VALIDATE: assert a[0] == I64
                 count = 0
-                val = a[1]
+                val = ai
                 for i in range(64):
                     if 0x1 & val:
                         count += 1
                     val = val / 2
-                res = (I64, count, 0.0)
-            elif 0x8b == opcode: # f32.abs
-                if VALIDATE: assert a[0] == F32
-                res = (F32, 0, abs(a[2]))
+                istack[sp] = count
+            else:
+                raise WAException("%s(0x%x) unimplemented" % (
+                    OPERATOR_INFO[opcode][0], opcode))
+            if TRACE:
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
+        elif opcode in [0x8b, 0x8c, 0x99, 0x9a]:
+            af = fstack[sp]
+            if   0x8b == opcode: # f32.abs
+                fstack[sp] = abs(af)
             elif 0x8c == opcode: # f32.neg
-                if VALIDATE: assert a[0] == F32
-                res = (F32, 0, -a[2])
+                fstack[sp] = -af
             elif 0x99 == opcode: # f64.abs
-                if VALIDATE: assert a[0] == F64
-                res = (F64, 0, abs(a[2]))
+                fstack[sp] = abs(af)
             elif  0x9a == opcode: # f64.neg
-                if VALIDATE: assert a[0] == F64
-                res = (F64, 0, -a[2])
+                fstack[sp] = -af
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s) = %s" % (
-                    value_repr(a), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         # i32 binary
         elif 0x6a <= opcode <= 0x78:
-            a, b = stack[sp-1], stack[sp]
-            sp -= 2
-            if VALIDATE: assert a[0] == I32 and b[0] == I32
+            sp -= 1
+            ai, bi = istack[sp], istack[sp+1]
             if   0x6a == opcode: # i32.add
-                res = (I32, int2int32(a[1] + b[1]), 0.0)
+                istack[sp] = int2int32(ai + bi)
             elif 0x6b == opcode: # i32.sub
-                res = (I32, a[1] - b[1], 0.0)
+                istack[sp] = ai - bi
             elif 0x6c == opcode: # i32.mul
-                res = (I32, int2int32(a[1] * b[1]), 0.0)
+                istack[sp] = int2int32(ai * bi)
             elif 0x6d == opcode: # i32.div_s
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
-                elif a[1] == 0x80000000 and b[1] == -1:
+                elif ai == 0x80000000 and bi == -1:
                     raise WAException("integer overflow")
                 else:
-                    res = (I32, idiv_s(int2int32(a[1]), int2int32(b[1])), 0.0)
+                    istack[sp] = idiv_s(int2int32(ai), int2int32(bi))
             elif 0x6e == opcode: # i32.div_u
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    res = (I32, int2uint32(a[1]) / int2uint32(b[1]), 0.0)
+                    istack[sp] = int2uint32(ai) / int2uint32(bi)
             elif 0x6f == opcode: # i32.rem_s
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    res = (I32, irem_s(int2int32(a[1]), int2int32(b[1])), 0.0)
+                    istack[sp] = irem_s(int2int32(ai), int2int32(bi))
             elif 0x70 == opcode: # i32.rem_u
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    res = (I32, int2uint32(a[1]) % int2uint32(b[1]), 0.0)
+                    istack[sp] = int2uint32(ai) % int2uint32(bi)
             elif 0x71 == opcode: # i32.and
-                res = (I32, a[1] & b[1], 0.0)
+                istack[sp] = ai & bi
             elif 0x72 == opcode: # i32.or
-                res = (I32, a[1] | b[1], 0.0)
+                istack[sp] = ai | bi
             elif 0x73 == opcode: # i32.xor
-                res = (I32, a[1] ^ b[1], 0.0)
+                istack[sp] = ai ^ bi
             elif 0x74 == opcode: # i32.shl
-                res = (I32, a[1] << (b[1] % 0x20), 0.0)
+                istack[sp] = ai << (bi % 0x20)
             elif 0x75 == opcode: # i32.shr_s
-                res = (I32, int2int32(a[1]) >> (b[1] % 0x20), 0.0)
+                istack[sp] = int2int32(ai) >> (bi % 0x20)
             elif 0x76 == opcode: # i32.shr_u
-                res = (I32, int2uint32(a[1]) >> (b[1] % 0x20), 0.0)
-#            elif 0x77 == opcode: # i32.rotl
-#                res = (I32, rotl32(a[1], b[1]), 0.0)
-#            elif 0x78 == opcode: # i32.rotr
-#                res = (I32, rotr32(a[1], b[1]), 0.0)
+                istack[sp] = int2uint32(ai) >> (bi % 0x20)
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s, %s) = %s" % (
-                    value_repr(a), value_repr(b), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         # i64 binary
         elif 0x7c <= opcode <= 0x8a:
-            a, b = stack[sp-1], stack[sp]
-            sp -= 2
-            if VALIDATE: assert a[0] == I64 and b[0] == I64
+            sp -= 1
+            ai, bi = istack[sp], istack[sp+1]
             if   0x7c == opcode: # i64.add
-                res = (I64, int2int64(a[1] + b[1]), 0.0)
+                istack[sp] = int2int64(ai + bi)
             elif 0x7d == opcode: # i64.sub
-                res = (I64, a[1] - b[1], 0.0)
+                istack[sp] = ai - bi
             elif 0x7e == opcode: # i64.mul
-                res = (I64, int2int64(a[1] * b[1]), 0.0)
+                istack[sp] = int2int64(ai * bi)
             elif 0x7f == opcode: # i64.div_s
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
-#                elif a[1] == 0x8000000000000000 and b[1] == -1:
-#                    raise WAException("integer overflow")
                 else:
-                    res = (I64, idiv_s(int2int64(a[1]), int2int64(b[1])), 0.0)
+                    istack[sp] = idiv_s(int2int64(ai), int2int64(bi))
             elif 0x80 == opcode: # i64.div_u
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    if a[1] < 0 and b[1] > 0:
-                        res = (I64, int2uint64(-a[1]) / int2uint64(b[1]), 0.0)
-                    elif a[1] > 0 and b[1] < 0:
-                        res = (I64, int2uint64(a[1]) / int2uint64(-b[1]), 0.0)
+                    if ai < 0 and bi > 0:
+                        istack[sp] = int2uint64(-ai) / int2uint64(bi)
+                    elif ai > 0 and bi < 0:
+                        istack[sp] = int2uint64(ai) / int2uint64(-bi)
                     else:
-                        res = (I64, int2uint64(a[1]) / int2uint64(b[1]), 0.0)
+                        istack[sp] = int2uint64(ai) / int2uint64(bi)
             elif 0x81 == opcode: # i64.rem_s
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    res = (I64, irem_s(int2int64(a[1]), int2int64(b[1])), 0.0)
+                    istack[sp] = irem_s(int2int64(ai), int2int64(bi))
             elif 0x82 == opcode: # i64.rem_u
-                if b[1] == 0:
+                if bi == 0:
                     raise WAException("integer divide by zero")
                 else:
-                    res = (I64, int2uint64(a[1]) % int2uint64(b[1]), 0.0)
+                    istack[sp] = int2uint64(ai) % int2uint64(bi)
             elif 0x83 == opcode: # i64.and
-                res = (I64, a[1] & b[1], 0.0)
+                istack[sp] = ai & bi
             elif 0x84 == opcode: # i64.or
-                res = (I64, a[1] | b[1], 0.0)
+                istack[sp] = ai | bi
             elif 0x85 == opcode: # i64.xor
-                res = (I64, a[1] ^ b[1], 0.0)
+                istack[sp] = ai ^ bi
             elif 0x86 == opcode: # i64.shl
-                res = (I64, a[1] << (b[1] % 0x40), 0.0)
+                istack[sp] = ai << (bi % 0x40)
             elif 0x87 == opcode: # i64.shr_s
-                res = (I64, int2int64(a[1]) >> (b[1] % 0x40), 0.0)
+                istack[sp] = int2int64(ai) >> (bi % 0x40)
             elif 0x88 == opcode: # i64.shr_u
-                res = (I64, int2uint64(a[1]) >> (b[1] % 0x40), 0.0)
-#            elif 0x89 == opcode: # i64.rotl
-#                res = (I64, rotl64(a[1], b[1]), 0.0)
-#            elif 0x8a == opcode: # i64.rotr
-#                res = (I64, rotr64(a[1], b[1]), 0.0)
+                istack[sp] = int2uint64(ai) >> (bi % 0x40)
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s, %s) = %s" % (
-                    value_repr(a), value_repr(b), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         # f32 binary operations
         elif 0x92 <= opcode <= 0x98:
-            a, b = stack[sp-1], stack[sp]
-            sp -= 2
-            if VALIDATE: assert a[0] == F32 and b[0] == F32
+            sp -= 1
+            af, bf = fstack[sp], fstack[sp+1]
             if   0x92 == opcode: # f32.add
-                res = (F32, 0, a[2] + b[2])
+                fstack[sp] = af + bf
             elif 0x93 == opcode: # f32.sub
-                res = (F32, 0, a[2] - b[2])
+                fstack[sp] = af - bf
             elif 0x94 == opcode: # f32.mul
-                res = (F32, 0, a[2] * b[2])
+                fstack[sp] = af * bf
             elif 0x95 == opcode: # f32.div
-                res = (F32, 0, a[2] / b[2])
+                fstack[sp] = af / bf
             elif 0x96 == opcode: # f32.min
-                if a[2] < b[2]:
-                    res = (F32, 0, a[2])
+                if af < bf:
+                    fstack[sp] = af
                 else:
-                    res = (F32, 0, b[2])
+                    fstack[sp] = bf
             elif 0x97 == opcode: # f32.max
-                if a[2] > b[2]:
-                    res = (F32, 0, a[2])
+                if af > bf:
+                    fstack[sp] = af
                 else:
-                    res = (F32, 0, b[2])
+                    fstack[sp] = bf
             elif 0x98 == opcode: # f32.copysign
-                if b[2] > 0:
-                    res = (F32, 0, abs(a[2]))
+                if bf > 0:
+                    fstack[sp] = abs(af)
                 else:
-                    res = (F32, 0, -abs(a[2]))
+                    fstack[sp] = -abs(af)
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s, %s) = %s" % (
-                    value_repr(a), value_repr(b), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         # f64 binary operations
         elif 0xa0 <= opcode <= 0xa6:
-            a, b = stack[sp-1], stack[sp]
-            sp -= 2
-            if VALIDATE: assert a[0] == F64 and b[0] == F64
+            sp -= 1
+            af, bf = fstack[sp], fstack[sp+1]
             if   0xa0 == opcode: # f64.add
-                res = (F64, 0, a[2] + b[2])
+                fstack[sp] = af + bf
             elif 0xa1 == opcode: # f64.sub
-                res = (F64, 0, a[2] - b[2])
+                fstack[sp] = af - bf
             elif 0xa2 == opcode: # f64.mul
-                res = (F64, 0, a[2] * b[2])
+                fstack[sp] = af * bf
             elif 0xa3 == opcode: # f64.div
-                res = (F64, 0, a[2] / b[2])
+                fstack[sp] = af / bf
             elif 0xa4 == opcode: # f64.min
-                if a[2] < b[2]:
-                    res = (F64, 0, a[2])
+                if af < bf:
+                    fstack[sp] = af
                 else:
-                    res = (F64, 0, b[2])
+                    fstack[sp] = bf
             elif 0xa5 == opcode: # f64.max
-                if a[2] > b[2]:
-                    res = (F64, 0, a[2])
+                if af > bf:
+                    fstack[sp] = af
                 else:
-                    res = (F64, 0, b[2])
+                    fstack[sp] = bf
             elif 0xa6 == opcode: # f64.copysign
-                if b[2] > 0:
-                    res = (F64, 0, abs(a[2]))
+                if bf > 0:
+                    fstack[sp] = abs(af)
                 else:
-                    res = (F64, 0, -abs(a[2]))
+                    fstack[sp] = -abs(af)
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s, %s) = %s" % (
-                    value_repr(a), value_repr(b), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         ## conversion operations
         elif 0xa7 <= opcode <= 0xbb:
-            a = stack[sp]
-            sp -= 1
+            ai, af = istack[sp], fstack[sp]
 
             # conversion operations
             if   0xa7 == opcode: # i32.wrap/i64
-                if VALIDATE: assert a[0] == I64
-                res = (I32, int2int32(a[1]), 0.0)
+                istack[sp] = int2int32(ai)
             elif 0xa8 == opcode: # i32.trunc_s/f32
-                if VALIDATE: assert a[0] == F32
-                if math.isnan(a[2]):
+                if math.isnan(af):
                     raise WAException("invalid conversion to integer")
-                elif a[2] > 2147483647.0:
+                elif af > 2147483647.0:
                     raise WAException("integer overflow")
-                elif a[2] < -2147483648.0:
+                elif af < -2147483648.0:
                     raise WAException("integer overflow")
-                res = (I32, int(a[2]), 0.0)
-#            elif 0xa9 == opcode: # i32.trunc_u/f32
-#                if VALIDATE: assert a[0] == F32
-#                if math.isnan(a[2]):
-#                    raise WAException("invalid conversion to integer")
-#                elif a[2] > 4294967295.0:
-#                    raise WAException("integer overflow")
-#                elif a[2] <= -1.0:
-#                    raise WAException("integer overflow")
-#                res = (I32, int(a[2]), 0.0)
-#            elif 0xaa == opcode: # i32.trunc_s/f64
-#                if VALIDATE: assert a[0] == F64
-#                if math.isnan(a[2]):
-#                    raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**31-1:
-#                    raise WAException("integer overflow")
-#                elif a[2] < -2**31:
-#                    raise WAException("integer overflow")
-#                res = (I32, int(a[2]), 0.0)
-#            elif 0xab == opcode: # i32.trunc_u/f64
-#                if VALIDATE: assert a[0] == F64
-#                debug("*** a[2]: %s" % a[2])
-#                if math.isnan(a[2]):
-#                    raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**32-1:
-#                    raise WAException("integer overflow")
-#                elif a[2] <= -1.0:
-#                    raise WAException("integer overflow")
-#                res = (I32, int(a[2]), 0.0)
+                istack[sp] = int(af)
             elif 0xac == opcode: # i64.extend_s/i32
-                if VALIDATE: assert a[0] == I32
-                res = (I64, int2int32(a[1]), 0.0)
+                istack[sp] = int2int32(ai)
             elif 0xad == opcode: # i64.extend_u/i32
-                if VALIDATE: assert a[0] == I32
-                res = (I64, intmask(a[1]), 0.0)
-#            elif 0xae == opcode: # i64.trunc_s/f32
-#                if VALIDATE: assert a[0] == F32
-#                if math.isnan(a[2]):
-#                    raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**63-1:
-#                    raise WAException("integer overflow")
-#                elif a[2] < -2**63:
-#                    raise WAException("integer overflow")
-#                res = (I64, int(a[2]), 0.0)
-#            elif 0xaf == opcode: # i64.trunc_u/f32
-#                if VALIDATE: assert a[0] == F32
-#                if math.isnan(a[2]):
-#                    raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**63-1:
-#                    raise WAException("integer overflow")
-#                elif a[2] <= -1.0:
-#                    raise WAException("integer overflow")
-#                res = (I64, int(a[2]), 0.0)
+                istack[sp] = intmask(ai)
             elif 0xb0 == opcode: # i64.trunc_s/f64
-                if VALIDATE: assert a[0] == F64
-                if math.isnan(a[2]):
+                if math.isnan(af):
                     raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**63-1:
-#                    raise WAException("integer overflow")
-#                elif a[2] < -2**63:
-#                    raise WAException("integer overflow")
-                res = (I64, int(a[2]), 0.0)
+                istack[sp] = int(af)
             elif 0xb1 == opcode: # i64.trunc_u/f64
-                if VALIDATE: assert a[0] == F64
-                if math.isnan(a[2]):
+                if math.isnan(af):
                     raise WAException("invalid conversion to integer")
-#                elif a[2] > 2**63-1:
-#                    raise WAException("integer overflow")
-                elif a[2] <= -1.0:
+                elif af <= -1.0:
                     raise WAException("integer overflow")
-                res = (I64, int(a[2]), 0.0)
+                istack[sp] = int(af)
             elif 0xb2 == opcode: # f32.convert_s/i32
-                if VALIDATE: assert a[0] == I32
-                res = (F32, 0, float(a[1]))
+                fstack[sp] = float(ai)
             elif 0xb3 == opcode: # f32.convert_u/i32
-                if VALIDATE: assert a[0] == I32
-                res = (F32, 0, float(int2uint32(a[1])))
+                fstack[sp] = float(int2uint32(ai))
             elif 0xb4 == opcode: # f32.convert_s/i64
-                if VALIDATE: assert a[0] == I64
-                res = (F32, 0, float(a[1]))
+                fstack[sp] = float(ai)
             elif 0xb5 == opcode: # f32.convert_u/i64
-                if VALIDATE: assert a[0] == I64
-                res = (F32, 0, float(int2uint64(a[1])))
-#            elif 0xb6 == opcode: # f32.demote/f64
-#                if VALIDATE: assert a[0] == F64
-#                res = (F32, 0, unpack_f32(pack_f32(a[2])))
+                fstack[sp] = float(int2uint64(ai))
             elif 0xb7 == opcode: # f64.convert_s/i32
-                if VALIDATE: assert a[0] == I32
-                res = (F64, 0, float(a[1]))
+                fstack[sp] = float(ai)
             elif 0xb8 == opcode: # f64.convert_u/i32
-                if VALIDATE: assert a[0] == I32
-                res = (F64, 0, float(int2uint32(a[1])))
+                fstack[sp] = float(int2uint32(ai))
             elif 0xb9 == opcode: # f64.convert_s/i64
-                if VALIDATE: assert a[0] == I64
-                res = (F64, 0, float(a[1]))
+                fstack[sp] = float(ai)
             elif 0xba == opcode: # f64.convert_u/i64
-                if VALIDATE: assert a[0] == I64
-                res = (F64, 0, float(int2uint64(a[1])))
+                fstack[sp] = float(int2uint64(ai))
             elif 0xbb == opcode: # f64.promote/f32
-                if VALIDATE: assert a[0] == F32
-                res = (F64, 0, a[2])
+                fstack[sp] = af
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s) = %s" % (
-                    value_repr(a), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         ## reinterpretations
         elif 0xbc <= opcode <= 0xbf:
-            a = stack[sp]
-            sp -= 1
+            ai, af = istack[sp], fstack[sp]
 
             if   0xbc == opcode: # i32.reinterpret/f32
-                if VALIDATE: assert a[0] == F32
-                res = (I32, intmask(pack_f32(a[2])), 0.0)
+                istack[sp] = intmask(pack_f32(af))
             elif 0xbd == opcode: # i64.reinterpret/f64
-                if VALIDATE: assert a[0] == F64
-                res = (I64, intmask(pack_f64(a[2])), 0.0)
-#            elif 0xbe == opcode: # f32.reinterpret/i32
-#                if VALIDATE: assert a[0] == I32
-#                res = (F32, 0, unpack_f32(int2int32(a[1])))
+                istack[sp] = intmask(pack_f64(af))
             elif 0xbf == opcode: # f64.reinterpret/i64
-                if VALIDATE: assert a[0] == I64
-                res = (F64, 0, unpack_f64(int2int64(a[1])))
+                fstack[sp] = unpack_f64(int2int64(ai))
             else:
                 raise WAException("%s(0x%x) unimplemented" % (
                     OPERATOR_INFO[opcode][0], opcode))
             if TRACE:
-                debug("      - (%s) = %s" % (
-                    value_repr(a), value_repr(res)))
-            sp += 1
-            stack[sp] = res
+                debug("      - = %s" % slot_repr(istack, fstack, sp))
 
         else:
             raise WAException("unrecognized opcode 0x%x" % opcode)
 
-    return pc, sp, fp, csp
+    return sp
 
 
 ######################################
-# Higher level classes
+# Dispatch table interpreter
 ######################################
 
-class Reader():
-    def __init__(self, bytes):
-        self.bytes = bytes
-        self.pos = 0
+# interpret_mvp walks an if/elif chain so opcodes near the end of the
+# chain (conversions, float operators) pay for every test before
+# them. This engine instead maps each opcode to a handler through the
+# 256 entry HANDLERS table. It is meant for CPython and for RPython
+# builds without the JIT (the JIT traces interpret_mvp).
+#
+# Handlers are called as handler(r, istack, fstack, sp) and return the
+# new sp. Everything else the handler needs (decoded code, pc, fp, the
+# call stack, etc) is kept in a Registers object that handlers update
+# in place. Operators that behave the same for i32/i64 or f32/f64 on
+# the unboxed stacks share a handler.
+
+class Registers():
+    def __init__(self, module, func, pc, fp, csp):
+        self.module = module
+        self.memory = module.memory
+        self.function = module.function
+        self.table = module.table
+        self.callstack = module.callstack
+        self.func = func
+        self.code = func.code
+        self.consts = func.consts
+        self.pc = pc    # -1 once returned to the top-level
+        self.fp = fp
+        self.csp = csp
+
+def interpret_table(module,
+        pc, func,
+        memory, sp, istack, fstack, fp, csp, callstack):
+    r = Registers(module, func, pc, fp, csp)
+    handlers = HANDLERS
+    while r.pc >= 0:
+        pc = r.pc
+        opcode = r.code[pc]
+        if TRACE:
+            dump_stacks(sp, istack, fstack, r.fp, r.csp, r.callstack)
+            _, immediates = decoded_immediates(r.code, pc)
+            info("    0x%x <0x%x/%s%s%s>" % (
+                pc, opcode, opcode_name(opcode),
+                " " if immediates else "",
+                ",".join(["0x%x" % i for i in immediates])))
+        r.pc = pc + 1
+        sp = handlers[opcode](r, istack, fstack, sp)
+    return sp
 
-    def read_byte(self):
-        b = self.bytes[self.pos]
-        self.pos += 1
-        return b
+# Read the memory offset immediate and return the effective address of
+# an access of size bytes at base + offset
+def effective_addr(r, base, size):
+    offset = r.code[r.pc]
+    r.pc += 1
+    addr = base + offset
+    assert addr >= 0
+    if addr + size > r.memory.pages*(2**16):
+        raise WAException("out of bounds memory access")
+    return addr
+
+# Keep the branch results and drop the rest of the values pushed since
+# the target block was entered. tpc is the decoded (target, arity,
+# base) triple.
+def branch(r, istack, fstack, sp, tpc):
+    code = r.code
+    base = r.fp + code[tpc+2]
+    if code[tpc+1]:
+        istack[base] = istack[sp]
+        fstack[base] = fstack[sp]
+        sp = base
+    else:
+        sp = base - 1
+    r.pc = code[tpc]
+    return sp
 
-    def read_word(self):
-        w = bytes2uint32(self.bytes[self.pos:self.pos+4])
-        self.pos += 4
-        return w
+def call_function(r, istack, fstack, sp, callee):
+    if isinstance(callee, FunctionImport):
+        return do_call_import(istack, fstack, sp, r.memory,
+                r.module.imports, callee)
+    assert isinstance(callee, Function)
+    sp = do_call(istack, fstack, r.callstack, sp, r.fp, r.csp,
+            callee, r.pc, r.func)
+    r.csp += 1
+    r.fp = r.callstack[r.csp].sp + 1
+    r.pc = 0
+    r.func = callee
+    r.code = callee.code
+    r.consts = callee.consts
+    return sp
 
-    def read_bytes(self, cnt):
-        if VALIDATE: assert cnt >= 0
-        if VALIDATE: assert self.pos >= 0
-        bytes = self.bytes[self.pos:self.pos+cnt]
-        self.pos += cnt
-        return bytes
+# Control flow operators
 
-    def read_LEB(self, maxbits=32, signed=False):
-        [self.pos, result] = read_LEB(self.bytes, self.pos,
-                maxbits, signed)
-        return result
+def op_unrecognized(r, istack, fstack, sp):
+    raise WAException("unrecognized opcode 0x%x" % r.code[r.pc-1])
 
-    def eof(self):
-        return self.pos >= len(self.bytes)
+def op_unimplemented(r, istack, fstack, sp):
+    opcode = r.code[r.pc-1]
+    raise WAException("%s(0x%x) unimplemented" % (
+        OPERATOR_INFO[opcode][0], opcode))
 
-class Memory():
-    def __init__(self, pages=1, bytes=[]):
-        debug("memory pages: %d" % pages)
-        self.pages = pages
-        self.bytes = bytes + ([0]*((pages*(2**16))-len(bytes)))
-        #self.bytes = [0]*(pages*(2**16))
+def op_unreachable(r, istack, fstack, sp):
+    raise WAException("unreachable")
 
-    def grow(self, pages):
-        self.pages += int(pages)
-        self.bytes = self.bytes + ([0]*(int(pages)*(2**16)))
+def op_nop(r, istack, fstack, sp):
+    return sp
 
-    def read_byte(self, pos):
-        b = self.bytes[pos]
-        return b
+def op_if(r, istack, fstack, sp):
+    if istack[sp]:  # I32
+        r.pc += 1
+    else:
+        # branch to else block or after end of if
+        r.pc = r.code[r.pc]
+    return sp - 1
 
-    def write_byte(self, pos, val):
-        self.bytes[pos] = val
+def op_else(r, istack, fstack, sp):
+    # end of if block, jump after end
+    r.pc = r.code[r.pc]
+    return sp
 
+def op_return(r, istack, fstack, sp):  # end (of function), return
+    frame = r.callstack[r.csp]
+    sp = do_return(istack, fstack, frame, sp)
+    r.fp = frame.fp
+    r.csp -= 1
+    caller = frame.caller
+    if r.csp == -1 or caller is None:
+        # Return to top-level
+        r.pc = -1
+    else:
+        r.pc = frame.ra
+        r.func = caller
+        r.code = caller.code
+        r.consts = caller.consts
+    return sp
 
-class Import():
-    def __init__(self, module, field, kind, type=0,
-            element_type=0, initial=0, maximum=0, global_type=0,
-            mutability=0):
-        self.module = module
-        self.field = field
-        self.kind = kind
-        self.type = type # Function
-        self.element_type = element_type # Table
-        self.initial = initial # Table & Memory
+def op_br(r, istack, fstack, sp):
+    return branch(r, istack, fstack, sp, r.pc)
+
+def op_br_if(r, istack, fstack, sp):
+    if istack[sp]:  # I32
+        return branch(r, istack, fstack, sp-1, r.pc)
+    r.pc += 3
+    return sp - 1
+
+def op_br_table(r, istack, fstack, sp):
+    target_count = r.code[r.pc]
+    didx = istack[sp]  # I32
+    if didx < 0 or didx >= target_count:
+        didx = target_count  # default
+    return branch(r, istack, fstack, sp-1, r.pc + 1 + 3*didx)
+
+def op_call(r, istack, fstack, sp):
+    fidx = r.code[r.pc]
+    r.pc += 1
+    return call_function(r, istack, fstack, sp,
+            get_function(r.function, fidx))
+
+def op_call_indirect(r, istack, fstack, sp):
+    tidx = r.code[r.pc]
+    r.pc += 1
+    fidx = get_from_table(r.table, ANYFUNC, istack[sp])  # I32
+    callee = get_function(r.function, fidx)
+    if not same_signature(callee.type, r.module.type[tidx]):
+        raise WAException("indirect call signature mismatch")
+    return call_function(r, istack, fstack, sp-1, callee)
+
+# Parametric operators
+
+def op_drop(r, istack, fstack, sp):
+    return sp - 1
+
+def op_select(r, istack, fstack, sp):
+    cond = istack[sp]  # I32
+    sp -= 2
+    if not cond:
+        istack[sp] = istack[sp+1]
+        fstack[sp] = fstack[sp+1]
+    return sp
+
+# Variable access
+
+def op_get_local(r, istack, fstack, sp):
+    idx = r.fp + r.code[r.pc]
+    r.pc += 1
+    sp += 1
+    istack[sp] = istack[idx]
+    fstack[sp] = fstack[idx]
+    return sp
+
+def op_set_local(r, istack, fstack, sp):
+    idx = r.fp + r.code[r.pc]
+    r.pc += 1
+    istack[idx] = istack[sp]
+    fstack[idx] = fstack[sp]
+    return sp - 1
+
+def op_tee_local(r, istack, fstack, sp):
+    idx = r.fp + r.code[r.pc]
+    r.pc += 1
+    istack[idx] = istack[sp]
+    fstack[idx] = fstack[sp]
+    return sp
+
+def op_get_global(r, istack, fstack, sp):
+    val = r.module.global_list[r.code[r.pc]]
+    r.pc += 1
+    sp += 1
+    istack[sp] = val[1]
+    fstack[sp] = val[2]
+    return sp
+
+def op_set_global(r, istack, fstack, sp):
+    gidx = r.code[r.pc]
+    r.pc += 1
+    gtype = r.module.global_list[gidx][0]
+    r.module.global_list[gidx] = (gtype, istack[sp], fstack[sp])
+    return sp - 1
+
+# Memory-related operators
+
+def op_i32_load(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp], 4)
+    istack[sp] = read_I32(r.memory.bytes, addr)
+    return sp
+
+def op_i64_load(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp], 8)
+    istack[sp] = read_I64(r.memory.bytes, addr)
+    return sp
+
+def op_f32_load(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp], 4)
+    fstack[sp] = read_F32(r.memory.bytes, addr)
+    return sp
+
+def op_f64_load(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp], 8)
+    fstack[sp] = read_F64(r.memory.bytes, addr)
+    return sp
+
+def op_load8_s(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp], 1)
+    istack[sp] = read_I8_s(r.memory.bytes, addr)
+    return sp
+
+def op_load8_u(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp], 1)
+    istack[sp] = read_I8_u(r.memory.bytes, addr)
+    return sp
+
+def op_load16_s(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp], 2)
+    istack[sp] = read_I16_s(r.memory.bytes, addr)
+    return sp
+
+def op_load16_u(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp], 2)
+    istack[sp] = read_I16_u(r.memory.bytes, addr)
+    return sp
+
+def op_i64_load32_s(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp], 4)
+    istack[sp] = read_I32_s(r.memory.bytes, addr)
+    return sp
+
+def op_store32(r, istack, fstack, sp):  # i32.store, i64.store32
+    addr = effective_addr(r, istack[sp-1], 4)
+    write_I32(r.memory.bytes, addr, istack[sp])
+    return sp - 2
+
+def op_i64_store(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp-1], 8)
+    write_I64(r.memory.bytes, addr, istack[sp])
+    return sp - 2
+
+def op_f32_store(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp-1], 4)
+    write_F32(r.memory.bytes, addr, fstack[sp])
+    return sp - 2
+
+def op_f64_store(r, istack, fstack, sp):
+    addr = effective_addr(r, istack[sp-1], 8)
+    write_F64(r.memory.bytes, addr, fstack[sp])
+    return sp - 2
+
+def op_store8(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp-1], 1)
+    write_I8(r.memory.bytes, addr, istack[sp])
+    return sp - 2
+
+def op_store16(r, istack, fstack, sp):  # i32/i64
+    addr = effective_addr(r, istack[sp-1], 2)
+    write_I16(r.memory.bytes, addr, istack[sp])
+    return sp - 2
+
+def op_current_memory(r, istack, fstack, sp):
+    sp += 1
+    istack[sp] = r.memory.pages
+    return sp
+
+def op_grow_memory(r, istack, fstack, sp):
+    istack[sp] = r.memory.grow(istack[sp])  # I32
+    return sp
+
+# Constants
+
+def op_i_const(r, istack, fstack, sp):  # i32/i64
+    sp += 1
+    istack[sp] = r.code[r.pc]
+    r.pc += 1
+    return sp
+
+def op_f_const(r, istack, fstack, sp):  # f32/f64
+    sp += 1
+    fstack[sp] = r.consts[r.code[r.pc]]
+    r.pc += 1
+    return sp
+
+# Comparison operators
+
+def op_eqz(r, istack, fstack, sp):  # i32/i64
+    istack[sp] = istack[sp] == 0
+    return sp
+
+def op_i_eq(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] == istack[sp+1]
+    return sp
+
+def op_i_ne(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] != istack[sp+1]
+    return sp
+
+def op_i32_lt_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp]) < int2int32(istack[sp+1])
+    return sp
+
+def op_i32_lt_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint32(istack[sp]) < int2uint32(istack[sp+1])
+    return sp
+
+def op_i32_gt_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp]) > int2int32(istack[sp+1])
+    return sp
+
+def op_i32_gt_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint32(istack[sp]) > int2uint32(istack[sp+1])
+    return sp
+
+def op_i32_le_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp]) <= int2int32(istack[sp+1])
+    return sp
+
+def op_i32_le_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint32(istack[sp]) <= int2uint32(istack[sp+1])
+    return sp
+
+def op_i32_ge_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp]) >= int2int32(istack[sp+1])
+    return sp
+
+def op_i32_ge_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint32(istack[sp]) >= int2uint32(istack[sp+1])
+    return sp
+
+def op_i64_lt_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp]) < int2int64(istack[sp+1])
+    return sp
+
+def op_i64_lt_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint64(istack[sp]) < int2uint64(istack[sp+1])
+    return sp
+
+def op_i64_gt_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp]) > int2int64(istack[sp+1])
+    return sp
+
+def op_i64_gt_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint64(istack[sp]) > int2uint64(istack[sp+1])
+    return sp
+
+def op_i64_le_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp]) <= int2int64(istack[sp+1])
+    return sp
+
+def op_i64_le_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint64(istack[sp]) <= int2uint64(istack[sp+1])
+    return sp
+
+def op_i64_ge_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp]) >= int2int64(istack[sp+1])
+    return sp
+
+def op_i64_ge_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint64(istack[sp]) >= int2uint64(istack[sp+1])
+    return sp
+
+def op_f_eq(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] == fstack[sp+1]
+    return sp
+
+def op_f_ne(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] != fstack[sp+1]
+    return sp
+
+def op_f_lt(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] < fstack[sp+1]
+    return sp
+
+def op_f_gt(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] > fstack[sp+1]
+    return sp
+
+def op_f_le(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] <= fstack[sp+1]
+    return sp
+
+def op_f_ge(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    istack[sp] = fstack[sp] >= fstack[sp+1]
+    return sp
+
+# Numeric operators
+
+def op_i32_clz(r, istack, fstack, sp):
+    count = 0
+    val = istack[sp]
+    while count < 32 and (val & 0x80000000) == 0:
+        count += 1
+        val = val * 2
+    istack[sp] = count
+    return sp
+
+def op_i32_ctz(r, istack, fstack, sp):
+    count = 0
+    val = istack[sp]
+    while count < 32 and (val % 2) == 0:
+        count += 1
+        val = val / 2
+    istack[sp] = count
+    return sp
+
+def op_i32_popcnt(r, istack, fstack, sp):
+    count = 0
+    val = istack[sp]
+    for i in range(32):
+        if 0x1 & val:
+            count += 1
+        val = val / 2
+    istack[sp] = count
+    return sp
+
+def op_i64_clz(r, istack, fstack, sp):
+    val = istack[sp]
+    if val < 0:
+        istack[sp] = 0
+    else:
+        count = 1
+        while count < 63 and (val & 0x4000000000000000) == 0:
+            count += 1
+            val = val * 2
+        istack[sp] = count
+    return sp
+
+def op_i64_ctz(r, istack, fstack, sp):
+    count = 0
+    val = istack[sp]
+    while count < 64 and (val % 2) == 0:
+        count += 1
+        val = val / 2
+    istack[sp] = count
+    return sp
+
+def op_i64_popcnt(r, istack, fstack, sp):
+    count = 0
+    val = istack[sp]
+    for i in range(64):
+        if 0x1 & val:
+            count += 1
+        val = val / 2
+    istack[sp] = count
+    return sp
+
+def op_f_abs(r, istack, fstack, sp):  # f32/f64
+    fstack[sp] = abs(fstack[sp])
+    return sp
+
+def op_f_neg(r, istack, fstack, sp):  # f32/f64
+    fstack[sp] = -fstack[sp]
+    return sp
+
+def op_i32_add(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp] + istack[sp+1])
+    return sp
+
+def op_i_sub(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] - istack[sp+1]
+    return sp
+
+def op_i32_mul(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp] * istack[sp+1])
+    return sp
+
+def op_i32_div_s(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    elif ai == 0x80000000 and bi == -1:
+        raise WAException("integer overflow")
+    istack[sp] = idiv_s(int2int32(ai), int2int32(bi))
+    return sp
+
+def op_i32_div_u(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = int2uint32(ai) / int2uint32(bi)
+    return sp
+
+def op_i32_rem_s(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = irem_s(int2int32(ai), int2int32(bi))
+    return sp
+
+def op_i32_rem_u(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = int2uint32(ai) % int2uint32(bi)
+    return sp
+
+def op_i_and(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] & istack[sp+1]
+    return sp
+
+def op_i_or(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] | istack[sp+1]
+    return sp
+
+def op_i_xor(r, istack, fstack, sp):  # i32/i64
+    sp -= 1
+    istack[sp] = istack[sp] ^ istack[sp+1]
+    return sp
+
+def op_i32_shl(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = istack[sp] << (istack[sp+1] % 0x20)
+    return sp
+
+def op_i32_shr_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int32(istack[sp]) >> (istack[sp+1] % 0x20)
+    return sp
+
+def op_i32_shr_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint32(istack[sp]) >> (istack[sp+1] % 0x20)
+    return sp
+
+def op_i64_add(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp] + istack[sp+1])
+    return sp
+
+def op_i64_mul(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp] * istack[sp+1])
+    return sp
+
+def op_i64_div_s(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = idiv_s(int2int64(ai), int2int64(bi))
+    return sp
+
+def op_i64_div_u(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    if ai < 0 and bi > 0:
+        istack[sp] = int2uint64(-ai) / int2uint64(bi)
+    elif ai > 0 and bi < 0:
+        istack[sp] = int2uint64(ai) / int2uint64(-bi)
+    else:
+        istack[sp] = int2uint64(ai) / int2uint64(bi)
+    return sp
+
+def op_i64_rem_s(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = irem_s(int2int64(ai), int2int64(bi))
+    return sp
+
+def op_i64_rem_u(r, istack, fstack, sp):
+    sp -= 1
+    ai, bi = istack[sp], istack[sp+1]
+    if bi == 0:
+        raise WAException("integer divide by zero")
+    istack[sp] = int2uint64(ai) % int2uint64(bi)
+    return sp
+
+def op_i64_shl(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = istack[sp] << (istack[sp+1] % 0x40)
+    return sp
+
+def op_i64_shr_s(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2int64(istack[sp]) >> (istack[sp+1] % 0x40)
+    return sp
+
+def op_i64_shr_u(r, istack, fstack, sp):
+    sp -= 1
+    istack[sp] = int2uint64(istack[sp]) >> (istack[sp+1] % 0x40)
+    return sp
+
+def op_f_add(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    fstack[sp] = fstack[sp] + fstack[sp+1]
+    return sp
+
+def op_f_sub(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    fstack[sp] = fstack[sp] - fstack[sp+1]
+    return sp
+
+def op_f_mul(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    fstack[sp] = fstack[sp] * fstack[sp+1]
+    return sp
+
+def op_f_div(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    fstack[sp] = fstack[sp] / fstack[sp+1]
+    return sp
+
+def op_f_min(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    if not fstack[sp] < fstack[sp+1]:
+        fstack[sp] = fstack[sp+1]
+    return sp
+
+def op_f_max(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    if not fstack[sp] > fstack[sp+1]:
+        fstack[sp] = fstack[sp+1]
+    return sp
+
+def op_f_copysign(r, istack, fstack, sp):  # f32/f64
+    sp -= 1
+    if fstack[sp+1] > 0:
+        fstack[sp] = abs(fstack[sp])
+    else:
+        fstack[sp] = -abs(fstack[sp])
+    return sp
+
+# Conversion operators
+
+def op_i32_wrap(r, istack, fstack, sp):  # also i64.extend_s/i32
+    istack[sp] = int2int32(istack[sp])
+    return sp
+
+def op_i32_trunc_s_f32(r, istack, fstack, sp):
+    af = fstack[sp]
+    if math.isnan(af):
+        raise WAException("invalid conversion to integer")
+    elif af > 2147483647.0:
+        raise WAException("integer overflow")
+    elif af < -2147483648.0:
+        raise WAException("integer overflow")
+    istack[sp] = int(af)
+    return sp
+
+def op_i64_extend_u(r, istack, fstack, sp):
+    istack[sp] = intmask(istack[sp])
+    return sp
+
+def op_i64_trunc_s_f64(r, istack, fstack, sp):
+    af = fstack[sp]
+    if math.isnan(af):
+        raise WAException("invalid conversion to integer")
+    istack[sp] = int(af)
+    return sp
+
+def op_i64_trunc_u_f64(r, istack, fstack, sp):
+    af = fstack[sp]
+    if math.isnan(af):
+        raise WAException("invalid conversion to integer")
+    elif af <= -1.0:
+        raise WAException("integer overflow")
+    istack[sp] = int(af)
+    return sp
+
+def op_f_convert_s(r, istack, fstack, sp):  # f32/f64 from i32/i64
+    fstack[sp] = float(istack[sp])
+    return sp
+
+def op_f_convert_u_i32(r, istack, fstack, sp):  # f32/f64
+    fstack[sp] = float(int2uint32(istack[sp]))
+    return sp
+
+def op_f_convert_u_i64(r, istack, fstack, sp):  # f32/f64
+    fstack[sp] = float(int2uint64(istack[sp]))
+    return sp
+
+def op_f64_promote(r, istack, fstack, sp):
+    return sp
+
+def op_i32_reinterpret(r, istack, fstack, sp):
+    istack[sp] = intmask(pack_f32(fstack[sp]))
+    return sp
+
+def op_i64_reinterpret(r, istack, fstack, sp):
+    istack[sp] = intmask(pack_f64(fstack[sp]))
+    return sp
+
+def op_f64_reinterpret(r, istack, fstack, sp):
+    fstack[sp] = unpack_f64(int2int64(istack[sp]))
+    return sp
+
+# Superinstructions (see optimize_function)
+
+def op_get_local2(r, istack, fstack, sp):
+    code, pc, fp = r.code, r.pc, r.fp
+    r.pc = pc + 2
+    istack[sp+1] = istack[fp+code[pc]]
+    fstack[sp+1] = fstack[fp+code[pc]]
+    istack[sp+2] = istack[fp+code[pc+1]]
+    fstack[sp+2] = fstack[fp+code[pc+1]]
+    return sp + 2
+
+def op_i32_add_locals(r, istack, fstack, sp):
+    code, pc, fp = r.code, r.pc, r.fp
+    r.pc = pc + 2
+    sp += 1
+    istack[sp] = int2int32(istack[fp+code[pc]] + istack[fp+code[pc+1]])
+    return sp
+
+def op_i32_add_local_const(r, istack, fstack, sp):
+    code, pc = r.code, r.pc
+    r.pc = pc + 2
+    sp += 1
+    istack[sp] = int2int32(istack[r.fp+code[pc]] + code[pc+1])
+    return sp
+
+def op_i32_load_local_const(r, istack, fstack, sp):
+    code, pc = r.code, r.pc
+    r.pc = pc + 2
+    base = int2int32(istack[r.fp+code[pc]] + code[pc+1])
+    addr = effective_addr(r, base, 4)
+    sp += 1
+    istack[sp] = read_I32(r.memory.bytes, addr)
+    return sp
+
+def op_i32_add_const(r, istack, fstack, sp):
+    istack[sp] = int2int32(istack[sp] + r.code[r.pc])
+    r.pc += 1
+    return sp
+
+def op_br_unless(r, istack, fstack, sp):  # i32.eqz.br_if
+    if not istack[sp]:  # I32
+        return branch(r, istack, fstack, sp-1, r.pc)
+    r.pc += 3
+    return sp - 1
+
+HANDLERS = [op_unrecognized] * 256
+for opcode, handler in [
+        (0x00, op_unreachable), (0x01, op_nop), (0x04, op_if),
+        (0x05, op_else), (0x0b, op_return), (0x0c, op_br),
+        (0x0d, op_br_if), (0x0e, op_br_table), (0x0f, op_return),
+        (0x10, op_call), (0x11, op_call_indirect),
+        (0x1a, op_drop), (0x1b, op_select),
+        (0x20, op_get_local), (0x21, op_set_local),
+        (0x22, op_tee_local), (0x23, op_get_global),
+        (0x24, op_set_global),
+        (0x28, op_i32_load), (0x29, op_i64_load),
+        (0x2a, op_f32_load), (0x2b, op_f64_load),
+        (0x2c, op_load8_s), (0x2d, op_load8_u),
+        (0x2e, op_load16_s), (0x2f, op_load16_u),
+        (0x30, op_load8_s), (0x31, op_load8_u),
+        (0x32, op_load16_s), (0x33, op_load16_u),
+        (0x34, op_i64_load32_s), (0x35, op_i32_load),
+        (0x36, op_store32), (0x37, op_i64_store),
+        (0x38, op_f32_store), (0x39, op_f64_store),
+        (0x3a, op_store8), (0x3b, op_store16),
+        (0x3c, op_store8), (0x3d, op_store16), (0x3e, op_store32),
+        (0x3f, op_current_memory), (0x40, op_grow_memory),
+        (0x41, op_i_const), (0x42, op_i_const),
+        (0x43, op_f_const), (0x44, op_f_const),
+        (0x45, op_eqz), (0x46, op_i_eq), (0x47, op_i_ne),
+        (0x48, op_i32_lt_s), (0x49, op_i32_lt_u),
+        (0x4a, op_i32_gt_s), (0x4b, op_i32_gt_u),
+        (0x4c, op_i32_le_s), (0x4d, op_i32_le_u),
+        (0x4e, op_i32_ge_s), (0x4f, op_i32_ge_u),
+        (0x50, op_eqz), (0x51, op_i_eq), (0x52, op_i_ne),
+        (0x53, op_i64_lt_s), (0x54, op_i64_lt_u),
+        (0x55, op_i64_gt_s), (0x56, op_i64_gt_u),
+        (0x57, op_i64_le_s), (0x58, op_i64_le_u),
+        (0x59, op_i64_ge_s), (0x5a, op_i64_ge_u),
+        (0x5b, op_f_eq), (0x5c, op_f_ne), (0x5d, op_f_lt),
+        (0x5e, op_f_gt), (0x5f, op_f_le), (0x60, op_f_ge),
+        (0x61, op_f_eq), (0x62, op_f_ne), (0x63, op_f_lt),
+        (0x64, op_f_gt), (0x65, op_f_le), (0x66, op_f_ge),
+        (0x67, op_i32_clz), (0x68, op_i32_ctz), (0x69, op_i32_popcnt),
+        (0x6a, op_i32_add), (0x6b, op_i_sub), (0x6c, op_i32_mul),
+        (0x6d, op_i32_div_s), (0x6e, op_i32_div_u),
+        (0x6f, op_i32_rem_s), (0x70, op_i32_rem_u),
+        (0x71, op_i_and), (0x72, op_i_or), (0x73, op_i_xor),
+        (0x74, op_i32_shl), (0x75, op_i32_shr_s),
+        (0x76, op_i32_shr_u),
+        (0x77, op_unimplemented), (0x78, op_unimplemented),
+        (0x79, op_i64_clz), (0x7a, op_i64_ctz), (0x7b, op_i64_popcnt),
+        (0x7c, op_i64_add), (0x7d, op_i_sub), (0x7e, op_i64_mul),
+        (0x7f, op_i64_div_s), (0x80, op_i64_div_u),
+        (0x81, op_i64_rem_s), (0x82, op_i64_rem_u),
+        (0x83, op_i_and), (0x84, op_i_or), (0x85, op_i_xor),
+        (0x86, op_i64_shl), (0x87, op_i64_shr_s),
+        (0x88, op_i64_shr_u),
+        (0x89, op_unimplemented), (0x8a, op_unimplemented),
+        (0x8b, op_f_abs), (0x8c, op_f_neg),
+        (0x92, op_f_add), (0x93, op_f_sub), (0x94, op_f_mul),
+        (0x95, op_f_div), (0x96, op_f_min), (0x97, op_f_max),
+        (0x98, op_f_copysign),
+        (0x99, op_f_abs), (0x9a, op_f_neg),
+        (0xa0, op_f_add), (0xa1, op_f_sub), (0xa2, op_f_mul),
+        (0xa3, op_f_div), (0xa4, op_f_min), (0xa5, op_f_max),
+        (0xa6, op_f_copysign),
+        (0xa7, op_i32_wrap), (0xa8, op_i32_trunc_s_f32),
+        (0xa9, op_unimplemented), (0xaa, op_unimplemented),
+        (0xab, op_unimplemented),
+        (0xac, op_i32_wrap), (0xad, op_i64_extend_u),
+        (0xae, op_unimplemented), (0xaf, op_unimplemented),
+        (0xb0, op_i64_trunc_s_f64), (0xb1, op_i64_trunc_u_f64),
+        (0xb2, op_f_convert_s), (0xb3, op_f_convert_u_i32),
+        (0xb4, op_f_convert_s), (0xb5, op_f_convert_u_i64),
+        (0xb6, op_unimplemented),
+        (0xb7, op_f_convert_s), (0xb8, op_f_convert_u_i32),
+        (0xb9, op_f_convert_s), (0xba, op_f_convert_u_i64),
+        (0xbb, op_f64_promote),
+        (0xbc, op_i32_reinterpret), (0xbd, op_i64_reinterpret),
+        (0xbe, op_unimplemented), (0xbf, op_f64_reinterpret),
+        (0xc0, op_get_local2), (0xc1, op_i32_add_locals),
+        (0xc2, op_i32_add_local_const),
+        (0xc3, op_i32_load_local_const),
+        (0xc4, op_i32_add_const), (0xc5, op_br_unless)]:
+    HANDLERS[opcode] = handler
+
+
+######################################
+# Register interpreter
+######################################
+
+# The register engine runs a register form of each function instead of
+# the decoded stack code. Operand stack heights are static so every
+# stack slot can be named by its position relative to fp (the locals
+# come first, then stack height h lives at local count + h).
+# translate_registers turns func.code into func.reg_code where each
+# instruction names the slots it reads and writes:
+#   - get_local emits nothing, later operators read the local's slot
+#   - set_local/tee_local retarget the operator that computed the
+#     value to write the local directly where possible
+#   - other stack values live in their own slot and are moved there
+#     ("flushed") before labels, branches and calls which expect them
+#     in place
+# Instructions are the opcode followed by slot operands (d is the
+# destination, a/b/c sources):
+#   - numeric operators: op d a [b], constants: op d value/const idx
+#   - loads: op d a offset, stores: op a b offset
+#   - 0xc4 (i32.const.i32.add): d a value
+#   - 0xd0 move: d a
+#   - 0xd1/0xd2 unary/binary operators run with their HANDLERS entry:
+#     op d a [b]
+#   - if: a target, br: target a base, br_if/0xc5: a target b base and
+#     br_table: a b count (target base)*(count+1) where b is the slot
+#     of the branch value (-1 if none) and base the slot it moves to
+#   - call: fidx top and call_indirect: tidx a top where top is the
+#     slot of the last argument (the results start there)
+#   - return (and the final end): a (-1 if no result)
+
+# Operators the register interpreter runs directly; any other unary
+# or binary operator goes through its HANDLERS entry
+REG_BINARY = [0x46, 0x47, 0x48, 0x49, 0x4a, 0x4b, 0x4c, 0x4d, 0x4e,
+              0x4f, 0x6a, 0x6b, 0x6c, 0x71, 0x72, 0x73, 0x74, 0x75,
+              0x76, 0x7c, 0x7d, 0x92, 0x93, 0x94, 0xa0, 0xa1, 0xa2]
+
+class RegTranslator():
+    def __init__(self, local_cnt):
+        self.local_cnt = local_cnt
+        self.code = []
+        self.slots = []     # slot holding each stack value
+        self.last_dst = -1  # code index of the last retargetable d
+
+    def emit(self, ops):
+        self.code.extend(ops)
+        self.last_dst = -1
+
+    # Emit an operator writing to the slot of a new stack value that a
+    # following set_local may retarget
+    def emit_def(self, opcode, operands):
+        d = self.local_cnt + len(self.slots)
+        self.code.append(opcode)
+        self.last_dst = len(self.code)
+        self.code.append(d)
+        self.code.extend(operands)
+        self.slots.append(d)
+
+    def pop(self):
+        return self.slots.pop()
+
+    # Move the stack values from height start up into their own slots
+    def flush(self, start):
+        for h in range(start, len(self.slots)):
+            slot = self.local_cnt + h
+            if self.slots[h] != slot:
+                self.emit([0xd0, slot, self.slots[h]])
+                self.slots[h] = slot
+
+    # Move stack values that read local idx before it is written
+    def spill_local(self, idx):
+        for h in range(len(self.slots)):
+            if self.slots[h] == idx:
+                slot = self.local_cnt + h
+                self.emit([0xd0, slot, idx])
+                self.slots[h] = slot
+
+    def set_local(self, idx, tee):
+        src = self.slots[-1]
+        aliased = False
+        for h in range(len(self.slots)-1):
+            if self.slots[h] == idx:
+                aliased = True
+        if (self.last_dst >= 0 and not aliased and
+                self.code[self.last_dst] == src):
+            # Compute the value straight into the local
+            self.code[self.last_dst] = idx
+            self.last_dst = -1
+            self.slots[-1] = idx
+        elif src != idx:
+            self.spill_local(idx)
+            self.emit([0xd0, idx, src])
+            if tee:
+                self.slots[-1] = idx
+        if not tee:
+            self.pop()
+
+# Translate the decoded code of func into func.reg_code (see above)
+def translate_registers(func, function, types):
+    code = func.code
+    local_cnt = len(func.type.params) + len(func.locals)
+    heights, _ = stack_heights(func, function, types)
+    targets = {}
+    pc = 0
+    while pc < len(code):
+        for i in decoded_targets(code, pc):
+            targets[code[pc+i]] = True
+        pc, _ = decoded_immediates(code, pc)
+
+    t = RegTranslator(local_cnt)
+    addr_map = {}  # {decoded pc: register code pc, ...}
+    fixups = []    # [(register code index, decoded target), ...]
+    live = True
+    pc = 0
+    while pc < len(code):
+        opcode = code[pc]
+        next_pc, imms = decoded_immediates(code, pc)
+        if pc in targets and pc in heights:
+            # Values arrive in their own slots from every branch
+            if live:
+                t.flush(0)
+            live = True
+            t.slots = [local_cnt + h for h in range(heights[pc])]
+            t.last_dst = -1
+        if not live or pc not in heights:
+            pc = next_pc
+            continue
+        assert len(t.slots) == heights[pc]
+        addr_map[pc] = len(t.code)
+
+        if   0x00 == opcode:  # unreachable
+            t.emit([0x00])
+            live = False
+        elif 0x04 == opcode:  # if
+            a = t.pop()
+            t.flush(0)
+            fixups.append((len(t.code)+2, imms[0]))
+            t.emit([0x04, a, 0])
+        elif 0x05 == opcode:  # else
+            t.flush(0)
+            fixups.append((len(t.code)+1, imms[0]))
+            t.emit([0x0c, 0, -1, 0])
+            live = False
+        elif opcode in (0x0b, 0x0f):  # end (of function), return
+            a = -1
+            if len(func.type.results) > 0:
+                a = t.slots[-1]
+            t.emit([0x0f, a])
+            live = False
+        elif 0x0c == opcode:  # br
+            target, arity, base = imms
+            b = -1
+            if arity:
+                b = t.slots[-1]
+            t.flush(0)
+            fixups.append((len(t.code)+1, target))
+            t.emit([0x0c, 0, b, base])
+            live = False
+        elif opcode in (0x0d, 0xc5):  # br_if, i32.eqz.br_if
+            target, arity, base = imms
+            a = t.pop()
+            b = -1
+            if arity:
+                b = t.slots[-1]
+            t.flush(0)
+            fixups.append((len(t.code)+2, target))
+            t.emit([opcode, a, 0, b, base])
+        elif 0x0e == opcode:  # br_table
+            count = imms[0]
+            a = t.pop()
+            b = -1
+            if imms[2]:
+                b = t.slots[-1]
+            t.flush(0)
+            ops = [0x0e, a, b, count]
+            for i in range(count+1):
+                fixups.append((len(t.code)+len(ops), imms[1+3*i]))
+                ops.append(0)
+                ops.append(imms[3+3*i])
+            t.emit(ops)
+            live = False
+        elif 0x10 == opcode:  # call
+            ftype = function[imms[0]].type
+            t.flush(len(t.slots) - len(ftype.params))
+            top = local_cnt + len(t.slots) - 1
+            for i in range(len(ftype.params)):
+                t.pop()
+            t.emit([0x10, imms[0], top])
+            for i in range(len(ftype.results)):
+                t.slots.append(local_cnt + len(t.slots))
+        elif 0x11 == opcode:  # call_indirect
+            ftype = types[imms[0]]
+            a = t.pop()
+            t.flush(len(t.slots) - len(ftype.params))
+            top = local_cnt + len(t.slots) - 1
+            for i in range(len(ftype.params)):
+                t.pop()
+            t.emit([0x11, imms[0], a, top])
+            for i in range(len(ftype.results)):
+                t.slots.append(local_cnt + len(t.slots))
+        elif 0x1a == opcode:  # drop
+            t.pop()
+        elif 0x1b == opcode:  # select
+            c = t.pop()
+            b = t.pop()
+            a = t.pop()
+            t.emit_def(0x1b, [a, b, c])
+        elif 0x20 == opcode:  # get_local
+            t.slots.append(imms[0])
+            t.last_dst = -1
+        elif opcode in (0x21, 0x22):  # set_local, tee_local
+            t.set_local(imms[0], 0x22 == opcode)
+        elif 0x23 == opcode:  # get_global
+            t.emit_def(0x23, [imms[0]])
+        elif 0x24 == opcode:  # set_global
+            t.emit([0x24, t.pop(), imms[0]])
+        elif 0x28 <= opcode <= 0x35:  # loads
+            t.emit_def(opcode, [t.pop(), imms[0]])
+        elif 0x36 <= opcode <= 0x3e:  # stores
+            b = t.pop()
+            a = t.pop()
+            t.emit([opcode, a, b, imms[0]])
+        elif 0x3f == opcode:  # current_memory
+            t.emit_def(0x3f, [])
+        elif 0x40 == opcode:  # grow_memory
+            t.emit_def(0x40, [t.pop()])
+        elif 0x41 <= opcode <= 0x44:  # constants
+            t.emit_def(opcode, [imms[0]])
+        elif 0xc0 == opcode:  # get_local.get_local
+            t.slots.append(imms[0])
+            t.slots.append(imms[1])
+            t.last_dst = -1
+        elif 0xc1 == opcode:  # get_local.get_local.i32.add
+            t.emit_def(0x6a, [imms[0], imms[1]])
+        elif 0xc2 == opcode:  # get_local.i32.const.i32.add
+            t.emit_def(0xc4, [imms[0], imms[1]])
+        elif 0xc3 == opcode:  # get_local.i32.const.i32.add.i32.load
+            t.emit_def(0xc4, [imms[0], imms[1]])
+            t.emit_def(0x28, [t.pop(), imms[2]])
+        elif 0xc4 == opcode:  # i32.const.i32.add
+            t.emit_def(0xc4, [t.pop(), imms[0]])
+        elif 0x01 == opcode:  # nop
+            pass
+        else:
+            pops, pushes = stack_effect(opcode)
+            if 2 == pops:
+                b = t.pop()
+                a = t.pop()
+                if opcode in REG_BINARY:
+                    t.emit_def(opcode, [a, b])
+                else:
+                    d = local_cnt + len(t.slots)
+                    t.emit([0xd2, opcode, d, a, b])
+                    t.slots.append(d)
+            else:
+                a = t.pop()
+                if opcode in (0x45, 0x50):  # i32.eqz, i64.eqz
+                    t.emit_def(0x45, [a])
+                else:
+                    d = local_cnt + len(t.slots)
+                    t.emit([0xd1, opcode, d, a])
+                    t.slots.append(d)
+        pc = next_pc
+
+    for idx, target in fixups:
+        t.code[idx] = addr_map[target]
+    func.reg_code = t.code
+    if DEBUG:
+        debug("  function 0x%x: %d decoded, %d register code entries" % (
+            func.index, len(code), len(t.code)))
+    return func
+
+# Store or load sized values for the register engine
+def reg_load(opcode, bytes, addr, istack, fstack, d):
+    if   0x28 == opcode or 0x35 == opcode:  # i32.load, i64.load32_u
+        istack[d] = read_I32(bytes, addr)
+    elif 0x29 == opcode:  # i64.load
+        istack[d] = read_I64(bytes, addr)
+    elif 0x2a == opcode:  # f32.load
+        fstack[d] = read_F32(bytes, addr)
+    elif 0x2b == opcode:  # f64.load
+        fstack[d] = read_F64(bytes, addr)
+    elif 0x2c == opcode or 0x30 == opcode:  # load8_s
+        istack[d] = read_I8_s(bytes, addr)
+    elif 0x2d == opcode or 0x31 == opcode:  # load8_u
+        istack[d] = read_I8_u(bytes, addr)
+    elif 0x2e == opcode or 0x32 == opcode:  # load16_s
+        istack[d] = read_I16_s(bytes, addr)
+    elif 0x2f == opcode or 0x33 == opcode:  # load16_u
+        istack[d] = read_I16_u(bytes, addr)
+    else:  # i64.load32_s
+        istack[d] = read_I32_s(bytes, addr)
+
+def reg_store(opcode, bytes, addr, istack, fstack, b):
+    if   0x36 == opcode or 0x3e == opcode:  # i32.store, i64.store32
+        write_I32(bytes, addr, istack[b])
+    elif 0x37 == opcode:  # i64.store
+        write_I64(bytes, addr, istack[b])
+    elif 0x38 == opcode:  # f32.store
+        write_F32(bytes, addr, fstack[b])
+    elif 0x39 == opcode:  # f64.store
+        write_F64(bytes, addr, fstack[b])
+    elif 0x3a == opcode or 0x3c == opcode:  # store8
+        write_I8(bytes, addr, istack[b])
+    else:  # store16
+        write_I16(bytes, addr, istack[b])
+
+# Keep the branch value (slot b, -1 if none) in slot base. Returns the
+# new sp.
+def reg_branch(istack, fstack, fp, b, base):
+    if b < 0:
+        return fp + base - 1
+    istack[fp+base] = istack[fp+b]
+    fstack[fp+base] = fstack[fp+b]
+    return fp + base
+
+# HANDLERS entry of a 0xd1/0xd2 operator. The fallback handlers for
+# operators without an implementation read the table engine's
+# Registers, so trap for those here instead.
+def reg_handler(opcode):
+    handler = HANDLERS[opcode]
+    if handler is op_unrecognized:
+        raise WAException("unrecognized opcode 0x%x" % opcode)
+    if handler is op_unimplemented:
+        raise WAException("%s(0x%x) unimplemented" % (
+            OPERATOR_INFO[opcode][0], opcode))
+    return handler
+
+def interpret_register(module,
+        pc, func,
+        memory, sp, istack, fstack, fp, csp, callstack):
+    code = func.reg_code
+    while True:
+        opcode = code[pc]
+        if TRACE:
+            info("    fn%d 0x%x <0x%x> %s" % (func.index, pc, opcode,
+                ",".join([str(i) for i in code[pc+1:pc+6]])))
+
+        if   0xd0 == opcode:  # move
+            d, a = fp + code[pc+1], fp + code[pc+2]
+            istack[d] = istack[a]
+            fstack[d] = fstack[a]
+            pc += 3
+        elif 0xc4 == opcode:  # i32.const.i32.add
+            istack[fp+code[pc+1]] = int2int32(istack[fp+code[pc+2]] +
+                                              code[pc+3])
+            pc += 4
+        elif 0x6a == opcode:  # i32.add
+            istack[fp+code[pc+1]] = int2int32(istack[fp+code[pc+2]] +
+                                              istack[fp+code[pc+3]])
+            pc += 4
+        elif 0x0d == opcode or 0xc5 == opcode:  # br_if, i32.eqz.br_if
+            cond = istack[fp+code[pc+1]] != 0  # I32
+            if 0xc5 == opcode:
+                cond = not cond
+            if cond:
+                sp = reg_branch(istack, fstack, fp, code[pc+3],
+                        code[pc+4])
+                pc = code[pc+2]
+            else:
+                pc += 5
+        elif 0x0c == opcode:  # br
+            sp = reg_branch(istack, fstack, fp, code[pc+2], code[pc+3])
+            pc = code[pc+1]
+        elif 0x41 == opcode or 0x42 == opcode:  # i32.const, i64.const
+            istack[fp+code[pc+1]] = code[pc+2]
+            pc += 3
+        elif 0x43 == opcode or 0x44 == opcode:  # f32.const, f64.const
+            fstack[fp+code[pc+1]] = func.consts[code[pc+2]]
+            pc += 3
+        elif 0x45 <= opcode <= 0x4f:  # i32 comparisons, eqz
+            d = fp + code[pc+1]
+            ai = istack[fp+code[pc+2]]
+            if 0x45 == opcode:  # i32.eqz, i64.eqz
+                istack[d] = ai == 0
+                pc += 3
+                continue
+            bi = istack[fp+code[pc+3]]
+            pc += 4
+            if   0x46 == opcode:  # i32.eq
+                istack[d] = ai == bi
+            elif 0x47 == opcode:  # i32.ne
+                istack[d] = ai != bi
+            elif 0x48 == opcode:  # i32.lt_s
+                istack[d] = int2int32(ai) < int2int32(bi)
+            elif 0x49 == opcode:  # i32.lt_u
+                istack[d] = int2uint32(ai) < int2uint32(bi)
+            elif 0x4a == opcode:  # i32.gt_s
+                istack[d] = int2int32(ai) > int2int32(bi)
+            elif 0x4b == opcode:  # i32.gt_u
+                istack[d] = int2uint32(ai) > int2uint32(bi)
+            elif 0x4c == opcode:  # i32.le_s
+                istack[d] = int2int32(ai) <= int2int32(bi)
+            elif 0x4d == opcode:  # i32.le_u
+                istack[d] = int2uint32(ai) <= int2uint32(bi)
+            elif 0x4e == opcode:  # i32.ge_s
+                istack[d] = int2int32(ai) >= int2int32(bi)
+            else:  # i32.ge_u
+                istack[d] = int2uint32(ai) >= int2uint32(bi)
+        elif 0x6b <= opcode <= 0x7d:  # i32 and i64 arithmetic
+            d = fp + code[pc+1]
+            ai, bi = istack[fp+code[pc+2]], istack[fp+code[pc+3]]
+            pc += 4
+            if   0x6b == opcode or 0x7d == opcode:  # i32.sub, i64.sub
+                istack[d] = ai - bi
+            elif 0x6c == opcode:  # i32.mul
+                istack[d] = int2int32(ai * bi)
+            elif 0x71 == opcode:  # i32.and
+                istack[d] = ai & bi
+            elif 0x72 == opcode:  # i32.or
+                istack[d] = ai | bi
+            elif 0x73 == opcode:  # i32.xor
+                istack[d] = ai ^ bi
+            elif 0x74 == opcode:  # i32.shl
+                istack[d] = ai << (bi % 0x20)
+            elif 0x75 == opcode:  # i32.shr_s
+                istack[d] = int2int32(ai) >> (bi % 0x20)
+            elif 0x76 == opcode:  # i32.shr_u
+                istack[d] = int2uint32(ai) >> (bi % 0x20)
+            else:  # i64.add
+                istack[d] = int2int64(ai + bi)
+        elif 0x92 <= opcode <= 0xa2:  # f32/f64 add, sub, mul
+            d = fp + code[pc+1]
+            af, bf = fstack[fp+code[pc+2]], fstack[fp+code[pc+3]]
+            pc += 4
+            if 0x92 == opcode or 0xa0 == opcode:
+                fstack[d] = af + bf
+            elif 0x93 == opcode or 0xa1 == opcode:
+                fstack[d] = af - bf
+            else:
+                fstack[d] = af * bf
+        elif 0x28 <= opcode <= 0x35:  # loads
+            addr = istack[fp+code[pc+2]] + code[pc+3]  # I32
+            assert addr >= 0
+            if bound_violation(opcode, addr, memory.pages):
+                raise WAException("out of bounds memory access")
+            reg_load(opcode, memory.bytes, addr, istack, fstack,
+                    fp+code[pc+1])
+            pc += 4
+        elif 0x36 <= opcode <= 0x3e:  # stores
+            addr = istack[fp+code[pc+1]] + code[pc+3]  # I32
+            assert addr >= 0
+            if bound_violation(opcode, addr, memory.pages):
+                raise WAException("out of bounds memory access")
+            reg_store(opcode, memory.bytes, addr, istack, fstack,
+                    fp+code[pc+2])
+            pc += 4
+        elif 0xd1 == opcode or 0xd2 == opcode:  # via HANDLERS
+            d, a = fp + code[pc+2], fp + code[pc+3]
+            istack[d] = istack[a]
+            fstack[d] = fstack[a]
+            if 0xd2 == opcode:
+                b = fp + code[pc+4]
+                istack[d+1] = istack[b]
+                fstack[d+1] = fstack[b]
+                reg_handler(code[pc+1])(None, istack, fstack, d+1)
+                pc += 5
+            else:
+                reg_handler(code[pc+1])(None, istack, fstack, d)
+                pc += 4
+        elif 0x04 == opcode:  # if
+            if istack[fp+code[pc+1]]:  # I32
+                pc += 3
+            else:
+                pc = code[pc+2]
+        elif 0x0e == opcode:  # br_table
+            count = code[pc+3]
+            didx = istack[fp+code[pc+1]]  # I32
+            if didx < 0 or didx >= count:
+                didx = count  # default
+            tpc = pc + 4 + 2*didx
+            sp = reg_branch(istack, fstack, fp, code[pc+2], code[tpc+1])
+            pc = code[tpc]
+        elif 0x10 == opcode or 0x11 == opcode:  # call, call_indirect
+            if 0x10 == opcode:
+                callee = get_function(module.function, code[pc+1])
+                sp = fp + code[pc+2]
+                pc += 3
+            else:
+                fidx = get_from_table(module.table, ANYFUNC,
+                        istack[fp+code[pc+2]])  # I32
+                callee = get_function(module.function, fidx)
+                if not same_signature(callee.type, module.type[code[pc+1]]):
+                    raise WAException("indirect call signature mismatch")
+                sp = fp + code[pc+3]
+                pc += 4
+            if isinstance(callee, FunctionImport):
+                sp = do_call_import(istack, fstack, sp, memory,
+                        module.imports, callee)
+            else:
+                assert isinstance(callee, Function)
+                sp = do_call(istack, fstack, callstack, sp, fp, csp,
+                        callee, pc, func)
+                csp += 1
+                fp = callstack[csp].sp + 1
+                func = callee
+                code = func.reg_code
+                pc = 0
+        elif 0x0f == opcode:  # return
+            a = code[pc+1]
+            if a >= 0:
+                sp = fp + a
+            frame = callstack[csp]
+            sp = do_return(istack, fstack, frame, sp)
+            fp = frame.fp
+            csp -= 1
+            if csp == -1 or frame.caller is None:
+                return sp
+            pc = frame.ra
+            func = frame.caller
+            code = func.reg_code
+        elif 0x1b == opcode:  # select
+            d = fp + code[pc+1]
+            if istack[fp+code[pc+4]]:  # I32
+                a = fp + code[pc+2]
+            else:
+                a = fp + code[pc+3]
+            istack[d] = istack[a]
+            fstack[d] = fstack[a]
+            pc += 5
+        elif 0x23 == opcode:  # get_global
+            val = module.global_list[code[pc+2]]
+            istack[fp+code[pc+1]] = val[1]
+            fstack[fp+code[pc+1]] = val[2]
+            pc += 3
+        elif 0x24 == opcode:  # set_global
+            a = fp + code[pc+1]
+            gidx = code[pc+2]
+            gtype = module.global_list[gidx][0]
+            module.global_list[gidx] = (gtype, istack[a], fstack[a])
+            pc += 3
+        elif 0x3f == opcode:  # current_memory
+            istack[fp+code[pc+1]] = memory.pages
+            pc += 2
+        elif 0x40 == opcode:  # grow_memory
+            istack[fp+code[pc+1]] = memory.grow(istack[fp+code[pc+2]])
+            pc += 3
+        elif 0x00 == opcode:  # unreachable
+            raise WAException("unreachable")
+        else:
+            raise WAException("unrecognized register opcode 0x%x" % opcode)
+
+
+######################################
+# Closure compiler
+######################################
+
+# The closure engine (CPython only) compiles each function, the first
+# time an Instance calls it, into basic blocks of pre-bound Python
+# closures. Validation guarantees that the operand stack height at
+# every reachable instruction is static, so each closure is bound to
+# the stack slots (relative to fp) it reads and writes along with its
+# decoded immediates and only takes fp as an argument. A block runs
+# its closures followed by its terminator which returns the index of
+# the next block, or CALL/RETURN for interpret_closure to switch
+# frames.
+
+CALL   = -1
+RETURN = -2
+
+class ClosureState():
+    def __init__(self):
+        self.sp = -1        # sp at a call or return
+        self.callee = None  # Function being called
+        self.ra = 0         # block to continue at after the call
+
+MEMORY_READ = { 0x28 : read_I32,  0x29 : read_I64,
+                0x2a : read_F32,  0x2b : read_F64,
+                0x2c : read_I8_s, 0x2d : read_I8_u,
+                0x2e : read_I16_s, 0x2f : read_I16_u,
+                0x30 : read_I8_s, 0x31 : read_I8_u,
+                0x32 : read_I16_s, 0x33 : read_I16_u,
+                0x34 : read_I32_s, 0x35 : read_I32 }
+
+MEMORY_WRITE = { 0x36 : write_I32, 0x37 : write_I64,
+                 0x38 : write_F32, 0x39 : write_F64,
+                 0x3a : write_I8,  0x3b : write_I16,
+                 0x3c : write_I8,  0x3d : write_I16,
+                 0x3e : write_I32 }
+
+# Operand stack height (above the locals) before each reachable
+# instruction of func and the start of each basic block. Code after
+# br, br_table, else, return and unreachable is only reachable if an
+# earlier branch targets it.
+def stack_heights(func, function, types):
+    code = func.code
+    local_cnt = len(func.type.params) + len(func.locals)
+    heights = {0: 0}
+    leaders = {0: True}
+    pc = 0
+    h = 0
+    live = True
+    while pc < len(code):
+        opcode = code[pc]
+        next_pc, _ = decoded_immediates(code, pc)
+        if not live:
+            if pc not in heights:
+                pc = next_pc
+                continue
+            h = heights[pc]
+            live = True
+        heights[pc] = h
+        if opcode in (0x00, 0x0b, 0x0f):  # unreachable, end, return
+            live = False
+        elif 0x04 == opcode:  # if
+            h -= 1
+            heights[code[pc+1]] = h
+            leaders[code[pc+1]] = True
+        elif 0x05 == opcode:  # else
+            heights[code[pc+1]] = h
+            leaders[code[pc+1]] = True
+            live = False
+        elif opcode in (0x0c, 0x0d, 0x0e, 0xc5):  # br, br_if, br_table
+            if 0x0c == opcode:
+                tpcs = [pc+1]
+                live = False
+            elif opcode in (0x0d, 0xc5):  # br_if, i32.eqz.br_if
+                h -= 1
+                tpcs = [pc+1]
+            else:
+                h -= 1
+                tpcs = [pc+2+3*i for i in range(code[pc+1]+1)]
+                live = False
+            for tpc in tpcs:
+                target = code[tpc]
+                heights[target] = code[tpc+2] - local_cnt + code[tpc+1]
+                leaders[target] = True
+        elif 0x10 == opcode:  # call
+            callee = function[code[pc+1]]
+            t = callee.type
+            h += len(t.results) - len(t.params)
+            if isinstance(callee, Function):
+                leaders[next_pc] = True
+        elif 0x11 == opcode:  # call_indirect
+            t = types[code[pc+1]]
+            h += len(t.results) - len(t.params) - 1
+            leaders[next_pc] = True
+        else:
+            pops, pushes = stack_effect(opcode)
+            h += pushes - pops
+        if not live or opcode in (0x04, 0x0d, 0xc5):
+            leaders[next_pc] = True
+        pc = next_pc
+    return heights, leaders
+
+# Closure for one straight-line instruction at pc with the top of the
+# operand stack at slot fp+t. Returns None for instructions that only
+# move sp (which is static).
+def closure_op(module, func, pc, t):
+    code = func.code
+    opcode = code[pc]
+    istack = module.istack
+    fstack = module.fstack
+    memory = module.memory
+
+    if opcode in (0x01, 0x1a):  # nop, drop
+        return None
+    elif 0x1b == opcode:  # select
+        def op(fp):
+            if not istack[fp+t]:
+                istack[fp+t-2] = istack[fp+t-1]
+                fstack[fp+t-2] = fstack[fp+t-1]
+    elif 0x20 == opcode:  # get_local
+        src = code[pc+1]
+        def op(fp):
+            istack[fp+t+1] = istack[fp+src]
+            fstack[fp+t+1] = fstack[fp+src]
+    elif opcode in (0x21, 0x22):  # set_local, tee_local
+        dst = code[pc+1]
+        def op(fp):
+            istack[fp+dst] = istack[fp+t]
+            fstack[fp+dst] = fstack[fp+t]
+    elif 0x23 == opcode:  # get_global
+        global_list = module.global_list
+        gidx = code[pc+1]
+        def op(fp):
+            val = global_list[gidx]
+            istack[fp+t+1] = val[1]
+            fstack[fp+t+1] = val[2]
+    elif 0x24 == opcode:  # set_global
+        global_list = module.global_list
+        gidx = code[pc+1]
+        gtype = global_list[gidx][0]
+        def op(fp):
+            global_list[gidx] = (gtype, istack[fp+t], fstack[fp+t])
+    elif 0x28 <= opcode <= 0x35:  # loads
+        offset = code[pc+1]
+        size = LOAD_SIZE[opcode]
+        read = MEMORY_READ[opcode]
+        if opcode in (0x2a, 0x2b):
+            dest = fstack
+        else:
+            dest = istack
+        def op(fp):
+            addr = istack[fp+t] + offset
+            assert addr >= 0
+            if addr + size > memory.pages*(2**16):
+                raise WAException("out of bounds memory access")
+            dest[fp+t] = read(memory.bytes, addr)
+    elif 0x36 <= opcode <= 0x3e:  # stores
+        offset = code[pc+1]
+        size = LOAD_SIZE[opcode]
+        write = MEMORY_WRITE[opcode]
+        if opcode in (0x38, 0x39):
+            src = fstack
+        else:
+            src = istack
+        def op(fp):
+            addr = istack[fp+t-1] + offset
+            assert addr >= 0
+            if addr + size > memory.pages*(2**16):
+                raise WAException("out of bounds memory access")
+            write(memory.bytes, addr, src[fp+t])
+    elif 0x3f == opcode:  # current_memory
+        def op(fp):
+            istack[fp+t+1] = memory.pages
+    elif 0x40 == opcode:  # grow_memory
+        def op(fp):
+            istack[fp+t] = memory.grow(istack[fp+t])
+    elif opcode in (0x41, 0x42):  # i32.const, i64.const
+        val = code[pc+1]
+        def op(fp):
+            istack[fp+t+1] = val
+    elif opcode in (0x43, 0x44):  # f32.const, f64.const
+        val = func.consts[code[pc+1]]
+        def op(fp):
+            fstack[fp+t+1] = val
+    elif opcode in (0x45, 0x50):  # i32.eqz, i64.eqz
+        def op(fp):
+            istack[fp+t] = istack[fp+t] == 0
+    elif opcode in (0x46, 0x51):  # i32.eq, i64.eq
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] == istack[fp+t]
+    elif opcode in (0x47, 0x52):  # i32.ne, i64.ne
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] != istack[fp+t]
+    elif 0x48 == opcode:  # i32.lt_s
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1]) < int2int32(istack[fp+t])
+    elif 0x49 == opcode:  # i32.lt_u
+        def op(fp):
+            istack[fp+t-1] = int2uint32(istack[fp+t-1]) < int2uint32(istack[fp+t])
+    elif 0x4a == opcode:  # i32.gt_s
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1]) > int2int32(istack[fp+t])
+    elif 0x4b == opcode:  # i32.gt_u
+        def op(fp):
+            istack[fp+t-1] = int2uint32(istack[fp+t-1]) > int2uint32(istack[fp+t])
+    elif 0x4c == opcode:  # i32.le_s
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1]) <= int2int32(istack[fp+t])
+    elif 0x4e == opcode:  # i32.ge_s
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1]) >= int2int32(istack[fp+t])
+    elif opcode in (0x5b, 0x61):  # f32.eq, f64.eq
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] == fstack[fp+t]
+    elif opcode in (0x5c, 0x62):  # f32.ne, f64.ne
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] != fstack[fp+t]
+    elif opcode in (0x5d, 0x63):  # f32.lt, f64.lt
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] < fstack[fp+t]
+    elif opcode in (0x5e, 0x64):  # f32.gt, f64.gt
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] > fstack[fp+t]
+    elif opcode in (0x5f, 0x65):  # f32.le, f64.le
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] <= fstack[fp+t]
+    elif opcode in (0x60, 0x66):  # f32.ge, f64.ge
+        def op(fp):
+            istack[fp+t-1] = fstack[fp+t-1] >= fstack[fp+t]
+    elif 0x6a == opcode:  # i32.add
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1] + istack[fp+t])
+    elif opcode in (0x6b, 0x7d):  # i32.sub, i64.sub
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] - istack[fp+t]
+    elif 0x6c == opcode:  # i32.mul
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1] * istack[fp+t])
+    elif opcode in (0x71, 0x83):  # i32.and, i64.and
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] & istack[fp+t]
+    elif opcode in (0x72, 0x84):  # i32.or, i64.or
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] | istack[fp+t]
+    elif opcode in (0x73, 0x85):  # i32.xor, i64.xor
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] ^ istack[fp+t]
+    elif 0x74 == opcode:  # i32.shl
+        def op(fp):
+            istack[fp+t-1] = istack[fp+t-1] << (istack[fp+t] % 0x20)
+    elif 0x75 == opcode:  # i32.shr_s
+        def op(fp):
+            istack[fp+t-1] = int2int32(istack[fp+t-1]) >> (istack[fp+t] % 0x20)
+    elif 0x76 == opcode:  # i32.shr_u
+        def op(fp):
+            istack[fp+t-1] = int2uint32(istack[fp+t-1]) >> (istack[fp+t] % 0x20)
+    elif 0x7c == opcode:  # i64.add
+        def op(fp):
+            istack[fp+t-1] = int2int64(istack[fp+t-1] + istack[fp+t])
+    elif opcode in (0x92, 0xa0):  # f32.add, f64.add
+        def op(fp):
+            fstack[fp+t-1] = fstack[fp+t-1] + fstack[fp+t]
+    elif opcode in (0x93, 0xa1):  # f32.sub, f64.sub
+        def op(fp):
+            fstack[fp+t-1] = fstack[fp+t-1] - fstack[fp+t]
+    elif opcode in (0x94, 0xa2):  # f32.mul, f64.mul
+        def op(fp):
+            fstack[fp+t-1] = fstack[fp+t-1] * fstack[fp+t]
+    elif opcode in (0x95, 0xa3):  # f32.div, f64.div
+        def op(fp):
+            fstack[fp+t-1] = fstack[fp+t-1] / fstack[fp+t]
+    elif 0xc0 == opcode:  # get_local.get_local
+        src, src2 = code[pc+1], code[pc+2]
+        def op(fp):
+            istack[fp+t+1] = istack[fp+src]
+            fstack[fp+t+1] = fstack[fp+src]
+            istack[fp+t+2] = istack[fp+src2]
+            fstack[fp+t+2] = fstack[fp+src2]
+    elif 0xc1 == opcode:  # get_local.get_local.i32.add
+        src, src2 = code[pc+1], code[pc+2]
+        def op(fp):
+            istack[fp+t+1] = int2int32(istack[fp+src] + istack[fp+src2])
+    elif 0xc2 == opcode:  # get_local.i32.const.i32.add
+        src, val = code[pc+1], code[pc+2]
+        def op(fp):
+            istack[fp+t+1] = int2int32(istack[fp+src] + val)
+    elif 0xc3 == opcode:  # get_local.i32.const.i32.add.i32.load
+        src, val, offset = code[pc+1], code[pc+2], code[pc+3]
+        def op(fp):
+            addr = int2int32(istack[fp+src] + val) + offset
+            assert addr >= 0
+            if addr + 4 > memory.pages*(2**16):
+                raise WAException("out of bounds memory access")
+            istack[fp+t+1] = read_I32(memory.bytes, addr)
+    elif 0xc4 == opcode:  # i32.const.i32.add
+        val = code[pc+1]
+        def op(fp):
+            istack[fp+t] = int2int32(istack[fp+t] + val)
+    elif 0x10 == opcode:  # call (of an import)
+        callee = module.function[code[pc+1]]
+        def op(fp):
+            do_call_import(istack, fstack, fp+t, memory,
+                    module.imports, callee)
+    else:
+        # Remaining operators have no immediates and do not need the
+        # interpreter registers so reuse their dispatch table handler
+        handler = HANDLERS[opcode]
+        if handler in (op_unrecognized, op_unimplemented):
+            if handler == op_unrecognized:
+                msg = "unrecognized opcode 0x%x" % opcode
+            else:
+                msg = "%s(0x%x) unimplemented" % (
+                        OPERATOR_INFO[opcode][0], opcode)
+            def op(fp):
+                raise WAException(msg)
+        else:
+            def op(fp):
+                handler(None, istack, fstack, fp+t)
+    return op
+
+# Terminator closure of the basic block ending with the instruction at
+# pc (top of stack at fp+t). next_block is the fall through block.
+def closure_terminator(module, func, pc, t, block_index, next_block):
+    code = func.code
+    opcode = code[pc]
+    istack = module.istack
+    fstack = module.fstack
+    state = module.closure_state
+
+    if   0x00 == opcode:  # unreachable
+        def term(fp):
+            raise WAException("unreachable")
+    elif 0x04 == opcode:  # if
+        else_block = block_index[code[pc+1]]
+        def term(fp):
+            if istack[fp+t]:
+                return next_block
+            return else_block
+    elif 0x05 == opcode:  # else
+        end_block = block_index[code[pc+1]]
+        def term(fp):
+            return end_block
+    elif opcode in (0x0b, 0x0f):  # end (of function), return
+        def term(fp):
+            state.sp = fp + t
+            return RETURN
+    elif 0x0c == opcode:  # br
+        target = block_index[code[pc+1]]
+        if code[pc+2]:
+            base = code[pc+3]
+            def term(fp):
+                istack[fp+base] = istack[fp+t]
+                fstack[fp+base] = fstack[fp+t]
+                return target
+        else:
+            def term(fp):
+                return target
+    elif 0x0d == opcode:  # br_if
+        target = block_index[code[pc+1]]
+        if code[pc+2]:
+            base = code[pc+3]
+            def term(fp):
+                if istack[fp+t]:
+                    istack[fp+base] = istack[fp+t-1]
+                    fstack[fp+base] = fstack[fp+t-1]
+                    return target
+                return next_block
+        else:
+            def term(fp):
+                if istack[fp+t]:
+                    return target
+                return next_block
+    elif 0xc5 == opcode:  # i32.eqz.br_if
+        target = block_index[code[pc+1]]
+        if code[pc+2]:
+            base = code[pc+3]
+            def term(fp):
+                if not istack[fp+t]:
+                    istack[fp+base] = istack[fp+t-1]
+                    fstack[fp+base] = fstack[fp+t-1]
+                    return target
+                return next_block
+        else:
+            def term(fp):
+                if not istack[fp+t]:
+                    return target
+                return next_block
+    elif 0x0e == opcode:  # br_table
+        count = code[pc+1]
+        targets = []
+        for i in range(count+1):
+            tpc = pc + 2 + 3*i
+            targets.append((block_index[code[tpc]], code[tpc+1],
+                            code[tpc+2]))
+        def term(fp):
+            didx = istack[fp+t]
+            if didx < 0 or didx >= count:
+                didx = count  # default
+            target, arity, base = targets[didx]
+            if arity:
+                istack[fp+base] = istack[fp+t-1]
+                fstack[fp+base] = fstack[fp+t-1]
+            return target
+    elif 0x10 == opcode:  # call
+        callee = module.function[code[pc+1]]
+        def term(fp):
+            state.sp = fp + t
+            state.callee = callee
+            state.ra = next_block
+            return CALL
+    elif 0x11 == opcode:  # call_indirect
+        ftype = module.type[code[pc+1]]
+        table = module.table
+        function = module.function
+        memory = module.memory
+        def term(fp):
+            fidx = get_from_table(table, ANYFUNC, istack[fp+t])  # I32
+            callee = function[fidx]
+            if not same_signature(callee.type, ftype):
+                raise WAException("indirect call signature mismatch")
+            if isinstance(callee, FunctionImport):
+                do_call_import(istack, fstack, fp+t-1, memory,
+                        module.imports, callee)
+                return next_block
+            state.sp = fp + t - 1
+            state.callee = callee
+            state.ra = next_block
+            return CALL
+    else:
+        raise Exception("0x%x does not end a block" % opcode)
+    return term
+
+def closure_block(ops, term, next_block):
+    if term is None:
+        def run(fp):
+            for op in ops:
+                op(fp)
+            return next_block
+    elif len(ops) == 0:
+        run = term
+    else:
+        def run(fp):
+            for op in ops:
+                op(fp)
+            return term(fp)
+    return run
+
+# Compile func into a list of basic block closures (block 0 is the
+# function entry)
+def compile_closures(module, func):
+    ensure_compiled(func)
+    code = func.code
+    local_cnt = len(func.type.params) + len(func.locals)
+    heights, leaders = stack_heights(func, module.function,
+            module.type)
+
+    starts = [pc for pc in sorted(leaders.keys())
+              if pc in heights and pc < len(code)]
+    block_index = {}
+    for idx, pc in enumerate(starts):
+        block_index[pc] = idx
+
+    blocks = []
+    for idx, start in enumerate(starts):
+        ops = []
+        term = None
+        next_block = idx + 1
+        pc = start
+        while True:
+            opcode = code[pc]
+            t = local_cnt + heights[pc] - 1
+            next_pc, _ = decoded_immediates(code, pc)
+            if (opcode in (0x00, 0x04, 0x05, 0x0b, 0x0c, 0x0d, 0x0e,
+                           0x0f, 0x11, 0xc5) or
+                (0x10 == opcode and
+                 isinstance(module.function[code[pc+1]], Function))):
+                term = closure_terminator(module, func, pc, t,
+                        block_index, next_block)
+                break
+            op = closure_op(module, func, pc, t)
+            if op is not None:
+                ops.append(op)
+            pc = next_pc
+            if pc in block_index:
+                break
+        blocks.append(closure_block(ops, term, next_block))
+    module.closure_index[func.index] = block_index
+
+    if DEBUG:
+        debug("compiled function 0x%x to %d closure blocks" % (
+            func.index, len(blocks)))
+    return blocks
+
+def closure_code(module, func):
+    blocks = module.closure_code.get(func.index, None)
+    if blocks is None:
+        blocks = compile_closures(module, func)
+        module.closure_code[func.index] = blocks
+    return blocks
+
+# Run the closure blocks of func from block blk in the frame at csp
+# until that frame returns. Returns the value stack size with the
+# results on top; the caller pops the frame.
+def closure_run(module, func, blk, fp, csp):
+    state = module.closure_state
+    istack, fstack = module.istack, module.fstack
+    callstack = module.callstack
+    base_csp = csp
+    blocks = closure_code(module, func)
+    while True:
+        if TRACE:
+            info("    fn%d block %d (fp: %d)" % (func.index, blk, fp))
+        blk = blocks[blk](fp)
+        if blk >= 0:
+            continue
+        if blk == CALL:
+            callee = state.callee
+            sp = do_call(istack, fstack, callstack, state.sp, fp, csp,
+                    callee, state.ra, func)
+            csp += 1
+            fp = callstack[csp].sp + 1
+            func = callee
+            blocks = closure_code(module, func)
+            blk = 0
+        else:  # RETURN
+            if csp == base_csp:
+                return state.sp
+            frame = callstack[csp]
+            sp = do_return(istack, fstack, frame, state.sp)
+            fp = frame.fp
+            csp -= 1
+            func = frame.caller
+            blocks = closure_code(module, func)
+            blk = frame.ra
+
+def interpret_closure(module,
+        pc, func,
+        memory, sp, istack, fstack, fp, csp, callstack):
+    sp = closure_run(module, func, 0, fp, csp)
+    return do_return(istack, fstack, callstack[csp], sp)
+
+
+######################################
+# Python transpiler
+######################################
+
+# The python engine (CPython only) translates each function, the first
+# time an instance calls it, into the source of a Python function and
+# compiles that with compile(). Parameters and locals become Python
+# locals (l0, l1, ...), operand stack slots become Python locals named
+# by their static height (s0, s1, ...), calls are direct Python calls
+# and memory accesses use the read_*/write_* buffer helpers.
+#
+# Structured control flow maps to Python loops: a block, loop or if
+# that is a branch target is wrapped in "while True:" so a branch to
+# it is a break (or continue for a loop). Branches that cross more
+# than one loop set lbl to the target and break; each crossed loop
+# then re-dispatches on lbl. Functions that use an operator without a
+# translation here (or nest too deeply for the Python compiler) run
+# in the closure engine, whose calls stay in closure blocks instead of
+# adding Python frames per call (see tier_interpreter).
+
+class Untranslatable(Exception):
+    pass
+
+# Expressions of the pure operators, {a} and {b} are the operands
+PY_EXPR = {
+    0x45 : "{a} == 0",                            # i32.eqz
+    0x46 : "{a} == {b}",                          # i32.eq
+    0x47 : "{a} != {b}",                          # i32.ne
+    0x48 : "int2int32({a}) < int2int32({b})",     # i32.lt_s
+    0x49 : "int2uint32({a}) < int2uint32({b})",   # i32.lt_u
+    0x4a : "int2int32({a}) > int2int32({b})",     # i32.gt_s
+    0x4b : "int2uint32({a}) > int2uint32({b})",   # i32.gt_u
+    0x4c : "int2int32({a}) <= int2int32({b})",    # i32.le_s
+    0x4d : "int2uint32({a}) <= int2uint32({b})",  # i32.le_u
+    0x4e : "int2int32({a}) >= int2int32({b})",    # i32.ge_s
+    0x4f : "int2uint32({a}) >= int2uint32({b})",  # i32.ge_u
+    0x50 : "{a} == 0",                            # i64.eqz
+    0x51 : "{a} == {b}",                          # i64.eq
+    0x52 : "{a} != {b}",                          # i64.ne
+    0x53 : "int2int64({a}) < int2int64({b})",     # i64.lt_s
+    0x54 : "int2uint64({a}) < int2uint64({b})",   # i64.lt_u
+    0x55 : "int2int64({a}) > int2int64({b})",     # i64.gt_s
+    0x56 : "int2uint64({a}) > int2uint64({b})",   # i64.gt_u
+    0x57 : "int2int64({a}) <= int2int64({b})",    # i64.le_s
+    0x58 : "int2uint64({a}) <= int2uint64({b})",  # i64.le_u
+    0x59 : "int2int64({a}) >= int2int64({b})",    # i64.ge_s
+    0x5a : "int2uint64({a}) >= int2uint64({b})",  # i64.ge_u
+    0x5b : "{a} == {b}",                          # f32.eq
+    0x5c : "{a} != {b}",                          # f32.ne
+    0x5d : "{a} < {b}",                           # f32.lt
+    0x5e : "{a} > {b}",                           # f32.gt
+    0x5f : "{a} <= {b}",                          # f32.le
+    0x60 : "{a} >= {b}",                          # f32.ge
+    0x61 : "{a} == {b}",                          # f64.eq
+    0x62 : "{a} != {b}",                          # f64.ne
+    0x63 : "{a} < {b}",                           # f64.lt
+    0x64 : "{a} > {b}",                           # f64.gt
+    0x65 : "{a} <= {b}",                          # f64.le
+    0x66 : "{a} >= {b}",                          # f64.ge
+    0x6a : "int2int32({a} + {b})",                # i32.add
+    0x6b : "{a} - {b}",                           # i32.sub
+    0x6c : "int2int32({a} * {b})",                # i32.mul
+    0x71 : "{a} & {b}",                           # i32.and
+    0x72 : "{a} | {b}",                           # i32.or
+    0x73 : "{a} ^ {b}",                           # i32.xor
+    0x74 : "{a} << ({b} % 0x20)",                 # i32.shl
+    0x75 : "int2int32({a}) >> ({b} % 0x20)",      # i32.shr_s
+    0x76 : "int2uint32({a}) >> ({b} % 0x20)",     # i32.shr_u
+    0x7c : "int2int64({a} + {b})",                # i64.add
+    0x7d : "{a} - {b}",                           # i64.sub
+    0x7e : "int2int64({a} * {b})",                # i64.mul
+    0x83 : "{a} & {b}",                           # i64.and
+    0x84 : "{a} | {b}",                           # i64.or
+    0x85 : "{a} ^ {b}",                           # i64.xor
+    0x86 : "{a} << ({b} % 0x40)",                 # i64.shl
+    0x87 : "int2int64({a}) >> ({b} % 0x40)",      # i64.shr_s
+    0x88 : "int2uint64({a}) >> ({b} % 0x40)",     # i64.shr_u
+    0x8b : "abs({a})",                            # f32.abs
+    0x8c : "-{a}",                                # f32.neg
+    0x92 : "{a} + {b}",                           # f32.add
+    0x93 : "{a} - {b}",                           # f32.sub
+    0x94 : "{a} * {b}",                           # f32.mul
+    0x95 : "{a} / {b}",                           # f32.div
+    0x96 : "{a} if {a} < {b} else {b}",           # f32.min
+    0x97 : "{a} if {a} > {b} else {b}",           # f32.max
+    0x98 : "abs({a}) if {b} > 0 else -abs({a})",  # f32.copysign
+    0x99 : "abs({a})",                            # f64.abs
+    0x9a : "-{a}",                                # f64.neg
+    0xa0 : "{a} + {b}",                           # f64.add
+    0xa1 : "{a} - {b}",                           # f64.sub
+    0xa2 : "{a} * {b}",                           # f64.mul
+    0xa3 : "{a} / {b}",                           # f64.div
+    0xa4 : "{a} if {a} < {b} else {b}",           # f64.min
+    0xa5 : "{a} if {a} > {b} else {b}",           # f64.max
+    0xa6 : "abs({a}) if {b} > 0 else -abs({a})",  # f64.copysign
+    0xa7 : "int2int32({a})",                      # i32.wrap/i64
+    0xac : "int2int32({a})",                      # i64.extend_s/i32
+    0xad : "intmask({a})",                        # i64.extend_u/i32
+    0xb2 : "float({a})",                          # f32.convert_s/i32
+    0xb3 : "float(int2uint32({a}))",              # f32.convert_u/i32
+    0xb4 : "float({a})",                          # f32.convert_s/i64
+    0xb5 : "float(int2uint64({a}))",              # f32.convert_u/i64
+    0xb7 : "float({a})",                          # f64.convert_s/i32
+    0xb8 : "float(int2uint32({a}))",              # f64.convert_u/i32
+    0xb9 : "float({a})",                          # f64.convert_s/i64
+    0xba : "float(int2uint64({a}))",              # f64.convert_u/i64
+    0xbb : "{a}",                                 # f64.promote/f32
+    0xbc : "intmask(pack_f32({a}))",              # i32.reinterpret/f32
+    0xbd : "intmask(pack_f64({a}))",              # i64.reinterpret/f64
+    0xbf : "unpack_f64(int2int64({a}))",          # f64.reinterpret/i64
+}
+
+DIV_ZERO = 'raise WAException("integer divide by zero")'
+OVERFLOW = 'raise WAException("integer overflow")'
+BAD_CONVERSION = 'raise WAException("invalid conversion to integer")'
+
+# Operators that can trap: ([(condition, raise statement), ...],
+# result expression)
+PY_CHECKED = {
+    0x6d : ([("{b} == 0", DIV_ZERO),                      # i32.div_s
+             ("{a} == 0x80000000 and {b} == -1", OVERFLOW)],
+            "idiv_s(int2int32({a}), int2int32({b}))"),
+    0x6e : ([("{b} == 0", DIV_ZERO)],                     # i32.div_u
+            "int2uint32({a}) / int2uint32({b})"),
+    0x6f : ([("{b} == 0", DIV_ZERO)],                     # i32.rem_s
+            "irem_s(int2int32({a}), int2int32({b}))"),
+    0x70 : ([("{b} == 0", DIV_ZERO)],                     # i32.rem_u
+            "int2uint32({a}) % int2uint32({b})"),
+    0x7f : ([("{b} == 0", DIV_ZERO)],                     # i64.div_s
+            "idiv_s(int2int64({a}), int2int64({b}))"),
+    0x81 : ([("{b} == 0", DIV_ZERO)],                     # i64.rem_s
+            "irem_s(int2int64({a}), int2int64({b}))"),
+    0x82 : ([("{b} == 0", DIV_ZERO)],                     # i64.rem_u
+            "int2uint64({a}) % int2uint64({b})"),
+    0xa8 : ([("math.isnan({a})", BAD_CONVERSION),         # i32.trunc_s/f32
+             ("{a} > 2147483647.0", OVERFLOW),
+             ("{a} < -2147483648.0", OVERFLOW)],
+            "int({a})"),
+    0xb0 : ([("math.isnan({a})", BAD_CONVERSION)],        # i64.trunc_s/f64
+            "int({a})"),
+    0xb1 : ([("math.isnan({a})", BAD_CONVERSION),         # i64.trunc_u/f64
+             ("{a} <= -1.0", OVERFLOW)],
+            "int({a})"),
+}
+
+# Control stack entry of the translator
+class PyCtrl():
+    def __init__(self, block, label, loop, height, live):
+        self.block = block    # Block from find_blocks
+        self.label = label    # value of lbl for branches to this entry
+        self.loop = loop      # emitted as "while True:"
+        self.height = height  # operand stack height on entry
+        self.live = live      # reachable on entry
+        self.branched = False # a reachable branch targets this entry
+        self.crossed = False  # a branch passes through this loop
+
+class PyWriter():
+    def __init__(self):
+        self.lines = []
+        self.indent = 1
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+def py_slot(h):
+    return "s%d" % h
+
+# Emit a branch to ctrl with the top of the operand stack at h-1
+def py_branch(w, ctrls, ctrl, h):
+    block = ctrl.block
+    if block.kind == 0x00:  # out of the function
+        if len(block.type.results) > 0:
+            w.emit("return %s" % py_slot(h-1))
+        else:
+            w.emit("return")
+        return
+    ctrl.branched = True
+    if block.kind != 0x03 and len(block.type.results) > 0:
+        if h-1 != ctrl.height:
+            w.emit("%s = %s" % (py_slot(ctrl.height), py_slot(h-1)))
+    # The innermost loop
+    inner = None
+    for i in range(len(ctrls)-1, -1, -1):
+        if ctrls[i].loop:
+            inner = ctrls[i]
+            break
+    if inner is ctrl:
+        if block.kind == 0x03:
+            w.emit("continue")
+        else:
+            w.emit("break")
+    else:
+        for i in range(len(ctrls)-1, -1, -1):
+            if ctrls[i] is ctrl:
+                break
+            if ctrls[i].loop:
+                ctrls[i].crossed = True
+        w.emit("lbl = %d" % ctrl.label)
+        w.emit("break")
+
+# Python source of func (a def named f<index>) and the float
+# constants it refers to ({name: value, ...})
+def transpile_function(module, func):
+    ensure_compiled(func)
+    code = module.compiled.rdr.bytes
+    block_map, branch_map = find_blocks(code, func, module.function,
+            module.type)
+    targets = {}
+    for blocks in branch_map.values():
+        for block in blocks:
+            targets[block] = True
+
+    nparams = len(func.type.params)
+    ltypes = func.type.params + func.locals
+    consts = {}
+    w = PyWriter()
+    for i in range(nparams, len(ltypes)):
+        if ltypes[i] in (F32, F64):
+            w.emit("l%d = 0.0" % i)
+        else:
+            w.emit("l%d = 0" % i)
+    w.emit("lbl = -1")
+
+    fblock = Block(0x00, func.type, func.start)
+    ctrls = [PyCtrl(fblock, 0, False, 0, True)]
+    h = 0
+    live = True
+    pos = func.start
+    while pos <= func.end:
+        opcode = code[pos]
+        cur_pos = pos
+        pos, vals = skip_immediates(code, pos)
+        a, b = py_slot(h-2), py_slot(h-1)
+
+        # Structure is tracked in unreachable code too
+        if opcode in (0x02, 0x03, 0x04):  # block, loop, if
+            block = block_map[cur_pos]
+            if live and 0x04 == opcode:
+                h -= 1
+            loop = live and block in targets
+            ctrl = PyCtrl(block, len(ctrls), loop, h, live)
+            if loop:
+                w.emit("while True:")
+                w.indent += 1
+            if live and 0x04 == opcode:
+                w.emit("if %s:" % py_slot(h))
+                w.indent += 1
+                w.emit("pass")
+            ctrls.append(ctrl)
+            continue
+        elif 0x05 == opcode:  # else
+            ctrl = ctrls[-1]
+            if ctrl.live:
+                w.indent -= 1
+                w.emit("else:")
+                w.indent += 1
+                w.emit("pass")
+            h = ctrl.height
+            live = ctrl.live
+            continue
+        elif 0x0b == opcode:  # end
+            if cur_pos == func.end:
+                if live:
+                    if len(func.type.results) > 0:
+                        w.emit("return %s" % py_slot(h-1))
+                    else:
+                        w.emit("return")
+                break
+            ctrl = ctrls.pop()
+            if ctrl.live and ctrl.block.kind == 0x04:
+                w.indent -= 1
+            if ctrl.loop:
+                if live or ctrl.block.kind == 0x04:
+                    w.emit("break")
+                w.indent -= 1
+                if ctrl.crossed:
+                    # Continue a branch that crossed this loop
+                    parent = None
+                    for i in range(len(ctrls)-1, -1, -1):
+                        if ctrls[i].loop:
+                            parent = ctrls[i]
+                            break
+                    assert parent is not None
+                    w.emit("if lbl >= 0:")
+                    w.indent += 1
+                    w.emit("if lbl == %d:" % parent.label)
+                    w.indent += 1
+                    w.emit("lbl = -1")
+                    if parent.block.kind == 0x03:
+                        w.emit("continue")
+                    else:
+                        w.emit("break")
+                    w.indent -= 1
+                    w.emit("break")
+                    w.indent -= 1
+            if ctrl.block.kind == 0x03:
+                live = live and ctrl.live
+            else:
+                live = ctrl.live and (live or ctrl.branched or
+                                      ctrl.block.kind == 0x04)
+            h = ctrl.height + len(ctrl.block.type.results)
+            continue
+
+        if not live:
+            continue
+
+        if   0x00 == opcode:  # unreachable
+            w.emit('raise WAException("unreachable")')
+            live = False
+        elif 0x01 == opcode:  # nop
+            pass
+        elif 0x0c == opcode:  # br
+            py_branch(w, ctrls, ctrls[-1-vals[0]], h)
+            live = False
+        elif 0x0d == opcode:  # br_if
+            h -= 1
+            w.emit("if %s:" % py_slot(h))
+            w.indent += 1
+            py_branch(w, ctrls, ctrls[-1-vals[0]], h)
+            w.indent -= 1
+        elif 0x0e == opcode:  # br_table
+            h -= 1
+            depths = vals[1:]
+            for i in range(len(depths)):
+                if len(depths) == 1:
+                    w.emit("if True:")
+                elif i == len(depths)-1:
+                    w.emit("else:")
+                elif i == 0:
+                    w.emit("if %s == %d:" % (py_slot(h), i))
+                else:
+                    w.emit("elif %s == %d:" % (py_slot(h), i))
+                w.indent += 1
+                py_branch(w, ctrls, ctrls[-1-depths[i]], h)
+                w.indent -= 1
+            live = False
+        elif 0x0f == opcode:  # return
+            py_branch(w, ctrls, ctrls[0], h)
+            live = False
+        elif opcode in (0x10, 0x11):  # call, call_indirect
+            if 0x10 == opcode:
+                t = module.function[vals[0]].type
+                callee = "fns[%d]" % vals[0]
+            else:
+                t = module.type[vals[0]]
+                h -= 1
+                w.emit("fidx = get_from_table(table, ANYFUNC, %s)" %
+                       py_slot(h))
+                w.emit("if not same_signature(function[fidx].type, "
+                       "types[%d]):" % vals[0])
+                w.emit('    raise WAException('
+                       '"indirect call signature mismatch")')
+                callee = "fns[fidx]"
+            h -= len(t.params)
+            args = ", ".join([py_slot(h+i) for i in range(len(t.params))])
+            # Each call is a Python call, count its depth in inst.csp
+            w.emit("inst.csp += 1")
+            w.emit("if inst.csp >= CALLSTACK_SIZE:")
+            w.emit('    raise WAException("call stack exhausted")')
+            if len(t.results) > 0:
+                w.emit("%s = %s(%s)" % (py_slot(h), callee, args))
+                h += 1
+            else:
+                w.emit("%s(%s)" % (callee, args))
+            w.emit("inst.csp -= 1")
+        elif 0x1a == opcode:  # drop
+            h -= 1
+        elif 0x1b == opcode:  # select
+            w.emit("if not %s:" % py_slot(h-1))
+            w.emit("    %s = %s" % (py_slot(h-3), py_slot(h-2)))
+            h -= 2
+        elif 0x20 == opcode:  # get_local
+            w.emit("%s = l%d" % (py_slot(h), vals[0]))
+            h += 1
+        elif opcode in (0x21, 0x22):  # set_local, tee_local
+            w.emit("l%d = %s" % (vals[0], b))
+            if 0x21 == opcode:
+                h -= 1
+        elif 0x23 == opcode:  # get_global
+            if module.global_list[vals[0]][0] in (F32, F64):
+                w.emit("%s = glob[%d][2]" % (py_slot(h), vals[0]))
+            else:
+                w.emit("%s = glob[%d][1]" % (py_slot(h), vals[0]))
+            h += 1
+        elif 0x24 == opcode:  # set_global
+            gtype = module.global_list[vals[0]][0]
+            if gtype in (F32, F64):
+                w.emit("glob[%d] = (%d, 0, %s)" % (vals[0], gtype, b))
+            else:
+                w.emit("glob[%d] = (%d, %s, 0.0)" % (vals[0], gtype, b))
+            h -= 1
+        elif 0x28 <= opcode <= 0x3e:  # loads, stores
+            if opcode >= 0x36:
+                addr_slot = a
+            else:
+                addr_slot = b
+            w.emit("addr = %s + %d" % (addr_slot, vals[1]))
+            w.emit("assert addr >= 0")
+            w.emit("if addr + %d > memory.pages*65536:" %
+                   LOAD_SIZE[opcode])
+            w.emit('    raise WAException("out of bounds memory access")')
+            if opcode >= 0x36:
+                w.emit("%s(memory.bytes, addr, %s)" % (
+                    MEMORY_WRITE[opcode].__name__, b))
+                h -= 2
+            else:
+                w.emit("%s = %s(memory.bytes, addr)" % (
+                    b, MEMORY_READ[opcode].__name__))
+        elif 0x3f == opcode:  # current_memory
+            w.emit("%s = memory.pages" % py_slot(h))
+            h += 1
+        elif 0x40 == opcode:  # grow_memory
+            w.emit("%s = memory.grow(%s)" % (b, b))
+        elif opcode in (0x41, 0x42):  # i32.const, i64.const
+            w.emit("%s = %d" % (py_slot(h), vals[0]))
+            h += 1
+        elif opcode in (0x43, 0x44):  # f32.const, f64.const
+            name = "c%d_%d" % (func.index, len(consts))
+            consts[name] = vals[0]
+            w.emit("%s = %s" % (py_slot(h), name))
+            h += 1
+        elif opcode in PY_EXPR or opcode in PY_CHECKED:
+            pops, _ = stack_effect(opcode)
+            if pops == 1:
+                a, b = b, ""
+            if opcode in PY_CHECKED:
+                checks, expr = PY_CHECKED[opcode]
+                for cond, stmt in checks:
+                    w.emit("if %s:" % cond.format(a=a, b=b))
+                    w.emit("    " + stmt)
+            else:
+                expr = PY_EXPR[opcode]
+            h -= pops
+            w.emit("%s = %s" % (py_slot(h), expr.format(a=a, b=b)))
+            h += 1
+        else:
+            raise Untranslatable("%s(0x%x)" % (
+                OPERATOR_INFO[opcode][0], opcode))
+
+    params = ", ".join(["l%d" % i for i in range(nparams)])
+    source = "def f%d(%s):\n%s\n" % (func.index, params,
+            "\n".join(w.lines))
+    return source, consts
+
+# Names the generated functions use, the rest of their namespace is
+# the instance (see py_namespace)
+PY_BUILTINS = ['WAException', 'ANYFUNC', 'CALLSTACK_SIZE', 'math',
+               'intmask', 'int2int32', 'int2uint32', 'int2int64', 'int2uint64',
+               'idiv_s', 'irem_s', 'pack_f32', 'pack_f64', 'unpack_f64',
+               'get_from_table', 'same_signature']
+
+def py_namespace(module):
+    ns = {'inst': module}
+    for name in PY_BUILTINS + [f.__name__ for f in
+                               MEMORY_READ.values() + MEMORY_WRITE.values()]:
+        ns[name] = globals()[name]
+    ns['memory'] = module.memory
+    ns['glob'] = module.global_list
+    ns['table'] = module.table
+    ns['function'] = module.function
+    ns['types'] = module.type
+    ns['fns'] = module.py_fns
+    return ns
+
+# The compiled Python function of func or None if it can not be
+# translated. Code objects are kept on the CompiledModule so other
+# instances only need to bind them.
+def py_function(module, func):
+    fn = module.py_funcs.get(func.index, False)
+    if fn is not False:
+        return fn
+    compiled = module.compiled
+    entry = compiled.py_code.get(func.index, None)
+    if entry is None:
+        try:
+            source, consts = transpile_function(module, func)
+            entry = (compile(source, "<wasm f%d>" % func.index, "exec"),
+                     consts)
+            if DEBUG:
+                debug("transpiled function 0x%x:\n%s" % (
+                    func.index, source))
+        except (Untranslatable, SyntaxError) as e:
+            info("function 0x%x not transpiled: %s" % (func.index, e))
+            entry = (None, {})
+        compiled.py_code[func.index] = entry
+    code, consts = entry
+    fn = None
+    if code is not None:
+        ns = module.py_ns
+        ns.update(consts)
+        exec code in ns
+        fn = ns["f%d" % func.index]
+        module.py_fns[func.index] = fn
+    module.py_funcs[func.index] = fn
+    return fn
+
+def py_arg(istack, fstack, vtype, slot):
+    if vtype in (F32, F64):
+        return fstack[slot]
+    return istack[slot]
+
+def py_push(istack, fstack, vtype, slot, val):
+    if vtype in (F32, F64):
+        fstack[slot] = val
+    else:
+        istack[slot] = val
+
+# Call fn (the Python function of func) with its arguments popped from
+# the top of the value stack at sp and push its result. Returns the
+# new sp. The call counts as a frame at csp+1: module.csp holds the
+# call depth while Python code runs (see transpile_function).
+def py_call(module, fn, func, istack, fstack, sp, fp, csp):
+    t = func.type
+    if csp+1 >= CALLSTACK_SIZE:
+        raise WAException("call stack exhausted")
+    sp -= len(t.params)
+    args = [py_arg(istack, fstack, t.params[i], sp+1+i)
+            for i in range(len(t.params))]
+    # Nested interpreter calls start above the caller's frame
+    module.sp, module.fp, module.csp = sp, fp, csp+1
+    res = fn(*args)
+    if len(t.results) > 0:
+        sp += 1
+        py_push(istack, fstack, t.results[0], sp, res)
+    return sp
+
+# Callable used by generated code for functions that are not
+# transpiled (or are imported): run them on the value stack above
+# module.sp
+def py_bridge(module, func):
+    t = func.type
+    istack, fstack = module.istack, module.fstack
+    def call(*args):
+        base_sp, base_csp = module.sp, module.csp
+        sp = base_sp
+        if sp + len(args) >= len(istack):
+            grow_stacks(istack, fstack, sp + len(args) + 1)
+        for i in range(len(args)):
+            sp += 1
+            py_push(istack, fstack, t.params[i], sp, args[i])
+        if isinstance(func, FunctionImport):
+            sp = do_call_import(istack, fstack, sp, module.memory,
+                    module.imports, func)
+        else:
+            # The call site counted this call in module.csp, so the
+            # interpreter's frame for it goes at that depth
+            module.sp, module.csp = sp, base_csp - 1
+            module.run_interpreter(func, tier_interpreter(module, func))
+            sp = module.sp
+        module.sp, module.csp = base_sp, base_csp
+        if len(t.results) > 0:
+            return py_arg(istack, fstack, t.results[0], sp)
+        return None
+    return call
+
+# Initial fns entry: translate on first call (tiered: once it is hot)
+def py_stub(module, func):
+    bridge = py_bridge(module, func)
+    def call(*args):
+        fn = None
+        if module.tiering:
+            if not tier_hot(module, func):
+                # Interpreted, do_call counts the call
+                return bridge(*args)
+            if tier_of(module, func) == "python":
+                fn = py_function(module, func)
+        else:
+            fn = py_function(module, func)
+        if fn is None:
+            fn = bridge
+        module.py_fns[func.index] = fn
+        return fn(*args)
+    return call
+
+def py_setup(module):
+    module.py_funcs = {}  # {function index: Python function or None}
+    module.py_fns = []
+    for func in module.function:
+        if isinstance(func, FunctionImport):
+            module.py_fns.append(py_bridge(module, func))
+        else:
+            module.py_fns.append(py_stub(module, func))
+    module.py_ns = py_namespace(module)
+
+
+######################################
+# Tiered execution
+######################################
+
+# The tiered engine (CPython only) starts every function in
+# interpret_mvp, which only needs the pre-decoded code. Function.hotness
+# counts calls (in do_call) and loop back-edges (in interpret_mvp) and
+# once it reaches CompiledModule.tier_threshold the function is
+# promoted: calls to it run the transpiled Python function (--tier-up
+# python, the default) or its closure blocks (--tier-up closure, or
+# when it can not be transpiled). Back-edges of a hot function that is
+# still being interpreted continue in the closure tier from the loop
+# header (on-stack replacement); closure blocks share the interpreter's
+# frame layout so they can take over a running call, transpiled
+# functions can only be entered at the top.
+
+# tier_call/tier_loop result when the interpreter has to run the code
+NOT_TIERED = -2
+
+def tier_hot(module, func):
+    return func.hotness >= module.compiled.tier_threshold
+
+# The tier a hot function is promoted to: "python" or "closure"
+def tier_of(module, func):
+    tier = module.tiers.get(func.index, None)
+    if tier is None:
+        tier = "closure"
+        if (module.compiled.tier_up == "python" and
+                py_function(module, func) is not None):
+            tier = "python"
+        module.tiers[func.index] = tier
+        info("promoting function 0x%x to the %s tier (hotness %d)" % (
+            func.index, tier, func.hotness))
+    return tier
+
+# The interpreter for func when it does not run as a transpiled
+# Python function: cold functions of the tiered engine are interpreted,
+# hot ones and untranslatable ones of the python engine run in the
+# closure tier
+def tier_interpreter(module, func):
+    if not module.tiering:
+        return interpret_closure
+    if tier_hot(module, func) and tier_of(module, func) == "closure":
+        return interpret_closure
+    return interpret_mvp
+
+# Call func (arguments on the value stack at sp) in a faster tier if it
+# has one (always the transpiled function with the python engine).
+# Returns the new sp or NOT_TIERED.
+def tier_call(module, func, sp, fp, csp):
+    istack, fstack = module.istack, module.fstack
+    if module.tiering:
+        if not tier_hot(module, func):
+            return NOT_TIERED
+        if tier_of(module, func) == "closure":
+            callstack = module.callstack
+            sp = do_call(istack, fstack, callstack, sp, fp, csp,
+                    func, 0, None)
+            frame = callstack[csp+1]
+            sp = closure_run(module, func, 0, frame.sp + 1, csp+1)
+            return do_return(istack, fstack, frame, sp)
+    fn = py_function(module, func)
+    if fn is None:
+        return NOT_TIERED
+    return py_call(module, fn, func, istack, fstack, sp, fp, csp)
+
+# Count a back-edge to target in the interpreted call of func at csp.
+# Once func is hot run the rest of the call in the closure tier from
+# the loop header and return the sp to return with, else NOT_TIERED.
+def tier_loop(module, func, target, sp, fp, csp):
+    func.hotness += 1
+    if not tier_hot(module, func):
+        return NOT_TIERED
+    closure_code(module, func)
+    blk = module.closure_index[func.index].get(target, -1)
+    if blk < 0:
+        return NOT_TIERED
+    if DEBUG:
+        debug("entering function 0x%x at 0x%x (block %d) in the"
+              " closure tier" % (func.index, target, blk))
+    return closure_run(module, func, blk, fp, csp)
+
+
+# Execution engines (selected with --engine). The JIT traces the
+# if/elif chain in interpret_mvp so it stays the default there and the
+# closure, python and tiered engines are only available under CPython.
+if IS_RPYTHON:
+    ENGINES = ["mvp", "table", "register"]
+    DEFAULT_ENGINE = "mvp"
+else:
+    ENGINES = ["mvp", "table", "register", "closure", "python",
+               "tiered"]
+    DEFAULT_ENGINE = "tiered"
+
+
+######################################
+# Validation
+######################################
+
+UNKNOWN = 0x00  # operand of any type (in unreachable code)
+
+# Control frame of the validator (function body, block, loop, if or
+# else) with the types its label takes and the types left at its end
+class CtrlFrame():
+    def __init__(self, kind, label_types, end_types, height):
+        self.kind = kind
+        self.label_types = label_types
+        self.end_types = end_types
+        self.height = height
+        self.unreachable = False
+
+# Operand stack of the validator
+class Validator():
+    def __init__(self, func):
+        self.func = func
+        self.opds = []
+        self.ctrls = []
+        self.pos = 0
+
+    def error(self, msg):
+        raise Exception("invalid function 0x%x at 0x%x: %s" % (
+            self.func.index, self.pos, msg))
+
+    def push(self, t):
+        self.opds.append(t)
+
+    def push_all(self, types):
+        for t in types:
+            self.opds.append(t)
+
+    def pop(self):
+        frame = self.ctrls[-1]
+        if len(self.opds) == frame.height:
+            if frame.unreachable:
+                return UNKNOWN
+            self.error("stack underflow")
+        return self.opds.pop()
+
+    def pop_expect(self, expect):
+        actual = self.pop()
+        if actual == UNKNOWN: return expect
+        if expect == UNKNOWN: return actual
+        if actual != expect:
+            self.error("type mismatch: %s != %s" % (
+                VALUE_TYPE[expect], VALUE_TYPE[actual]))
+        return actual
+
+    def pop_all(self, types):
+        for i in range(len(types)-1, -1, -1):
+            self.pop_expect(types[i])
+
+    def push_ctrl(self, kind, label_types, end_types):
+        self.ctrls.append(CtrlFrame(kind, label_types, end_types,
+                                    len(self.opds)))
+
+    def pop_ctrl(self):
+        if len(self.ctrls) == 0:
+            self.error("unmatched end")
+        frame = self.ctrls[-1]
+        self.pop_all(frame.end_types)
+        if len(self.opds) != frame.height:
+            self.error("values remaining on stack at end of block")
+        self.ctrls.pop()
+        return frame
+
+    def label(self, depth):
+        if depth >= len(self.ctrls):
+            self.error("unknown label %d" % depth)
+        return self.ctrls[-1-depth].label_types
+
+    def set_unreachable(self):
+        frame = self.ctrls[-1]
+        del self.opds[frame.height:]
+        frame.unreachable = True
+
+# Type check the body of func per the MVP validation algorithm.
+# Raises an Exception for invalid code, so the interpreter does not
+# need to check operand types or signatures at runtime.
+def validate_function(bytes, func, module):
+    v = Validator(func)
+    locals = func.type.params + func.locals
+    results = func.type.results
+    v.push_ctrl(0x00, results, results)
+
+    pos = func.start
+    opcode = 0
+    while pos <= func.end:
+        opcode = bytes[pos]
+        v.pos = pos
+        if opcode not in OPERATOR_INFO:
+            v.error("unknown opcode 0x%x" % opcode)
+        pos, vals = skip_immediates(bytes, pos)
+
+        if   0x00 == opcode:  # unreachable
+            v.set_unreachable()
+        elif 0x01 == opcode:  # nop
+            pass
+        elif 0x02 <= opcode <= 0x04:  # block, loop, if
+            if vals[0] not in BLOCK_TYPE:
+                v.error("invalid block type 0x%x" % vals[0])
+            bresults = BLOCK_TYPE[vals[0]].results
+            if 0x04 == opcode:
+                v.pop_expect(I32)
+            if 0x03 == opcode:
+                v.push_ctrl(opcode, [], bresults)
+            else:
+                v.push_ctrl(opcode, bresults, bresults)
+        elif 0x05 == opcode:  # else
+            frame = v.pop_ctrl()
+            if frame.kind != 0x04:
+                v.error("else not matched with if")
+            v.push_ctrl(0x05, frame.label_types, frame.end_types)
+        elif 0x0b == opcode:  # end
+            frame = v.pop_ctrl()
+            if frame.kind == 0x04 and len(frame.end_types) > 0:
+                v.error("if with a result but no else")
+            if len(v.ctrls) == 0:
+                if pos <= func.end:
+                    v.error("operators after the end of the function")
+                break
+            v.push_all(frame.end_types)
+        elif 0x0c == opcode:  # br
+            v.pop_all(v.label(vals[0]))
+            v.set_unreachable()
+        elif 0x0d == opcode:  # br_if
+            v.pop_expect(I32)
+            label_types = v.label(vals[0])
+            v.pop_all(label_types)
+            v.push_all(label_types)
+        elif 0x0e == opcode:  # br_table
+            v.pop_expect(I32)
+            default_types = v.label(vals[-1])
+            for depth in vals[1:-1]:
+                label_types = v.label(depth)
+                if len(label_types) != len(default_types):
+                    v.error("br_table target arity mismatch")
+                for i in range(len(label_types)):
+                    if label_types[i] != default_types[i]:
+                        v.error("br_table target type mismatch")
+            v.pop_all(default_types)
+            v.set_unreachable()
+        elif 0x0f == opcode:  # return
+            v.pop_all(results)
+            v.set_unreachable()
+        elif 0x10 == opcode:  # call
+            if vals[0] >= len(module.function):
+                v.error("unknown function 0x%x" % vals[0])
+            t = module.function[vals[0]].type
+            v.pop_all(t.params)
+            v.push_all(t.results)
+        elif 0x11 == opcode:  # call_indirect
+            if ANYFUNC not in module.table:
+                v.error("call_indirect without a table")
+            if vals[0] >= len(module.type):
+                v.error("unknown type 0x%x" % vals[0])
+            t = module.type[vals[0]]
+            v.pop_expect(I32)
+            v.pop_all(t.params)
+            v.push_all(t.results)
+        elif 0x1a == opcode:  # drop
+            v.pop()
+        elif 0x1b == opcode:  # select
+            v.pop_expect(I32)
+            t = v.pop()
+            v.push(v.pop_expect(t))
+        elif 0x20 <= opcode <= 0x22:  # get_local, set_local, tee_local
+            if vals[0] >= len(locals):
+                v.error("unknown local 0x%x" % vals[0])
+            ltype = locals[vals[0]]
+            if 0x20 != opcode:
+                v.pop_expect(ltype)
+            if 0x21 != opcode:
+                v.push(ltype)
+        elif 0x23 == opcode:  # get_global
+            if vals[0] >= len(module.global_list):
+                v.error("unknown global 0x%x" % vals[0])
+            v.push(module.global_list[vals[0]][0])
+        elif 0x24 == opcode:  # set_global
+            if vals[0] >= len(module.global_list):
+                v.error("unknown global 0x%x" % vals[0])
+            if not module.global_mutable[vals[0]]:
+                v.error("global 0x%x is immutable" % vals[0])
+            v.pop_expect(module.global_list[vals[0]][0])
+        elif 0x28 <= opcode <= 0x40:  # memory operators
+            if not module.has_memory:
+                v.error("memory operator without a memory")
+            if opcode <= 0x3e and (1 << vals[0]) > LOAD_SIZE[opcode]:
+                v.error("alignment larger than natural")
+            if opcode == 0x3f:  # current_memory
+                v.push(I32)
+            elif opcode == 0x40:  # grow_memory
+                v.pop_expect(I32)
+                v.push(I32)
+            else:
+                params, presults = OPERATOR_TYPES[opcode]
+                v.pop_all(params)
+                v.push_all(presults)
+        elif opcode in OPERATOR_TYPES:  # constants and numeric
+            params, presults = OPERATOR_TYPES[opcode]
+            v.pop_all(params)
+            v.push_all(presults)
+        else:
+            v.error("unknown opcode 0x%x" % opcode)
+
+    if opcode != 0x0b or len(v.ctrls) != 0:
+        v.error("function did not end with 0xb")
+
+
+######################################
+# Compiled module cache
+######################################
+
+CACHE_VERSION = 5
+
+# Key of block_type in BLOCK_TYPE
+def block_type_code(block_type):
+    if len(block_type.results) == 0:
+        return BLOCK
+    return block_type.results[0]
+
+# Plain data image of a parsed and decoded module (see
+# Module.to_image). This is also the rmarshal type description, so the
+# RPython build and CPython read and write the same marshal format.
+IMAGE_TYPE = (int,                                 # CACHE_VERSION
+              [(int, [int], [int])],               # types
+              [(str, str, int, int, int, int)],    # imports
+              [(int, int, str, str, [int], [int],
+                [float], int, int,
+                [(int, int, int, int, int,
+                  int, int, int)])],               # functions
+              int, [int],                          # table
+              int, int, int,                       # memory pages, max,
+                                                   # has_memory
+              [(int, str)],                        # data segments
+              [(int, int, float)], [int],          # globals, mutable
+              [(str, int, int)],                   # exports
+              int,                                 # start function
+              [(str, int)],                        # peephole stats
+              int)                                 # compiled count
+
+if IS_RPYTHON:
+    image_dumper = get_marshaller(IMAGE_TYPE)
+    image_loader = get_loader(IMAGE_TYPE)
+
+    def image_dumps(image):
+        buf = []
+        image_dumper(buf, image)
+        return "".join(buf)
+
+    def image_loads(s):
+        return image_loader(s)
+
+    def content_hash(data):
+        return RSHA("".join([chr(b) for b in data])).hexdigest()
+else:
+    def image_dumps(image):
+        return marshal.dumps(image)
+
+    def image_loads(s):
+        return marshal.loads(s)
+
+    def content_hash(data):
+        return hashlib.sha1(data).hexdigest()
+
+def cache_path(cache_dir, data, optimize):
+    suffix = ""
+    if not optimize:
+        suffix = "-noopt"
+    return "%s/%s-%d%s.wpc" % (cache_dir, content_hash(data),
+                               CACHE_VERSION, suffix)
+
+
+######################################
+# Higher level classes
+######################################
+
+# Reads directly from a bytearray of the module (indexing yields ints)
+#
+# With fd set the module is streamed: bytes holds what has been read
+# so far and callers fill() what they are about to parse, so
+# sections are parsed (and functions validated and decoded) while
+# the rest of the module is still arriving.
+class Reader():
+    def __init__(self, bytes, fd=-1):
+        self.bytes = bytes
+        self.pos = 0
+        self.fd = fd  # stream to read from, -1 once at EOF or unset
+
+    # Make sure cnt bytes from pos are in bytes. With partial cnt is
+    # only an upper bound (e.g. for a LEB) and the module may end
+    # sooner.
+    def fill(self, cnt, partial=False):
+        while self.fd >= 0 and len(self.bytes) < self.pos + cnt:
+            data = os.read(self.fd, IO_CHUNK)
+            if not data:
+                self.fd = -1
+                break
+            self.bytes += data
+        if not partial and len(self.bytes) < self.pos + cnt:
+            raise Exception("unexpected end of module")
+
+    def read_byte(self):
+        if self.pos >= len(self.bytes):
+            raise Exception("unexpected end of module")
+        b = self.bytes[self.pos]
+        self.pos += 1
+        return b
+
+    def read_word(self):
+        w = read_I32(self.bytes, self.pos)
+        self.pos += 4
+        return w
+
+    def read_bytes(self, cnt):
+        if VALIDATE: assert cnt >= 0
+        if VALIDATE: assert self.pos >= 0
+        bytes = self.bytes[self.pos:self.pos+cnt]
+        self.pos += cnt
+        return bytes
+
+    def read_LEB(self, maxbits=32, signed=False):
+        if self.pos + (maxbits+6)//7 > len(self.bytes):
+            # Near the end of what has been read: check the LEB ends
+            # before it
+            end = self.pos
+            while end < len(self.bytes) and self.bytes[end] & 0x80:
+                end += 1
+            if end >= len(self.bytes):
+                raise Exception("unexpected end of module")
+        [self.pos, result] = read_LEB(self.bytes, self.pos,
+                maxbits, signed)
+        return result
+
+    def eof(self):
+        self.fill(1, True)
+        return self.pos >= len(self.bytes)
+
+# Linear memory. Only the first pages*64KiB of bytes are accessible;
+# the bounds checks use pages, not len(bytes).
+#
+# Under CPython bytes is an anonymous private mmap that reserves the
+# declared maximum up front (or all of MAX_PAGES if there is none).
+# The OS only backs pages that are touched and grow_memory just bumps
+# pages. If the reservation can't be made, a smaller mapping is used
+# and remapped with doubling when it runs out. RPython uses a
+# bytearray that grows in place.
+class Memory():
+    def __init__(self, pages=1, maximum=-1):
+        debug("memory pages: %d, maximum: %d" % (pages, maximum))
+        self.pages = pages
+        if maximum >= 0:
+            self.maximum = min(maximum, MAX_PAGES)
+        else:
+            self.maximum = MAX_PAGES
+        if IS_RPYTHON:
+            self.bytes = bytearray(pages*(2**16))
+        else:
+            try:
+                self.bytes = self.reserve(self.maximum)
+            except EnvironmentError:
+                self.bytes = self.reserve(pages)
+            self.buf = None  # memoryview of bytes (see view)
+
+    def reserve(self, pages):
+        return mmap.mmap(-1, max(pages, 1)*(2**16), mmap.MAP_PRIVATE)
+
+    # Returns the previous size in pages, or -1 if the memory can't
+    # grow by that many pages
+    def grow(self, pages):
+        prev_pages = self.pages
+        if pages < 0 or prev_pages + pages > self.maximum:
+            return -1
+        self.pages = prev_pages + pages
+        size = self.pages*(2**16)
+        if IS_RPYTHON:
+            self.bytes.extend(bytearray(pages*(2**16)))
+        elif size > len(self.bytes):
+            reserved = min(max(self.pages, 2*len(self.bytes)/(2**16)),
+                           self.maximum)
+            new_bytes = self.reserve(reserved)
+            new_bytes[0:len(self.bytes)] = self.bytes[:]
+            if self.buf is None:
+                self.bytes.close()
+            # (otherwise views keep the old mapping until collected)
+            self.bytes = new_bytes
+            self.buf = None
+        return prev_pages
+
+    def read_byte(self, pos):
+        return read_I8_u(self.bytes, pos)
+
+    def write_byte(self, pos, val):
+        write_I8(self.bytes, pos, val)
+
+    def read_str(self, pos, length):
+        if IS_RPYTHON:
+            return "".join([chr(self.bytes[pos+i]) for i in range(length)])
+        return self.bytes[pos:pos+length]
+
+    def write_str(self, pos, s):
+        if IS_RPYTHON:
+            for i in range(len(s)):
+                self.bytes[pos+i] = ord(s[i])
+        else:
+            self.bytes[pos:pos+len(s)] = s
+
+    # Bounds checked bulk access for host functions. Ranges outside
+    # the current pages trap like guest loads and stores do.
+
+    def check_range(self, pos, length):
+        if pos < 0 or length < 0 or pos + length > self.pages*(2**16):
+            raise WAException("out of bounds memory access")
+
+    # Returns length bytes at pos as a str
+    def read_bytes(self, pos, length):
+        self.check_range(pos, length)
+        return self.read_str(pos, length)
+
+    # Writes the str s at pos
+    def write_bytes(self, pos, s):
+        self.check_range(pos, len(s))
+        self.write_str(pos, s)
+
+    # Copies length bytes from src to dest (the ranges may overlap)
+    def copy(self, dest, src, length):
+        self.check_range(src, length)
+        self.check_range(dest, length)
+        if IS_RPYTHON:
+            if dest <= src:
+                for i in range(length):
+                    self.bytes[dest+i] = self.bytes[src+i]
+            else:
+                for i in range(length-1, -1, -1):
+                    self.bytes[dest+i] = self.bytes[src+i]
+        elif length > 0:
+            self.bytes.move(dest, src, length)
+
+    # Standard python only. Returns a writable memoryview (format 'B')
+    # of length bytes at pos without copying. Reads and writes through
+    # it go straight to linear memory, so a host can fill it with
+    # readinto/recv_into or pass it to write/send. The view is only
+    # valid until the memory grows.
+    def view(self, pos, length):
+        self.check_range(pos, length)
+        if self.buf is None:
+            size = len(self.bytes)
+            self.buf = memoryview(
+                    (ctypes.c_ubyte * size).from_buffer(self.bytes))
+        return self.buf[pos:pos+length]
+
+
+class Import():
+    def __init__(self, module, field, kind, type=0,
+            element_type=0, initial=0, maximum=0, global_type=0,
+            mutability=0):
+        self.module = module
+        self.field = field
+        self.kind = kind
+        self.type = type # Function
+        self.element_type = element_type # Table
+        self.initial = initial # Table & Memory
         self.maximum = maximum # Table & Memory
 
         self.global_type = global_type # Global
@@ -2028,56 +5420,102 @@ class Export():
         self.index = index
 
 
-class Module():
-    def __init__(self, data, host_import_func, exports):
-        assert isinstance(data, str)
-        self.data = data
-        self.rdr = Reader([ord(b) for b in data])
-        self.host_import_func = host_import_func
-        self.exports = exports
+# The parsed and decoded module. This is never modified after
+# loading so it can be shared by any number of Instances.
+class CompiledModule():
+    # If fd is set the module is streamed from it (data is then empty,
+    # see Reader) and reading stops once the Data section is parsed.
+    # With lazy set function bodies are only validated and decoded on
+    # their first call (see compile_function).
+    def __init__(self, data, cache_dir="", optimize=True, fd=-1,
+            lazy=False):
+        assert isinstance(data, bytearray)
+        self.rdr = Reader(data, fd)
 
         # Sections
         self.type = []
         self.import_list = []
         self.function = []
-        self.table = {}
+        self.table = {}  # initial table contents
         self.export_list = []
         self.export_map = {}
-        self.memory = Memory(1)  # default to 1 page
-        self.global_list = []
-
-        # block/loop/if blocks {start addr: Block, ...}
-        self.block_map = {}
-
-        # Execution state
-        self.sp = -1
-        self.fp = -1
-        self.stack = [(0x00, 0, 0.0)] * STACK_SIZE
-        self.csp = -1
-        block = Block(0x00, BLOCK_TYPE[I32], 0)
-        self.callstack = [(block, -1, -1, 0)] * CALLSTACK_SIZE
+        self.memory_pages = 1  # default to 1 page
+        self.memory_maximum = -1  # no declared maximum
+        self.has_memory = False  # declared or imported memory
+        self.data_segments = []  # [(offset, bytes str), ...]
+        self.global_list = []  # initial global values
+        self.global_mutable = []
         self.start_function = -1
-
-        self.read_magic()
-        self.read_version()
-        self.read_sections()
+        self.engine = DEFAULT_ENGINE  # how instances run code
+        self.py_code = {}  # {function index: (code, consts)} (python engine)
+        self.tier_threshold = 1000  # hotness to promote at (tiered engine)
+        self.tier_up = "python"  # tier hot functions are promoted to
+        self.optimize = optimize  # run optimize_function on decoded code
+        self.peephole_stats = {}  # {rewrite name: count}
+        self.lazy = lazy  # defer compile_function to the first call
+        self.compiled_count = 0  # functions compile_function has done
+
+        # Load the parsed/decoded module from the cache if possible
+        cached = False
+        if cache_dir and fd < 0:
+            path = cache_path(cache_dir, data, optimize)
+            cached = self.load_cache(path)
+        if not cached:
+            self.read_magic()
+            self.read_version()
+            self.read_sections()
+            if cache_dir and fd < 0:
+                # The cache holds every function decoded
+                for func in self.function:
+                    if isinstance(func, Function):
+                        ensure_compiled(func)
+                self.save_cache(cache_dir, path)
 
         self.dump()
 
-        # Run the start function if set
-        if self.start_function >= 0:
-            fidx = self.start_function
-            info("Running start function 0x%x" % fidx)
-            if TRACE:
-                dump_stacks(self.sp, self.stack, self.fp, self.csp,
-                        self.callstack)
-            self.rdr.pos, self.sp, self.fp, self.csp = do_call(
-                    self.stack, self.callstack, self.sp, self.fp,
-                    self.csp, self.function[fidx], len(self.rdr.bytes))
-            self.interpret()
+    # Select how instances run code, translating functions up front
+    # for engines that need it
+    def set_engine(self, engine):
+        self.engine = engine
+        if engine == "register":
+            for func in self.function:
+                if isinstance(func, Function) and func.decoded:
+                    translate_registers(func, self.function, self.type)
+
+    # Validate, decode and optimize func from its bytes in the module
+    # (and translate it for the register engine)
+    def compile_function(self, func):
+        debug("  decode_function start: 0x%x, end: 0x%x" % (
+            func.start, func.end))
+        validate_function(self.rdr.bytes, func, self)
+        decode_function(self.rdr.bytes, func, self.function, self.type)
+        if self.optimize:
+            optimize_function(func, self.peephole_stats)
+        if self.engine == "register":
+            translate_registers(func, self.function, self.type)
+        func.decoded = True
+        self.compiled_count += 1
+
+    # Log how many functions have been compiled (see lazy)
+    def report_compiled(self):
+        total = 0
+        for func in self.function:
+            if isinstance(func, Function):
+                total += 1
+        info("Compiled %d of %d functions" % (self.compiled_count, total))
+
+    # Log how often each optimize_function rewrite fired
+    def report_peephole(self):
+        if not self.optimize:
+            info("Peephole optimizer disabled")
+            return
+        info("Peephole rewrites:")
+        names = self.peephole_stats.keys()
+        names.sort()
+        for name in names:
+            info("  %6d %s" % (self.peephole_stats[name], name))
 
     def dump(self):
-        #debug("raw module data: %s" % self.data)
         debug("module bytes: %s" % byte_code_repr(self.rdr.bytes))
         info("")
 
@@ -2114,11 +5552,10 @@ class Module():
             s = "%x" % x
             return '0' * (cnt-len(s)) + s
 
-        info("Memory:")
-        if self.memory.pages > 0:
-            for r in range(10):
-                info("  0x%s [%s]" % (hexpad(r*16,3),
-                    ",".join([hexpad(b,2) for b in self.memory.bytes[r*16:r*16+16]])))
+        info("Memory: %d pages" % self.memory_pages)
+        for offset, seg in self.data_segments:
+            info("  0x%s [%s]" % (hexpad(offset,3),
+                ",".join([hexpad(ord(c),2) for c in seg[:16]])))
 
         info("Global:")
         for i, g in enumerate(self.global_list):
@@ -2129,18 +5566,22 @@ class Module():
             info("  0x%x %s" % (i, export_repr(e)))
         info("")
 
-        bl = self.block_map
-        block_keys = bl.keys()
-        do_sort(block_keys)
-        info("block_map: %s" % (
-            ["%s[0x%x->0x%x]" % (block_repr(bl[k]), bl[k].start, bl[k].end)
-             for k in block_keys]))
+        info("Block maps:")
+        for f in self.function:
+            if not isinstance(f, Function): continue
+            bl = f.block_map
+            block_keys = bl.keys()
+            do_sort(block_keys)
+            info("  0x%x %s" % (f.index,
+                ["%s[0x%x->0x%x]" % (block_repr(bl[k]), bl[k].start, bl[k].end)
+                 for k in block_keys]))
         info("")
 
 
     ## Wasm top-level readers
 
     def read_magic(self):
+        self.rdr.fill(8)  # magic and version
         magic = self.rdr.read_word()
         if magic != MAGIC:
             raise Exception("Wanted magic 0x%x, got 0x%x" % (
@@ -2152,11 +5593,16 @@ class Module():
             raise Exception("Wanted version 0x%x, got 0x%x" % (
                 VERSION, self.version))
 
+    # Returns the section id
     def read_section(self):
         cur_pos = self.rdr.pos
+        self.rdr.fill(6, True)  # id and length
         id = self.rdr.read_LEB(7)
         name = SECTION_NAMES[id]
         length = self.rdr.read_LEB(32)
+        if "Code" != name:
+            # Code is filled per function body (see parse_Code_body)
+            self.rdr.fill(length)
         debug("parsing %s(%d), section start: 0x%x, payload start: 0x%x, length: 0x%x bytes" % (
             name, id, cur_pos, self.rdr.pos, length))
         if   "Type" == name:     self.parse_Type(length)
@@ -2171,10 +5617,39 @@ class Module():
         elif "Code" == name:     self.parse_Code(length)
         elif "Data" == name:     self.parse_Data(length)
         else:                    self.rdr.read_bytes(length)
+        return id
 
     def read_sections(self):
         while not self.rdr.eof():
-            self.read_section()
+            id = self.read_section()
+            if id == 11 and self.rdr.fd >= 0:
+                # Only custom sections can follow Data, so the module
+                # is complete. Leave the rest of the stream unread.
+                info("Streamed module complete after 0x%x bytes" % (
+                    self.rdr.pos))
+                break
+
+    # MVP init_exprs are a single constant or get_global followed by
+    # end, so evaluate them directly instead of interpreting them
+    def read_init_expr(self):
+        opcode = self.rdr.read_byte()
+        if   0x41 == opcode:  # i32.const
+            val = (I32, self.rdr.read_LEB(32, signed=True), 0.0)
+        elif 0x42 == opcode:  # i64.const
+            val = (I64, self.rdr.read_LEB(64, signed=True), 0.0)
+        elif 0x43 == opcode:  # f32.const
+            val = (F32, 0, read_F32(self.rdr.bytes, self.rdr.pos))
+            self.rdr.pos += 4
+        elif 0x44 == opcode:  # f64.const
+            val = (F64, 0, read_F64(self.rdr.bytes, self.rdr.pos))
+            self.rdr.pos += 8
+        elif 0x23 == opcode:  # get_global
+            val = self.global_list[self.rdr.read_LEB(32)]
+        else:
+            raise Exception("invalid init_expr opcode 0x%x" % opcode)
+        if self.rdr.read_byte() != 0x0b:
+            raise Exception("init_expr did not end with 0xb")
+        return val
 
     ## Wasm section handlers
 
@@ -2214,7 +5689,8 @@ class Module():
                 type = self.type[type_index]
                 imp = Import(module, field, kind, type=type_index)
                 self.import_list.append(imp)
-                func = FunctionImport(type, module, field)
+                func = FunctionImport(type, len(self.function),
+                        module, field)
                 self.function.append(func)
             elif kind in [0x1,0x2]:  # Table & Memory
                 if kind == 0x1:
@@ -2227,11 +5703,14 @@ class Module():
                     maximum = 0
                 self.import_list.append(Import(module, field, kind,
                     initial=initial, maximum=maximum))
+                if kind == 0x2:
+                    self.has_memory = True
             elif kind == 0x3:  # Global
                 type = self.rdr.read_byte()
                 mutability = self.rdr.read_LEB(1)
                 if "%s.%s" % (module, field) == "spectest.global":
                     self.global_list.append((type, 666, 666.6))
+                    self.global_mutable.append(mutability)
                 else:
                     raise Exception("unsupported global import %s.%s" % (
                         module, field))
@@ -2268,30 +5747,22 @@ class Module():
         if flags & 0x1:
             maximum = self.rdr.read_LEB(32)
         else:
-            maximum = 0
-        self.memory = Memory(initial)
+            maximum = -1
+        self.memory_pages = initial
+        self.memory_maximum = maximum
+        self.has_memory = True
 
     def parse_Global(self, length):
         count = self.rdr.read_LEB(32)
-        print("parse_Global count: %s" % count)
         for c in range(count):
             content_type = self.rdr.read_LEB(7)
             mutable = self.rdr.read_LEB(1)
-            print("global: content_type: %s, mutable: %s"
-                    % (content_type, mutable))
-            # Run the init_expr
-            block = Block(0x00, BLOCK_TYPE[content_type], self.rdr.pos)
-            self.csp += 1
-            self.callstack[self.csp] = (block, self.sp, self.fp, 0)
-            # WARNING: running code here to get offset!
-            self.interpret()  # run iter_expr
-            _, _, self.sp, self.fp, self.csp = pop_block(
-                    self.stack, self.callstack, self.sp, self.fp, self.csp)
-            init_val = self.stack[self.sp]
-            print("init_val: %s" % init_val)
-            self.sp -= 1
+            init_val = self.read_init_expr()
+            debug("  parsed global: %s, mutable: %s" % (
+                value_repr(init_val), mutable))
             assert content_type == init_val[0]
             self.global_list.append(init_val)
+            self.global_mutable.append(mutable)
 
     def parse_Export(self, length):
         count = self.rdr.read_LEB(32)
@@ -2318,14 +5789,7 @@ class Module():
             index = self.rdr.read_LEB(32)
             assert index == 0  # Only 1 default table in MVP
 
-            # Run the init_expr
-            block = Block(0x00, BLOCK_TYPE[I32], self.rdr.pos)
-            self.csp += 1
-            self.callstack[self.csp] = (block, self.sp, self.fp, 0)
-            # WARNING: running code here to get offset!
-            self.interpret()  # run iter_expr
-            offset_val = self.stack[self.sp]
-            self.sp -= 1
+            offset_val = self.read_init_expr()
             assert offset_val[0] == I32
             offset = int(offset_val[1])
 
@@ -2338,7 +5802,9 @@ class Module():
         assert self.rdr.pos == start+length
 
     def parse_Code_body(self, idx):
+        self.rdr.fill(5, True)
         body_size = self.rdr.read_LEB(32)
+        self.rdr.fill(body_size)
         payload_start = self.rdr.pos
         #debug("body_size %d" % body_size)
         local_count = self.rdr.read_LEB(32)
@@ -2357,11 +5823,12 @@ class Module():
         func = self.function[idx]
         assert isinstance(func,Function)
         func.update(locals, start, end)
-        debug("  find_blocks start: 0x%x, end: 0x%x" % (start, end))
-        self.block_map = find_blocks(
-                self.rdr.bytes, start, end, self.block_map)
+        func.owner = self
+        if not self.lazy:
+            self.compile_function(func)
 
     def parse_Code(self, length):
+        self.rdr.fill(5, True)
         body_count = self.rdr.read_LEB(32)
         import_cnt = len(self.import_list)
         for idx in range(body_count):
@@ -2373,189 +5840,970 @@ class Module():
             index = self.rdr.read_LEB(32)
             assert index == 0  # Only 1 default memory in MVP
 
-            # Run the init_expr
-            block = Block(0x00, BLOCK_TYPE[I32], self.rdr.pos)
-            self.csp += 1
-            self.callstack[self.csp] = (block, self.sp, self.fp, 0)
-            # WARNING: running code here to get offset!
-            self.interpret()  # run iter_expr
-            offset_val = self.stack[self.sp]
-            self.sp -= 1
+            offset_val = self.read_init_expr()
             assert offset_val[0] == I32
             offset = int(offset_val[1])
 
             size = self.rdr.read_LEB(32)
-            for addr in range(offset, offset+size, 1):
-                self.memory.bytes[addr] = self.rdr.read_byte()
+            seg = "".join([chr(b) for b in self.rdr.read_bytes(size)])
+            self.data_segments.append((offset, seg))
+
+    ## Compiled module cache
+
+    # Everything needed to recreate the module without parsing it
+    def to_image(self):
+        types = [(t.form, t.params, t.results) for t in self.type]
+        imports = [(i.module, i.field, i.kind, i.type, i.initial,
+                    i.maximum) for i in self.import_list]
+        functions = []
+        for f in self.function:
+            if isinstance(f, FunctionImport):
+                functions.append((0, f.type.index, f.module, f.field,
+                                  [], [], [], 0, 0, []))
+            else:
+                assert isinstance(f, Function)
+                blocks = []
+                for addr, b in f.block_map.items():
+                    blocks.append((addr, b.kind, block_type_code(b.type),
+                                   b.start, b.end, b.else_addr,
+                                   b.br_addr, b.height))
+                functions.append((1, f.type.index, "", "",
+                                  f.locals, f.code, f.consts,
+                                  f.start, f.end, blocks))
+        if ANYFUNC in self.table:
+            has_table, table = 1, self.table[ANYFUNC]
+        else:
+            has_table, table = 0, []
+        globals = [(g[0], g[1], g[2]) for g in self.global_list]
+        exports = [(e.field, e.kind, e.index) for e in self.export_list]
+        stats = [(name, count)
+                 for name, count in self.peephole_stats.items()]
+        has_memory = 0
+        if self.has_memory:
+            has_memory = 1
+        return (CACHE_VERSION, types, imports, functions,
+                has_table, table, self.memory_pages, self.memory_maximum,
+                has_memory, self.data_segments,
+                globals, self.global_mutable, exports,
+                self.start_function, stats, self.compiled_count)
+
+    def from_image(self, image):
+        (version, types, imports, functions, has_table, table, pages,
+         maximum, has_memory, segments, globals, global_mutable, exports,
+         start_function, stats, compiled_count) = image
+        if version != CACHE_VERSION:
+            raise Exception("cache version 0x%x != 0x%x" % (
+                version, CACHE_VERSION))
+
+        type_list = []
+        for form, params, results in types:
+            type_list.append(Type(len(type_list), form, params, results))
+        import_list = []
+        for module, field, kind, tidx, initial, maximum in imports:
+            import_list.append(Import(module, field, kind, type=tidx,
+                initial=initial, maximum=maximum))
+        function = []
+        for (defined, tidx, module, field, locals, code, consts,
+             start, end, blocks) in functions:
+            if defined:
+                func = Function(type_list[tidx], len(function))
+                func.update(locals, start, end)
+                func.code = code
+                func.consts = consts
+                for (addr, kind, btype, bstart, bend, else_addr, br_addr,
+                     height) in blocks:
+                    block = Block(kind, BLOCK_TYPE[btype], bstart)
+                    block.update(bend, br_addr)
+                    block.else_addr = else_addr
+                    block.height = height
+                    func.block_map[addr] = block
+                func.decoded = True
+                function.append(func)
+            else:
+                function.append(FunctionImport(type_list[tidx],
+                    len(function), module, field))
+
+        self.type = type_list
+        self.import_list = import_list
+        self.function = function
+        self.table = {}
+        if has_table:
+            self.table[ANYFUNC] = table
+        self.memory_pages = pages
+        self.memory_maximum = maximum
+        self.has_memory = has_memory != 0
+        self.data_segments = segments
+        self.global_list = globals
+        self.global_mutable = global_mutable
+        self.export_list = []
+        self.export_map = {}
+        for field, kind, index in exports:
+            exp = Export(field, kind, index)
+            self.export_list.append(exp)
+            self.export_map[field] = exp
+        self.start_function = start_function
+        self.peephole_stats = {}
+        for name, count in stats:
+            self.peephole_stats[name] = count
+        # Functions in the image were compiled when it was saved
+        self.compiled_count = compiled_count
+
+    def load_cache(self, path):
+        try:
+            f = open(path, 'rb')
+            try:
+                image = image_loads(f.read())
+            finally:
+                f.close()
+            self.from_image(image)
+        except Exception as e:
+            debug("compiled module cache miss: %s" % path)
+            return False
+        info("Loaded compiled module from %s" % path)
+        return True
+
+    def save_cache(self, cache_dir, path):
+        try:
+            try:
+                os.mkdir(cache_dir)
+            except OSError:
+                pass  # already exists
+            # write and rename so readers never see a partial file
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(image_dumps(self.to_image()))
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except Exception as e:
+            debug("failed to write compiled module cache: %s" % path)
+            return
+        info("Saved compiled module to %s" % path)
+
+
+# Per-instance execution state (memory, table, globals and stacks) of
+# a CompiledModule. Creating one does not reparse or redecode anything.
+class Instance():
+    _immutable_fields_ = ['compiled', 'imports', 'type',
+                          'function', 'export_map', 'table', 'memory',
+                          'istack', 'fstack', 'callstack']
+
+    def __init__(self, compiled, registry, exports):
+        self.compiled = compiled
+        self.exports = exports
+
+        # Shared (read-only) parts of the module
+        self.type = compiled.type
+        self.function = compiled.function
+        self.export_map = compiled.export_map
+        self.imports = registry.bind(self.function)
+
+        # Per-instance copies of the mutable parts
+        self.table = {}
+        for t, entries in compiled.table.items():
+            self.table[t] = entries[:]
+        self.memory = Memory(compiled.memory_pages,
+                compiled.memory_maximum)
+        for offset, seg in compiled.data_segments:
+            self.memory.write_str(offset, seg)
+        self.global_list = compiled.global_list[:]
+
+        # Execution state
+        self.sp = -1
+        self.fp = -1
+        self.istack = [0] * STACK_SIZE
+        self.fstack = [0.0] * STACK_SIZE
+        self.csp = -1
+        self.callstack = [Frame() for i in range(CALLSTACK_INIT)]
+        if not IS_RPYTHON:
+            # Closure engine code compiled on first call
+            self.closure_code = {}  # {function index: [block, ...]}
+            self.closure_index = {}  # {function index: {pc: block}}
+            self.closure_state = ClosureState()
+        self.py_funcs = None  # see py_setup
+        self.tiering = compiled.engine == "tiered"
+        self.tiers = {}  # {function index: tier} (see tier_of)
+
+        # Run the start function if set
+        if compiled.start_function >= 0:
+            fidx = compiled.start_function
+            info("Running start function 0x%x" % fidx)
+            if TRACE:
+                dump_stacks(self.sp, self.istack, self.fstack, self.fp,
+                        self.csp, self.callstack)
+            self.interpret(self.function[fidx])
+
+    # Call func with its arguments already on the value stack
+    def interpret(self, func):
+        engine = self.compiled.engine
+        if engine in ("python", "tiered") and not IS_RPYTHON:
+            if self.py_funcs is None:
+                py_setup(self)
+            # Each wasm call in the python tier is a Python call (the
+            # depth is limited to CALLSTACK_SIZE by py_call and the
+            # generated calls), so allow that much recursion during
+            # the call only
+            limit = sys.getrecursionlimit()
+            if limit < CALLSTACK_SIZE + 1000:
+                sys.setrecursionlimit(CALLSTACK_SIZE + 1000)
+            try:
+                sp = tier_call(self, func, self.sp, self.fp, self.csp)
+                if sp == NOT_TIERED:
+                    self.run_interpreter(func,
+                            tier_interpreter(self, func))
+                else:
+                    self.sp = sp
+            except RuntimeError as e:
+                # Calls that go back and forth between the tiers take
+                # several Python frames each
+                if "recursion" not in str(e):
+                    raise
+                raise WAException("call stack exhausted")
+            finally:
+                sys.setrecursionlimit(limit)
+        elif engine == "table":
+            self.run_interpreter(func, interpret_table)
+        elif engine == "register":
+            self.run_interpreter(func, interpret_register)
+        elif engine == "closure" and not IS_RPYTHON:
+            self.run_interpreter(func, interpret_closure)
+        else:
+            self.run_interpreter(func, interpret_mvp)
 
-    def interpret(self):
-        self.rdr.pos, self.sp, self.fp, self.csp = interpret_mvp(self,
+    def run_interpreter(self, func, interpret):
+        sp = do_call(self.istack, self.fstack, self.callstack,
+                self.sp, self.fp, self.csp, func, 0, None)
+        self.sp = interpret(self,
                 # Greens
-                self.rdr.pos, self.rdr.bytes, self.function,
-                self.table, self.block_map,
+                0, func,
                 # Reds
-                self.memory, self.sp, self.stack, self.fp, self.csp,
+                self.memory, sp, self.istack, self.fstack,
+                self.callstack[self.csp+1].sp + 1, self.csp+1,
                 self.callstack)
 
 
-    def run(self, all_args):
+    # Call an exported function with string arguments and return a
+    # list of its results (empty or one value in the MVP)
+    def call(self, name, args):
         # Reset stacks
         self.sp  = -1
         self.fp  = -1
         self.csp = -1
 
-        name = all_args[0]
-        args = all_args[1:]
-
+        if name not in self.export_map:
+            raise Exception("unknown export '%s'" % name)
         fidx = self.export_map[name].index
 
         # Args are strings so convert to expected numeric type
         tparams = self.function[fidx].type.params
+        if len(args) != len(tparams):
+            raise Exception("%s takes %d arguments (%d given)" % (
+                name, len(tparams), len(args)))
+        if len(args) >= len(self.istack):
+            grow_stacks(self.istack, self.fstack, len(args) + 1)
         for idx, arg in enumerate(args):
             arg = args[idx].lower()
             assert isinstance(arg, str)
+            val = parse_number(tparams[idx], arg)
             self.sp += 1
-            self.stack[self.sp] = parse_number(tparams[idx], arg)
+            self.istack[self.sp] = val[1]
+            self.fstack[self.sp] = val[2]
 
         info("Running function '%s' (0x%x)" % (name, fidx))
         if TRACE:
-            dump_stacks(self.sp, self.stack, self.fp, self.csp,
-                    self.callstack)
-        self.rdr.pos, self.sp, self.fp, self.csp = do_call(
-                self.stack, self.callstack, self.sp, self.fp,
-                self.csp, self.function[fidx], 0)
-
-        self.interpret()
+            dump_stacks(self.sp, self.istack, self.fstack, self.fp,
+                    self.csp, self.callstack)
+        func = self.function[fidx]
+        self.interpret(func)
         if TRACE:
-            dump_stacks(self.sp, self.stack, self.fp, self.csp,
-                    self.callstack)
-        if self.sp >= 0:
-            ret = self.stack[self.sp]
+            dump_stacks(self.sp, self.istack, self.fstack, self.fp,
+                    self.csp, self.callstack)
+        results = func.type.results
+        if len(results) > 0 and self.sp >= 0:
+            ret = (results[0], self.istack[self.sp], self.fstack[self.sp])
             self.sp -= 1
             info("%s(%s) = %s" % (
                 name, ",".join(args), value_repr(ret)))
-            print(value_repr(ret))
+            return [ret]
         else:
             info("%s(%s)" % (
                 name, ",".join(args)))
-            print("")
+            return []
+
+    def run(self, all_args):
+        results = self.call(all_args[0], all_args[1:])
+        if len(results) > 0:
+            writeline(value_repr(results[0]))
+        else:
+            writeline("")
+        return 0
+
+    # Run one "export arg..." command line against this instance,
+    # writing a result (or exception/error) line to out_fd. Blank and
+    # comment lines are skipped. Returns False if the call trapped or
+    # the command was bad.
+    def run_command(self, line, out_fd):
+        words = [w for w in line.strip().split(' ') if w]
+        if len(words) == 0 or words[0].startswith('#'):
+            return True
+        try:
+            results = self.call(words[0], words[1:])
+            flush_output()  # the call's own output goes first
+            if len(results) > 0:
+                os.write(out_fd, "%s\n" % value_repr(results[0]))
+            else:
+                os.write(out_fd, "\n")
+        except WAException as e:
+            flush_output()
+            os.write(out_fd, "Exception: %s\n" % e.message)
+            return False
+        except Exception as e:
+            # Bad command (unknown export, bad arguments)
+            flush_output()
+            os.write(out_fd, "Error: %s\n" % e)
+            return False
+        return True
+
+    # Run one command per line from fd against this instance
+    def run_batch(self, fd):
+        rdr = line_reader(fd)
+        errors = 0
+        while True:
+            line = rdr.readline()
+            if line is None: break
+            if not self.run_command(line, 1):
+                errors += 1
+        if errors > 0:
+            return 1
         return 0
 
+
+# Parse/decode a module and create a single Instance of it
+class Module(Instance):
+    def __init__(self, data, registry, exports, cache_dir=""):
+        Instance.__init__(self, CompiledModule(data, cache_dir),
+                registry, exports)
+
 ######################################
 # Imported functions points
 ######################################
 
 
+# Size of the reads done by LineReader and of the output buffer
+# (output is written out once this much is pending)
+IO_CHUNK = 65536
+
+# Buffered line reading from a file descriptor
+class LineReader():
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = ''
+        self.pos = 0  # start of the unread part of buf
+        self.eof = False
+
+    # Returns the next line without the newline, or None at EOF
+    def readline(self):
+        while True:
+            pos = self.pos
+            assert pos >= 0
+            nl = self.buf.find('\n', pos)
+            if nl >= 0:
+                self.pos = nl + 1
+                return self.buf[pos:nl]
+            if self.eof:
+                if pos >= len(self.buf): return None
+                line = self.buf[pos:]
+                self.buf = ''
+                self.pos = 0
+                return line
+            data = os.read(self.fd, IO_CHUNK)
+            if not data: self.eof = True
+            self.buf = self.buf[pos:] + data
+            self.pos = 0
+
+# Output to a file descriptor collected into large writes. Pending
+# output is written when it reaches IO_CHUNK bytes, on flush, before
+# reading input (see readline) and at exit (see entry_point). With
+# line_buffered set (stdout is a terminal) every line is written.
+class OutputBuffer():
+    def __init__(self, fd):
+        self.fd = fd
+        self.chunks = []
+        self.size = 0
+        self.line_buffered = False
+
+    def write(self, s):
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.size >= IO_CHUNK or self.line_buffered:
+            self.flush()
+
+    def flush(self):
+        if not IS_RPYTHON:
+            # Keep ordering with anything printed through sys.stdout
+            sys.stdout.flush()
+        if self.size == 0:
+            return
+        data = "".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        write_all(self.fd, data)
+
+STDIN = LineReader(0)
+STDOUT = OutputBuffer(1)
+
+# The reader for fd. Standard input has a single reader (STDIN) so
+# batch commands and core.readline share its buffer: a guest readline
+# reads the lines after its command.
+def line_reader(fd):
+    if fd == 0:
+        return STDIN
+    return LineReader(fd)
+
 def writeline(s):
-    print(s)
+    STDOUT.write(s + "\n")
 
 def readline(prompt):
-    res = ''
-    os.write(1, prompt)
-    while True:
-        buf = os.read(0, 255)
-        if not buf: raise EOFError()
-        res += buf
-        if res[-1] == '\n': return res[:-1]
-
-
-
-# Marshall, unmarshall for the imported functions
-# Current hard-coded for each function
-def call_import(mem, module, field, args):
-    fname = "%s.%s" % (module, field)
-    result = []
-    if   fname == "core.DEBUG":
-        if len(args) == 1:
-            print("DEBUG: %s" % (value_repr(args[0])))
-        elif len(args) == 2:
-            print("DEBUG: %s %s" % (
-                value_repr(args[0]), value_repr(args[1])))
-        else:
-            raise Exception("DEBUG called with > 2 args")
-    elif fname == "spectest.print":
-        assert len(args) == 1
-        assert args[0][0] == I32
-        val = args[0][1]
-        res = ""
-        while val > 0:
-            res = res + chr(val & 0xff)
-            val = val>>8
-        print("%s '%s'" % (value_repr(args[0]), res))
-    elif fname == "core.writeline":
-        addr = args[0][1]  # I32
-        assert addr >= 0
-        debug("writeline addr: %s" % addr)
-
-        length = read_I32(mem.bytes, addr)
-        assert length >= 0
-        bytes = mem.bytes[addr+4:addr+4+length]
-        str = "".join([chr(b) for b in bytes])
-        writeline(str)
-    elif fname == "core.readline":
-        addr = args[0][1]  # I32
-        max_length = args[1][1]  # I32
-        assert addr >= 0
-        assert max_length >= 0
-        debug("readline addr: %s, max_length: %s" % (addr,
-            max_length))
+    STDOUT.write(prompt)
+    STDOUT.flush()
+    line = STDIN.readline()
+    if line is None: raise EOFError()
+    return line
 
-        try:
-            res = readline("user> ")
-            res = res[0:max_length]
-            length = len(res)
+def flush_output():
+    STDOUT.flush()
 
-            # first four bytes are length
-            write_I32(mem.bytes, addr, 0)
-            start = addr+4
 
-            pos = start
+# Host functions are registered per (module, field) with their
+# signature and each instance binds its FunctionImports to them once
+# (see ImportRegistry.bind), so calls go straight to the host with no
+# name lookup or boxing of the arguments.
+#
+# fn is called as fn(memory, istack, fstack, sp, func) with the
+# arguments of the import func in the top len(func.type.params)
+# value stack slots (the last one at sp). It pops them, pushes the
+# results and returns the new sp. params is None for host functions
+# that accept any parameters.
+class HostFunction():
+    _immutable_fields_ = ['module', 'field', 'params', 'results', 'fn']
+
+    def __init__(self, module, field, params, results, fn):
+        self.module = module
+        self.field = field
+        self.params = params
+        self.results = results
+        self.fn = fn
+
+    def matches(self, t):
+        if self.params is not None and not same_types(self.params,
+                                                      t.params):
+            return False
+        return same_types(self.results, t.results)
+
+def same_types(a, b):
+    if len(a) != len(b): return False
+    for i in range(len(a)):
+        if a[i] != b[i]: return False
+    return True
+
+class ImportRegistry():
+    def __init__(self):
+        self.hosts = {}  # {"module.field": HostFunction}
+
+    def register(self, module, field, params, results, fn):
+        self.hosts["%s.%s" % (module, field)] = HostFunction(
+                module, field, params, results, fn)
+
+    # Standard python only. Register pyfn called as pyfn(memory, *args)
+    # with the arguments as Python numbers and returning the result (or
+    # None when results is empty).
+    def register_python(self, module, field, params, results, pyfn):
+        nparams = len(params)
+        def fn(memory, istack, fstack, sp, func):
+            sp -= nparams
+            args = [py_arg(istack, fstack, params[i], sp+1+i)
+                    for i in range(nparams)]
+            res = pyfn(memory, *args)
+            if len(results) > 0:
+                rtype = results[0]
+                if rtype == I32: res = int(int2int32(res))
+                elif rtype == I64: res = int(int2int64(res))
+                sp += 1
+                py_push(istack, fstack, rtype, sp, res)
+            return sp
+        self.register(module, field, params, results, fn)
+
+    # Returns the HostFunction of each import in function (None for
+    # functions defined by the module), indexed by function index.
+    # Imports that are not registered are bound to a host that traps
+    # when called.
+    def bind(self, function):
+        imports = [None] * len(function)
+        for fidx in range(len(function)):
+            func = function[fidx]
+            if not isinstance(func, FunctionImport):
+                continue
+            host = self.hosts.get("%s.%s" % (func.module, func.field),
+                                  None)
+            if host is None:
+                host = HostFunction(func.module, func.field, None,
+                        func.type.results, host_missing)
+            elif not host.matches(func.type):
+                raise Exception("import signature mismatch %s.%s: %s" % (
+                    func.module, func.field, type_repr(func.type)))
+            imports[fidx] = host
+        return imports
+
+def host_missing(mem, istack, fstack, sp, func):
+    raise Exception("invalid import %s.%s" % (func.module, func.field))
+
+def host_debug(mem, istack, fstack, sp, func):
+    t = func.type
+    if len(t.params) == 1:
+        writeline("DEBUG: %s" % (
+            value_repr((t.params[0], istack[sp], fstack[sp]))))
+    elif len(t.params) == 2:
+        writeline("DEBUG: %s %s" % (
+            value_repr((t.params[0], istack[sp-1], fstack[sp-1])),
+            value_repr((t.params[1], istack[sp], fstack[sp]))))
+    else:
+        raise Exception("DEBUG called with > 2 args")
+    return sp - len(t.params)
+
+def host_print(mem, istack, fstack, sp, func):
+    val = istack[sp]  # I32
+    res = ""
+    while val > 0:
+        res = res + chr(val & 0xff)
+        val = val>>8
+    writeline("%s '%s'" % (value_repr((I32, istack[sp], 0.0)), res))
+    return sp - 1
+
+def host_writeline(mem, istack, fstack, sp, func):
+    addr = istack[sp]  # I32
+    assert addr >= 0
+    debug("writeline addr: %s" % addr)
+
+    mem.check_range(addr, 4)
+    length = read_I32(mem.bytes, addr)
+    writeline(mem.read_bytes(addr+4, length))
+    return sp - 1
+
+def host_readline(mem, istack, fstack, sp, func):
+    addr = istack[sp-1]  # I32
+    max_length = istack[sp]  # I32
+    assert addr >= 0
+    assert max_length >= 0
+    debug("readline addr: %s, max_length: %s" % (addr,
+        max_length))
+
+    sp -= 1
+    try:
+        res = readline("user> ")
+        res = res[0:max_length]
+        length = len(res)
+
+        # first four bytes are length
+        mem.check_range(addr, 4)
+        mem.write_bytes(addr+4, res)
+        write_I32(mem.bytes, addr, length)
+
+        istack[sp] = length
+    except EOFError:
+        istack[sp] = -1
+    return sp
 
-            for i in range(length):
-                mem.bytes[pos] = ord(res[i])
-                pos += 1
-            write_I32(mem.bytes, addr, length)
+def host_flush(mem, istack, fstack, sp, func):
+    flush_output()
+    return sp
 
-            result.append((I32, int(length), 0.0))
-        except EOFError:
-            result.append((I32, int(-1), 0.0))
-    else:
-        raise Exception("invalid import %s.%s" % (module, field))
-    return result
+# Imports provided to every module run from the command line
+CORE_IMPORTS = ImportRegistry()
+CORE_IMPORTS.register("core", "DEBUG", None, [], host_debug)
+CORE_IMPORTS.register("spectest", "print", [I32], [], host_print)
+CORE_IMPORTS.register("core", "writeline", [I32], [], host_writeline)
+CORE_IMPORTS.register("core", "readline", [I32, I32], [I32],
+        host_readline)
+CORE_IMPORTS.register("core", "flush", [], [], host_flush)
 
 
 ######################################
 # Entry points
 ######################################
 
+# Read a wasm file into a bytearray in a single pass (one byte per
+# module byte and no intermediate str copy under CPython)
+def read_wasm_file(path):
+    if IS_RPYTHON:
+        return bytearray(open(path).read())
+    f = open(path, 'rb')
+    try:
+        data = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(data)
+    finally:
+        f.close()
+    return data
+
+# Returns a file descriptor to stream the module at path from (see
+# Reader), or -1 for regular files, which read_wasm_file reads in
+# one go. A path of "-" is standard input.
+def open_wasm_stream(path):
+    if path == "-":
+        return 0
+    fd = os.open(path, os.O_RDONLY, 0777)
+    if stat.S_ISREG(os.fstat(fd).st_mode):
+        os.close(fd)
+        return -1
+    return fd
+
+######################################
+# Server mode
+######################################
+
+if IS_RPYTHON:
+    POLLIN = rpoll.POLLIN
+
+    def unix_listen(path):
+        sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+        sock.bind(rsocket.UNIXAddress(path))
+        sock.listen(64)
+        return sock
+
+    def unix_accept(sock):
+        fd, _ = sock.accept()
+        return fd
+
+    def poll_readable(fds):
+        fddict = {}
+        for fd in fds:
+            fddict[fd] = POLLIN
+        return [fd for fd, _ in rpoll.poll(fddict, -1)]
+else:
+    POLLIN = select.POLLIN
+
+    def unix_listen(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.listen(64)
+        return sock
+
+    def unix_accept(sock):
+        conn, _ = sock.accept()
+        return os.dup(conn.fileno())  # conn is closed when collected
+
+    def poll_readable(fds):
+        p = select.poll()
+        for fd in fds:
+            p.register(fd, POLLIN)
+        return [fd for fd, _ in p.poll()]
+
+def write_all(fd, data):
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n:]
+
+# Frames are a 4 byte big-endian payload length followed by the payload
+def frame(payload):
+    n = len(payload)
+    return "%s%s%s%s%s" % (chr((n>>24) & 0xff), chr((n>>16) & 0xff),
+                           chr((n>>8) & 0xff), chr(n & 0xff), payload)
+
+# Instances of a CompiledModule created ahead of time, so a new
+# connection does not wait for memory allocation or the start function
+class InstancePool():
+    def __init__(self, compiled, size):
+        self.compiled = compiled
+        self.size = size
+        self.instances = []
+        self.fill()
+
+    def fill(self):
+        while len(self.instances) < self.size:
+            self.instances.append(Instance(self.compiled, CORE_IMPORTS, {}))
+
+    def take(self):
+        if len(self.instances) > 0:
+            return self.instances.pop()
+        return Instance(self.compiled, CORE_IMPORTS, {})
+
+# A client connection. Each connection gets its own Instance so calls
+# on the same connection share memory and globals.
+class Connection():
+    def __init__(self, fd, instance):
+        self.fd = fd
+        self.instance = instance
+        self.buf = ''
+
+    # Answer every complete request frame in the buffer. Requests may
+    # be pipelined; responses are written in request order.
+    def handle(self, data):
+        self.buf += data
+        out = []
+        pos = 0
+        while len(self.buf) - pos >= 4:
+            n = ((ord(self.buf[pos]) << 24) | (ord(self.buf[pos+1]) << 16) |
+                 (ord(self.buf[pos+2]) << 8) | ord(self.buf[pos+3]))
+            if len(self.buf) - pos - 4 < n: break
+            start = pos + 4
+            end = start + n
+            assert end >= 0
+            out.append(frame(self.invoke(self.buf[start:end])))
+            pos = end
+        self.buf = self.buf[pos:]
+        if len(out) > 0:
+            write_all(self.fd, "".join(out))
+
+    def invoke(self, request):
+        words = [w for w in request.strip().split(' ') if w]
+        if len(words) == 0:
+            return "Error: empty request"
+        try:
+            results = self.instance.call(words[0], words[1:])
+            if len(results) > 0:
+                return value_repr(results[0])
+            return ""
+        except WAException as e:
+            return "Exception: %s" % e.message
+        except Exception as e:
+            return "Error: %s" % e
+
+# Serve calls to compiled on a unix socket until killed
+def serve(compiled, path, pool_size):
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)  # stale socket from a previous server
+    except OSError:
+        pass
+    sock = unix_listen(path)
+    listen_fd = sock.fileno()
+    pool = InstancePool(compiled, pool_size)
+    conns = {}
+    info("Serving on %s (pool size %d)" % (path, pool_size))
+    while True:
+        fds = [listen_fd]
+        fds.extend(conns.keys())
+        for fd in poll_readable(fds):
+            if fd == listen_fd:
+                cfd = unix_accept(sock)
+                conns[cfd] = Connection(cfd, pool.take())
+                continue
+            conn = conns[fd]
+            try:
+                data = os.read(fd, 65536)
+                if data:
+                    conn.handle(data)
+                    continue
+            except OSError:
+                pass  # reset by the client, drop the connection
+            del conns[fd]
+            os.close(fd)
+        # Replace the instances handed out while idle
+        pool.fill()
+
+######################################
+# Process pool
+######################################
+
+# Run the command lines from fd across jobs forked worker processes.
+# The compiled module is shared copy-on-write with the workers and each
+# worker runs a contiguous shard of the lines against its own Instance,
+# so the calls must be independent of each other. Results are written
+# in input order once all workers have finished.
+def run_batch_parallel(compiled, fd, jobs):
+    rdr = line_reader(fd)
+    lines = []
+    while True:
+        line = rdr.readline()
+        if line is None: break
+        lines.append(line)
+
+    shard_size = (len(lines) + jobs - 1) // jobs
+    flush_output()  # so workers do not inherit pending output
+    pids = []
+    pipes = []
+    for j in range(jobs):
+        start = j * shard_size
+        end = min(start + shard_size, len(lines))
+        if start >= end: break
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Worker. Guest output goes down the pipe too, so it is
+            # emitted with the results of its commands in input order
+            os.close(rfd)
+            STDOUT.fd = wfd
+            STDOUT.line_buffered = False
+            status = 0
+            try:
+                inst = Instance(compiled, CORE_IMPORTS, {})
+                for line in lines[start:end]:
+                    if not inst.run_command(line, wfd):
+                        status = 1
+            except Exception as e:
+                os.write(2, "Exception: %s\n" % e)
+                status = 1
+            flush_output()
+            os._exit(status)
+        os.close(wfd)
+        pids.append(pid)
+        pipes.append(rfd)
+
+    # Drain all pipes concurrently so no worker blocks on a full pipe
+    outputs = [[] for _ in pipes]
+    open_fds = {}
+    for i, rfd in enumerate(pipes):
+        open_fds[rfd] = i
+    while len(open_fds) > 0:
+        for rfd in poll_readable(open_fds.keys()):
+            data = os.read(rfd, 65536)
+            if data:
+                outputs[open_fds[rfd]].append(data)
+            else:
+                os.close(rfd)
+                del open_fds[rfd]
+
+    result = 0
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            result = 1
+    for out in outputs:
+        write_all(1, "".join(out))
+    return result
+
+
 def entry_point(argv):
+    STDOUT.line_buffered = os.isatty(1)
+    try:
+        return main(argv)
+    finally:
+        flush_output()
+
+def main(argv):
     try:
         # Argument handling
         repl = False
+        serve_path = ""
+        pool_size = 4
+        jobs = 1
+        batch = False
+        batch_file = ""
+        cache_dir = ""
+        engine = DEFAULT_ENGINE
+        tier_threshold = -1
+        tier_up = ""
+        optimize = True
+        peephole_report = False
+        lazy = False
         args = []
-        for arg in argv[1:]:
+        idx = 1
+        while idx < len(argv):
+            arg = argv[idx]
             if arg == "--repl":
                 repl = True
+            elif arg == "--serve":
+                idx += 1
+                serve_path = argv[idx]
+            elif arg == "--pool":
+                idx += 1
+                pool_size = string_to_int(argv[idx])
+            elif arg == "--jobs":
+                idx += 1
+                batch = True  # --jobs only applies to batches
+                jobs = string_to_int(argv[idx])
+                if jobs < 1:
+                    raise Exception("--jobs must be at least 1")
+            elif arg == "--batch":
+                batch = True
+            elif arg == "--batch-file":
+                idx += 1
+                batch = True
+                batch_file = argv[idx]
+            elif arg == "--cache-dir":
+                idx += 1
+                cache_dir = argv[idx]
+            elif arg == "--engine":
+                idx += 1
+                engine = argv[idx]
+                if engine not in ENGINES:
+                    raise Exception("unknown engine '%s' (one of: %s)" % (
+                        engine, ", ".join(ENGINES)))
+            elif arg == "--no-peephole":
+                optimize = False
+            elif arg == "--peephole-report":
+                peephole_report = True
+            elif arg == "--lazy":
+                lazy = True
+            elif arg == "--tier-threshold":
+                idx += 1
+                tier_threshold = string_to_int(argv[idx])
+            elif arg == "--tier-up":
+                idx += 1
+                tier_up = argv[idx]
+                if tier_up not in ("python", "closure"):
+                    raise Exception("unknown tier '%s' (one of: python,"
+                                    " closure)" % tier_up)
             elif arg == "--":
-                continue
+                pass
             else:
                 args.append(arg)
-        wasm = open(args[0]).read()
+            idx += 1
+        # Pipes are parsed as they are read (the cache needs the
+        # whole module up front to hash it)
+        fd = -1
+        if not cache_dir:
+            fd = open_wasm_stream(args[0])
+        if fd >= 0:
+            wasm = bytearray()
+        else:
+            wasm = read_wasm_file(args[0])
         args = args[1:]
 
         #
 
-        m = Module(wasm, call_import, {})
-
+        compiled = CompiledModule(wasm, cache_dir, optimize, fd, lazy)
+        if fd > 0:
+            os.close(fd)
+        compiled.set_engine(engine)
+        if peephole_report:
+            compiled.report_peephole()
+        if tier_threshold >= 0:
+            compiled.tier_threshold = tier_threshold
+        if tier_up:
+            compiled.tier_up = tier_up
+        if serve_path:
+            serve(compiled, serve_path, pool_size)
+            return 0
+        if batch:
+            # Invoke one function per input line and exit
+            fd = 0
+            if batch_file:
+                fd = os.open(batch_file, os.O_RDONLY, 0777)
+            try:
+                if jobs > 1:
+                    return run_batch_parallel(compiled, fd, jobs)
+                res = Instance(compiled, CORE_IMPORTS, {}).run_batch(fd)
+                if lazy:
+                    compiled.report_compiled()
+                return res
+            finally:
+                if batch_file:
+                    os.close(fd)
+
+        m = Instance(compiled, CORE_IMPORTS, {})
         if not repl:
             # Invoke one function and exit
             try:
-                return m.run(args)
+                res = m.run(args)
             except WAException as e:
                 if not IS_RPYTHON:
                     os.write(2, "".join(traceback.format_exception(*sys.exc_info())))
                 os.write(2, "%s\n" % e.message)
-                return 1
+                res = 1
+            if lazy:
+                compiled.report_compiled()
+            return res
         else:
             # Simple REPL
             while True: